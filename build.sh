@@ -1,11 +1,12 @@
 #!/bin/bash
 WD=$(pwd)
 
+# Images are built from docker-images/ so they can share lagopus-common/
 function build_tag_push() {
   printf ">>> Building docker image '%s'\n" "$1"
-  cd docker-images/$1
-  SHA=$(docker build -q . | cut -d':' -f2)
-  echo "Tagging fuzzer ($(pwd))"
+  cd docker-images
+  SHA=$(docker build -q -f $1/Dockerfile . | cut -d':' -f2)
+  echo "Tagging $1"
   docker tag $SHA qlyoung/$1:latest
   docker push qlyoung/$1:latest
   cd $WD
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) Quentin Young 2020
+# MIT License
+#
+# Compressed, content addressed storage for crash texts.
+#
+# Backtraces and program output are stored in the blobs table keyed by the
+# SHA-1 of their uncompressed contents, so identical texts are stored once.
+# Sanitizer reports are very repetitive, so they're compressed with zstd using
+# a dictionary trained on the texts already in the database. Dictionaries live
+# in the blob_dicts table and are never modified, so a blob can always be
+# decompressed with the dictionary it was written with.
+#
+# Shared by lagopus-scanner, which writes blobs, and lagopus-server, which
+# reads them.
+
+import hashlib
+import random
+
+import zstandard
+
+CODEC_RAW = "raw"
+CODEC_ZSTD = "zstd"
+
+# zstd compression level for new blobs
+LEVEL = 19
+# size of trained dictionaries, in bytes
+DICT_SIZE = 112 * 1024
+# number of blobs to sample when training a dictionary
+DICT_SAMPLES = 5000
+# don't train a dictionary from fewer blobs than this
+DICT_MIN_SAMPLES = 500
+
+
+def blob_hash(data):
+    """
+    :param data: uncompressed blob contents
+    :return: key of the blob in the blobs table
+    """
+    return hashlib.sha1(data).hexdigest()
+
+
+class BlobCodec(object):
+    """
+    Compresses and decompresses blobs, caching dictionaries as they're needed.
+
+    New blobs are compressed with the most recently trained dictionary, or
+    without one if none has been trained yet.
+    """
+
+    def __init__(self, level=LEVEL):
+        self.level = level
+        self.dicts = {}
+        self.current = None
+        self.compressor = zstandard.ZstdCompressor(level=level)
+
+    def _load(self, cursor, dict_id):
+        cursor.execute(
+            "SELECT data FROM blob_dicts WHERE id = %(id)s", {"id": dict_id},
+        )
+        result = cursor.fetchall()
+        if not result:
+            raise KeyError("No blob dictionary {}".format(dict_id))
+        self.dicts[dict_id] = zstandard.ZstdCompressionDict(bytes(result[0][0]))
+        return self.dicts[dict_id]
+
+    def refresh(self, cursor):
+        """
+        Start compressing with the newest dictionary, if it has changed.
+
+        :param cursor: database cursor
+        """
+        cursor.execute("SELECT MAX(id) FROM blob_dicts")
+        result = cursor.fetchall()
+        newest = result[0][0] if result else None
+        if newest is None or newest == self.current:
+            return
+
+        zdict = self.dicts.get(newest) or self._load(cursor, newest)
+        self.compressor = zstandard.ZstdCompressor(level=self.level, dict_data=zdict)
+        self.current = newest
+
+    def compress(self, data):
+        """
+        :param data: uncompressed blob contents
+        :return: (codec, dict_id, stored data)
+        """
+        return CODEC_ZSTD, self.current, self.compressor.compress(data)
+
+    def decompress(self, cursor, codec, dict_id, data):
+        """
+        :param cursor: database cursor, used to load the dictionary if it
+                       isn't cached
+        :param codec: codec the blob was stored with
+        :param dict_id: dictionary the blob was compressed with, or None
+        :param data: stored data
+        :return: uncompressed blob contents
+        """
+        data = bytes(data)
+        if codec == CODEC_RAW:
+            return data
+        if codec != CODEC_ZSTD:
+            raise ValueError("Unknown blob codec {}".format(codec))
+
+        if dict_id is None:
+            return zstandard.ZstdDecompressor().decompress(data)
+
+        zdict = self.dicts.get(dict_id) or self._load(cursor, dict_id)
+        return zstandard.ZstdDecompressor(dict_data=zdict).decompress(data)
+
+
+def put(cursor, codec, blobs):
+    """
+    Store blobs, skipping any that are already stored. Only new blobs are
+    compressed.
+
+    This doesn't commit; the caller decides the transaction boundary.
+
+    :param cursor: database cursor
+    :param codec: BlobCodec
+    :param blobs: dict of uncompressed blob contents keyed by blob_hash
+    :return: number of blobs newly stored
+    """
+    if not blobs:
+        return 0
+
+    hashes = list(blobs.keys())
+    cursor.execute(
+        "SELECT hash FROM blobs WHERE hash IN ({})".format(
+            ", ".join(["%s"] * len(hashes))
+        ),
+        hashes,
+    )
+    existing = set(h for (h,) in cursor.fetchall())
+
+    rows = []
+    for h, data in blobs.items():
+        if h in existing:
+            continue
+        blobcodec, dict_id, stored = codec.compress(data)
+        rows.append((h, len(data), blobcodec, dict_id, stored))
+
+    # another scanner may have stored the same blob since we checked; it has
+    # the same contents, so leave it be
+    cursor.executemany(
+        "INSERT INTO blobs (hash, size, codec, dict_id, data) VALUES (%s, %s, %s, %s, %s) AS new ON DUPLICATE KEY UPDATE hash = new.hash",
+        rows,
+    )
+    return len(rows)
+
+
+def get_many(cursor, codec, hashes):
+    """
+    Fetch and decompress several blobs.
+
+    :param cursor: database cursor
+    :param codec: BlobCodec
+    :param hashes: blob_hash of each blob
+    :return: dict of uncompressed blob contents keyed by blob_hash; blobs that
+             don't exist are left out
+    """
+    hashes = list(set(hashes))
+    if not hashes:
+        return {}
+
+    cursor.execute(
+        "SELECT hash, codec, dict_id, data FROM blobs WHERE hash IN ({})".format(
+            ", ".join(["%s"] * len(hashes))
+        ),
+        hashes,
+    )
+    return {
+        h: codec.decompress(cursor, blobcodec, dict_id, data)
+        for h, blobcodec, dict_id, data in cursor.fetchall()
+    }
+
+
+def get(cursor, codec, blobhash):
+    """
+    Fetch and decompress a blob.
+
+    :param cursor: database cursor
+    :param codec: BlobCodec
+    :param blobhash: blob_hash of the blob
+    :return: uncompressed blob contents, or None if there's no such blob
+    """
+    return get_many(cursor, codec, [blobhash]).get(blobhash)
+
+
+def train(cursor, codec, samples=DICT_SAMPLES, size=DICT_SIZE):
+    """
+    Train a new dictionary on a random sample of the stored blobs and make it
+    the one new blobs are compressed with.
+
+    This doesn't commit; the caller decides the transaction boundary.
+
+    :param cursor: database cursor
+    :param codec: BlobCodec
+    :param samples: maximum number of blobs to train on
+    :param size: dictionary size, in bytes
+    :return: ID of the new dictionary, or None if there weren't enough blobs
+             to train on or training failed
+    """
+    cursor.execute("SELECT hash FROM blobs")
+    hashes = [h for (h,) in cursor.fetchall()]
+    if len(hashes) < DICT_MIN_SAMPLES:
+        return None
+
+    hashes = random.sample(hashes, min(samples, len(hashes)))
+    texts = []
+    for i in range(0, len(hashes), 500):
+        texts.extend(get_many(cursor, codec, hashes[i : i + 500]).values())
+    try:
+        zdict = zstandard.train_dictionary(size, texts)
+    except zstandard.ZstdError:
+        # samples too small or too uniform to train a dictionary of this size
+        return None
+
+    cursor.execute(
+        "INSERT INTO blob_dicts (data, samples) VALUES (%(data)s, %(samples)s)",
+        {"data": zdict.as_bytes(), "samples": len(texts)},
+    )
+    codec.refresh(cursor)
+    return codec.current
+
+
+def recompress(cursor, codec, limit):
+    """
+    Recompress blobs that aren't stored with the current dictionary.
+
+    This doesn't commit; the caller decides the transaction boundary.
+
+    :param cursor: database cursor
+    :param codec: BlobCodec
+    :param limit: maximum number of blobs to recompress
+    :return: number of blobs recompressed
+    """
+    if codec.current is None:
+        cursor.execute(
+            "SELECT hash, codec, dict_id, data FROM blobs WHERE codec <> %(codec)s LIMIT %(limit)s",
+            {"codec": CODEC_ZSTD, "limit": limit},
+        )
+    else:
+        cursor.execute(
+            "SELECT hash, codec, dict_id, data FROM blobs WHERE dict_id IS NULL OR dict_id <> %(dict_id)s LIMIT %(limit)s",
+            {"dict_id": codec.current, "limit": limit},
+        )
+
+    rows = []
+    for h, blobcodec, dict_id, data in cursor.fetchall():
+        data = codec.decompress(cursor, blobcodec, dict_id, data)
+        rows.append(codec.compress(data) + (h,))
+
+    cursor.executemany(
+        "UPDATE blobs SET codec = %s, dict_id = %s, data = %s WHERE hash = %s", rows,
+    )
+    return len(rows)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) Quentin Young 2020
+# MIT License
+#
+# Writing crash analyses into the crashes and crash_frames tables.
+#
+# A crash is identified within its job by the hash of its backtrace, so
+# importing the same crash again, from another sample or from the job's final
+# results after it was ingested live, updates it rather than adding another.
+#
+# Shared by lagopus-scanner, which imports crashes from the crash databases in
+# job results, and lagopus-server, which ingests them from fuzzers as they're
+# found.
+
+import datetime
+import hashlib
+import os
+
+import lagopus_blobs
+
+CRASH_COLUMNS = [
+    "job_id",
+    "job_time",
+    "type",
+    "is_security_issue",
+    "is_crash",
+    "sample_path",
+    "backtrace_hash",
+    "backtrace_blob",
+    "output_blob",
+    "return_code",
+    "create_time",
+]
+
+# columns refreshed when a crash is imported again; sample_path and
+# create_time are kept so they continue to refer to the first sample seen
+CRASH_UPDATE_COLUMNS = [
+    "type",
+    "is_security_issue",
+    "is_crash",
+    "backtrace_blob",
+    "output_blob",
+    "return_code",
+]
+
+
+FRAME_COLUMNS = [
+    "job_id",
+    "backtrace_hash",
+    "thread",
+    "frame",
+    "depth",
+    "function",
+    "file",
+    "file_name",
+    "line",
+    "module",
+]
+
+# longest function, file and module names that fit in crash_frames
+FRAME_NAME_MAX = 1024
+
+
+def job_time(cursor, jobid, fallback):
+    """
+    Get the creation time of a job, which crashes are partitioned by.
+
+    This must map a job to the same time every time it's called, since it's
+    part of the crashes primary key. It comes from the jobs table, or for jobs
+    no longer in it, the timestamp that lagopus_job_id() puts at the end of
+    each job ID.
+
+    :param cursor: database cursor, or None
+    :param jobid: job ID
+    :param fallback: time to use if neither is available
+    :return: naive datetime
+    """
+    if cursor:
+        cursor.execute(
+            "SELECT create_time FROM jobs WHERE job_id = %(job_id)s", {"job_id": jobid}
+        )
+        result = cursor.fetchall()
+        if result and result[0][0]:
+            return result[0][0]
+
+    try:
+        return datetime.datetime.strptime(jobid.split(".")[-1], "%Y-%m-%d-%H-%M-%S")
+    except ValueError:
+        return fallback
+
+
+def backtrace_hash(backtrace):
+    """
+    :param backtrace: UTF-8 encoded backtrace
+    :return: hash crashes are deduplicated on within a job
+    """
+    return hashlib.md5(backtrace).hexdigest()
+
+
+def crash_rows(jobid, jobtime, create_time, crashes, sample_frames):
+    """
+    Turn crash analyses into rows for export().
+
+    :param jobid: job the crashes were found by
+    :param jobtime: job_time() of the job
+    :param create_time: time to record the crashes as found at
+    :param crashes: iterable of tuples of (sample, type, is_crash,
+                    is_security_issue, backtrace, output, return_code)
+    :param sample_frames: dict of lists of (thread, frame, depth, function,
+                          file, line, module) keyed by sample
+    :return: tuple of (crash rows, blobs, frame rows)
+    """
+    rows = []
+    blobs = {}
+    frames = []
+    for sample, ctype, is_crash, is_security_issue, backtrace, output, rc in crashes:
+        backtrace = backtrace.encode("utf8")
+        bthash = backtrace_hash(backtrace)
+        backtrace_blob = lagopus_blobs.blob_hash(backtrace)
+        blobs[backtrace_blob] = backtrace
+        output_blob = None
+        if output:
+            output = output.encode("utf8")
+            output_blob = lagopus_blobs.blob_hash(output)
+            blobs[output_blob] = output
+        rows.append(
+            (
+                jobid,
+                jobtime,
+                ctype,
+                bool(is_security_issue),
+                bool(is_crash),
+                sample,
+                bthash,
+                backtrace_blob,
+                output_blob,
+                rc,
+                create_time,
+            )
+        )
+        for thread, frame, depth, function, file, line, module in sample_frames.get(
+            sample, []
+        ):
+            frames.append(
+                (
+                    jobid,
+                    bthash,
+                    thread,
+                    frame,
+                    depth,
+                    function[:FRAME_NAME_MAX] if function else None,
+                    file[:FRAME_NAME_MAX] if file else None,
+                    os.path.basename(file)[:255] if file else None,
+                    line,
+                    module[:FRAME_NAME_MAX] if module else None,
+                )
+            )
+    return rows, blobs, frames
+
+
+def export(cursor, codec, rows, blobs, frames):
+    """
+    Upsert a batch of crashes and their stack frames.
+
+    This doesn't commit; the caller decides the transaction boundary. All
+    values are passed as parameters so that the connector can rewrite the batch
+    into a single multi-row INSERT.
+
+    :param cursor: database cursor
+    :param codec: lagopus_blobs.BlobCodec to compress new blobs with
+    :param rows: list of tuples of values for CRASH_COLUMNS
+    :param blobs: dict of UTF-8 encoded texts referenced by rows, keyed by
+                  lagopus_blobs.blob_hash
+    :param frames: list of tuples of values for FRAME_COLUMNS
+    """
+    # blobs are content addressed, so an existing one never needs updating
+    lagopus_blobs.put(cursor, codec, blobs)
+
+    query = "INSERT INTO crashes ({}) VALUES ({}) AS new ON DUPLICATE KEY UPDATE {}".format(
+        ", ".join(CRASH_COLUMNS),
+        ", ".join(["%s"] * len(CRASH_COLUMNS)),
+        ", ".join("{0} = new.{0}".format(c) for c in CRASH_UPDATE_COLUMNS),
+    )
+    cursor.executemany(query, rows)
+
+    # samples with the same backtrace share frames, so just keep the last
+    query = "INSERT INTO crash_frames ({}) VALUES ({}) AS new ON DUPLICATE KEY UPDATE {}".format(
+        ", ".join(FRAME_COLUMNS),
+        ", ".join(["%s"] * len(FRAME_COLUMNS)),
+        ", ".join("{0} = new.{0}".format(c) for c in FRAME_COLUMNS[4:]),
+    )
+    cursor.executemany(query, frames)
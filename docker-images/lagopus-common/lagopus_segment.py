@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) Quentin Young 2020
+# MIT License
+#
+# Packed corpus segments.
+#
+# Corpora are directories of many small files, and every hop over NFS costs
+# metadata operations per file. A segment packs a corpus into two files:
+#
+#   <name>.seg  the contents of every input, back to back
+#   <name>.idx  header, then one record per input sorted by SHA-1:
+#               SHA-1 (20 bytes), offset (u64), length (u64), little endian
+#
+# so moving a corpus is a couple of large sequential transfers. Both are read
+# with mmap, and an input is found by binary search on the index without
+# reading the rest.
+#
+# Shared by lagopus-fuzzer, which packs and unpacks corpora, and
+# lagopus-server, which keeps the corpus store in segments.
+
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+
+MAGIC = b"LGPSEG01"
+HEADER = struct.Struct("<8sQ")
+RECORD = struct.Struct("<20sQQ")
+
+
+def segment_paths(path):
+    """
+    :param path: segment path, with or without extension
+    :return: tuple of (data file path, index file path)
+    """
+    base = path[: -len(".seg")] if path.endswith(".seg") else path
+    return base + ".seg", base + ".idx"
+
+
+def pack(inputs, path):
+    """
+    Pack inputs into a segment. Inputs with the same contents are stored once.
+
+    :param inputs: iterable of (SHA-1 hex digest or None, bytes or file path);
+                   a digest of None is computed
+    :param path: segment path
+    :return: number of inputs packed
+    """
+    seg_path, idx_path = segment_paths(path)
+    records = {}
+    offset = 0
+    with open(seg_path + ".tmp", "wb") as seg:
+        for digest, data in inputs:
+            if not isinstance(data, (bytes, bytearray, memoryview)):
+                with open(data, "rb") as f:
+                    data = f.read()
+            digest = bytes.fromhex(digest) if digest else hashlib.sha1(data).digest()
+            if digest in records:
+                continue
+            seg.write(data)
+            records[digest] = (offset, len(data))
+            offset += len(data)
+
+    with open(idx_path + ".tmp", "wb") as idx:
+        idx.write(HEADER.pack(MAGIC, len(records)))
+        for digest in sorted(records):
+            idx.write(RECORD.pack(digest, *records[digest]))
+
+    # index last, so a segment with an index is always complete
+    os.rename(seg_path + ".tmp", seg_path)
+    os.rename(idx_path + ".tmp", idx_path)
+    return len(records)
+
+
+def pack_directory(directory, path):
+    """
+    Pack every file in a directory into a segment.
+
+    :return: number of inputs packed
+    """
+    with os.scandir(directory) as entries:
+        files = sorted(e.path for e in entries if e.is_file())
+    return pack(((None, f) for f in files), path)
+
+
+class Segment(object):
+    """
+    Read only view of a segment.
+
+    :param path: segment path, with or without extension
+    """
+
+    def __init__(self, path):
+        self.path = path
+        seg_path, idx_path = segment_paths(path)
+        with open(idx_path, "rb") as idx:
+            self.index = mmap.mmap(idx.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.index) < HEADER.size:
+            self.index.close()
+            raise ValueError("{} is not a segment index".format(idx_path))
+        magic, self.count = HEADER.unpack_from(self.index)
+        if magic != MAGIC:
+            self.index.close()
+            raise ValueError("{} is not a segment index".format(idx_path))
+        if len(self.index) < HEADER.size + self.count * RECORD.size:
+            self.index.close()
+            raise ValueError("{} is truncated".format(idx_path))
+        if os.path.getsize(seg_path):
+            with open(seg_path, "rb") as seg:
+                self.data = mmap.mmap(seg.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # mmap can't map empty files
+            self.data = b""
+
+    def close(self):
+        self.index.close()
+        if self.data:
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def record(self, i):
+        """
+        :return: tuple of (SHA-1 hex digest, offset, length) of the i-th input
+        """
+        digest, offset, length = RECORD.unpack_from(
+            self.index, HEADER.size + i * RECORD.size
+        )
+        return digest.hex(), offset, length
+
+    def find(self, digest):
+        """
+        :param digest: SHA-1 hex digest
+        :return: tuple of (offset, length), or None if it isn't in the segment
+        """
+        key = bytes.fromhex(digest)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = HEADER.size + mid * RECORD.size
+            if self.index[start : start + 20] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count:
+            found, offset, length = RECORD.unpack_from(
+                self.index, HEADER.size + lo * RECORD.size
+            )
+            if found == key:
+                return offset, length
+        return None
+
+    def __contains__(self, digest):
+        return self.find(digest) is not None
+
+    def get(self, digest):
+        """
+        :return: contents of an input, or None if it isn't in the segment
+        """
+        found = self.find(digest)
+        if not found:
+            return None
+        offset, length = found
+        return self.data[offset : offset + length]
+
+    def __iter__(self):
+        """
+        Digests of the inputs, in index order.
+        """
+        for i in range(self.count):
+            yield self.record(i)[0]
+
+    def items(self):
+        """
+        Digests and contents of the inputs, in the order they were packed, so
+        that the data file is read sequentially.
+        """
+        records = sorted(map(self.record, range(self.count)), key=lambda r: r[1])
+        for digest, offset, length in records:
+            yield digest, self.data[offset : offset + length]
+
+    def sizes(self):
+        """
+        :return: dict mapping digest to size of each input
+        """
+        return {d: length for d, _, length in map(self.record, range(self.count))}
+
+
+def unpack(path, directory):
+    """
+    Unpack a segment into a directory, naming inputs by their SHA-1.
+
+    :return: number of inputs unpacked
+    """
+    os.makedirs(directory, exist_ok=True)
+    with Segment(path) as segment:
+        for digest, data in segment.items():
+            with open(os.path.join(directory, digest), "wb") as f:
+                f.write(data)
+        return len(segment)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack and unpack corpus segments")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    parser_pack = subparsers.add_parser("pack", help="Pack a directory")
+    parser_pack.add_argument("directory")
+    parser_pack.add_argument("segment")
+    parser_unpack = subparsers.add_parser("unpack", help="Unpack into a directory")
+    parser_unpack.add_argument("segment")
+    parser_unpack.add_argument("directory")
+    parser_list = subparsers.add_parser("list", help="List inputs and their sizes")
+    parser_list.add_argument("segment")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        print("Packed {} inputs".format(pack_directory(args.directory, args.segment)))
+    elif args.command == "unpack":
+        print("Unpacked {} inputs".format(unpack(args.segment, args.directory)))
+    elif args.command == "list":
+        with Segment(args.segment) as segment:
+            for digest, size in segment.sizes().items():
+                print("{} {}".format(digest, size))
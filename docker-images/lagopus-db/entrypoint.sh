@@ -0,0 +1,8 @@
+#!/bin/bash
+#
+# Start MySQL with the stock entrypoint and bring the schema up to date in the
+# background once it's accepting connections.
+
+lagopus-migrate --wait &
+
+exec docker-entrypoint.sh "$@"
@@ -0,0 +1,52 @@
+#!/bin/bash
+#
+# Apply pending schema migrations to the lagopus database.
+#
+# Each file in the migrations directory is applied once, in order, and records
+# itself in schema_migrations when it finishes. Fresh databases get every
+# migration at initialization time; run this against existing databases to
+# bring them up to date. It's run automatically each time the container starts.
+#
+# Usage: lagopus-migrate [--wait] [migrations_dir]
+#
+#   --wait: wait for the server to come up first
+
+MIGRATIONS="/migrations"
+
+if [ "$1" == "--wait" ]; then
+  WAIT=1
+  shift
+fi
+
+if [ "$1" != "" ]; then
+  MIGRATIONS="$1"
+fi
+
+# Connect over TCP so that we never talk to the temporary, socket-only server
+# the stock entrypoint runs while initializing a fresh database
+MYSQL=(mysql --protocol=tcp -h 127.0.0.1 -uroot -p"$MYSQL_ROOT_PASSWORD" "$MYSQL_DATABASE")
+
+if [ "$WAIT" == "1" ]; then
+  until "${MYSQL[@]}" -e "SELECT 1" &>/dev/null; do
+    sleep 5
+  done
+fi
+
+# databases from before migrations existed won't have this table
+"${MYSQL[@]}" -e "CREATE TABLE IF NOT EXISTS schema_migrations (version varchar(128) NOT NULL, applied_time timestamp DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (version)) ENGINE=InnoDB" || exit 1
+
+for MIGRATION in "$MIGRATIONS"/*.sql; do
+  VERSION="$(basename "$MIGRATION" .sql)"
+  APPLIED="$("${MYSQL[@]}" -N -e "SELECT COUNT(*) FROM schema_migrations WHERE version = '$VERSION'")"
+  if [ "$APPLIED" != "0" ]; then
+    continue
+  fi
+
+  printf "Applying migration %s\n" "$VERSION"
+  if ! "${MYSQL[@]}" < "$MIGRATION"; then
+    printf "Migration %s failed; not applying any more\n" "$VERSION"
+    exit 1
+  fi
+done
+
+exit 0
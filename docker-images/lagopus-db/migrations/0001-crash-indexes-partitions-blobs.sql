@@ -0,0 +1,101 @@
+USE lagopus;
+# Move backtraces and program output out of the crashes table into a
+# compressed, content addressed side table; add secondary indexes for the
+# API's queries; partition crashes by month of job creation.
+#
+# Every unique key of a partitioned table must include the partitioning
+# column, so the partition key is the job's creation time rather than the
+# crash's. A job ID always maps to the same job_time, so the primary key still
+# deduplicates on (job_id, backtrace_hash) as before.
+
+CREATE TABLE IF NOT EXISTS `blobs` (
+    `hash` char(40) NOT NULL,  # sha1 of the uncompressed text
+    `size` int(11) NOT NULL,
+    `data` longblob NOT NULL,
+    PRIMARY KEY (`hash`)
+  ) ENGINE=InnoDB ROW_FORMAT=COMPRESSED KEY_BLOCK_SIZE=8;
+
+DROP TABLE IF EXISTS `crashes_new`;
+CREATE TABLE `crashes_new` (
+    `job_id` varchar(128) NOT NULL,
+    `job_time` timestamp NOT NULL,  # creation time of the job
+    `type` varchar(64) NOT NULL,
+    `is_security_issue` BOOLEAN,
+    `is_crash` BOOLEAN,
+    `sample_path` varchar(4096) NOT NULL,
+    `backtrace_hash` char(65) NOT NULL,  # two md5s plus a period
+    `backtrace_blob` char(40),
+    `output_blob` char(40),
+    `return_code` int(11),
+    `create_time` timestamp,
+    PRIMARY KEY (`job_id`, `backtrace_hash`, `job_time`),
+    KEY `create_time` (`create_time`),
+    KEY `type_time` (`type`, `create_time`),
+    KEY `security_time` (`is_security_issue`, `create_time`)
+  ) ENGINE=InnoDB
+  PARTITION BY RANGE (UNIX_TIMESTAMP(`job_time`)) (
+    PARTITION pfuture VALUES LESS THAN MAXVALUE
+  );
+
+INSERT IGNORE INTO `blobs` (`hash`, `size`, `data`)
+  SELECT SHA1(`backtrace`), LENGTH(`backtrace`), `backtrace` FROM `crashes`;
+
+# job_time comes from the jobs table, or the timestamp lagopus_job_id()
+# appends to the job ID for crashes whose job has since been deleted
+INSERT INTO `crashes_new`
+  (`job_id`, `job_time`, `type`, `is_security_issue`, `is_crash`, `sample_path`,
+   `backtrace_hash`, `backtrace_blob`, `output_blob`, `return_code`, `create_time`)
+  SELECT c.`job_id`,
+         COALESCE(j.`create_time`,
+                  IF(SUBSTRING_INDEX(c.`job_id`, '.', -1) REGEXP '^[0-9]{4}(-[0-9]{2}){5}$',
+                     STR_TO_DATE(SUBSTRING_INDEX(c.`job_id`, '.', -1), '%Y-%m-%d-%H-%i-%s'),
+                     NULL),
+                  c.`create_time`,
+                  FROM_UNIXTIME(1)),
+         c.`type`, c.`is_security_issue`, c.`is_crash`, c.`sample_path`,
+         COALESCE(c.`backtrace_hash`, ''), SHA1(c.`backtrace`), NULL,
+         c.`return_code`, c.`create_time`
+  FROM `crashes` c LEFT JOIN `jobs` j ON j.`job_id` = c.`job_id`;
+
+RENAME TABLE `crashes` TO `crashes_unpartitioned`, `crashes_new` TO `crashes`;
+DROP TABLE `crashes_unpartitioned`;
+
+# Split monthly partitions off the catch-all partition up to `months` ahead.
+# Run daily by the crashes_partitions event, so there's always a partition
+# ready for the next month's jobs. The first split also takes in everything
+# older than the current month.
+DROP PROCEDURE IF EXISTS `crashes_add_partitions`;
+DELIMITER //
+CREATE PROCEDURE `crashes_add_partitions`(IN months INT)
+BEGIN
+  DECLARE i INT DEFAULT 0;
+  DECLARE bound DATE;
+  DECLARE pname VARCHAR(16);
+  WHILE i <= months DO
+    SET bound = DATE_ADD(DATE_FORMAT(CURRENT_DATE, '%Y-%m-01'), INTERVAL i + 1 MONTH);
+    SET pname = CONCAT('p', DATE_FORMAT(DATE_SUB(bound, INTERVAL 1 MONTH), '%Y%m'));
+    IF NOT EXISTS (
+      SELECT 1 FROM information_schema.partitions
+      WHERE table_schema = DATABASE() AND table_name = 'crashes'
+        AND partition_name = pname
+    ) THEN
+      SET @ddl = CONCAT(
+        'ALTER TABLE crashes REORGANIZE PARTITION pfuture INTO (',
+        'PARTITION ', pname, ' VALUES LESS THAN (UNIX_TIMESTAMP(''', bound, ''')), ',
+        'PARTITION pfuture VALUES LESS THAN MAXVALUE)');
+      PREPARE stmt FROM @ddl;
+      EXECUTE stmt;
+      DEALLOCATE PREPARE stmt;
+    END IF;
+    SET i = i + 1;
+  END WHILE;
+END //
+DELIMITER ;
+
+CALL crashes_add_partitions(3);
+
+DROP EVENT IF EXISTS `crashes_partitions`;
+CREATE EVENT `crashes_partitions` ON SCHEDULE EVERY 1 DAY
+  DO CALL crashes_add_partitions(3);
+
+INSERT INTO `schema_migrations` (`version`) VALUES ('0001-crash-indexes-partitions-blobs');
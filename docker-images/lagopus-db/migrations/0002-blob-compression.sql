@@ -0,0 +1,23 @@
+USE lagopus;
+# Compress blobs with zstd, using dictionaries trained on the stored texts.
+#
+# Existing blobs are left as they are and marked raw; lagopus-scanner trains a
+# dictionary once there are enough of them and recompresses them a batch at a
+# time. Since the data is compressed before it reaches InnoDB, the table goes
+# back to the default row format so pages aren't compressed twice.
+
+CREATE TABLE `blob_dicts` (
+    `id` int(11) NOT NULL AUTO_INCREMENT,
+    `data` mediumblob NOT NULL,  # zstd dictionary
+    `samples` int(11) NOT NULL,  # number of blobs it was trained on
+    `create_time` timestamp DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (`id`)
+  ) ENGINE=InnoDB;
+
+ALTER TABLE `blobs`
+  ADD COLUMN `codec` varchar(16) NOT NULL DEFAULT 'raw' AFTER `size`,
+  ADD COLUMN `dict_id` int(11) AFTER `codec`,
+  ADD KEY `dict_id` (`dict_id`),
+  ROW_FORMAT=DYNAMIC KEY_BLOCK_SIZE=0;
+
+INSERT INTO `schema_migrations` (`version`) VALUES ('0002-blob-compression');
@@ -0,0 +1,27 @@
+USE lagopus;
+# Index the stack frames of each crash so crashes can be searched by function
+# and file without fetching and grepping every backtrace.
+#
+# depth counts only the frames the analyzer considers interesting, so "in the
+# top 3 frames" is depth < 3 regardless of how many sanitizer frames are on
+# top of the stack; it's NULL for frames it ignores.
+
+CREATE TABLE `crash_frames` (
+    `job_id` varchar(128) NOT NULL,
+    `backtrace_hash` char(65) NOT NULL,
+    `thread` int(11) NOT NULL,
+    `frame` int(11) NOT NULL,
+    `depth` int(11),
+    `function` varchar(1024),
+    `file` varchar(1024),
+    `file_name` varchar(255),  # basename of file
+    `line` int(11),
+    `module` varchar(1024),
+    PRIMARY KEY (`job_id`, `backtrace_hash`, `thread`, `frame`),
+    KEY `function_depth` (`function`(255), `depth`),
+    KEY `file_depth` (`file`(255), `depth`),
+    KEY `file_name_depth` (`file_name`, `depth`),
+    FULLTEXT KEY `search` (`function`, `file`)
+  ) ENGINE=InnoDB;
+
+INSERT INTO `schema_migrations` (`version`) VALUES ('0003-crash-frames');
@@ -0,0 +1,21 @@
+USE lagopus;
+# Queue of jobs waiting for cluster resources. Jobs are released into k8s by
+# the scheduler in lagopus-server once they fit, in order of priority and then
+# their user's share of the cluster.
+
+CREATE TABLE `job_queue` (
+    `job_id` varchar(128) NOT NULL,
+    `user` varchar(128) NOT NULL,
+    `priority` int(11) NOT NULL DEFAULT 0,
+    `cpus` int(11) NOT NULL,
+    `memory` int(11) NOT NULL,        # Mi
+    `state` varchar(16) NOT NULL,     # queued, released, failed, cancelled
+    `enqueue_time` datetime(6) NOT NULL,  # UTC
+    `release_time` datetime(6),       # UTC
+    `error` text,
+    PRIMARY KEY (`job_id`),
+    KEY `state_priority` (`state`, `priority`, `enqueue_time`),
+    KEY `state_release` (`state`, `release_time`)
+  ) ENGINE=InnoDB;
+
+INSERT INTO `schema_migrations` (`version`) VALUES ('0004-job-queue');
@@ -0,0 +1,17 @@
+USE lagopus;
+# Where the scheduler placed each job, so fuzzing throughput of jobs kept
+# within one NUMA node can be compared with jobs spanning several.
+
+CREATE TABLE `job_placements` (
+    `job_id` varchar(128) NOT NULL,
+    `node` varchar(253) NOT NULL,
+    `numa_node` int(11),              # NULL if the job spans NUMA nodes
+    `numa_nodes` int(11) NOT NULL,    # NUMA nodes on the node
+    `cpus` int(11) NOT NULL,
+    `place_time` datetime(6) NOT NULL,  # UTC
+    PRIMARY KEY (`job_id`),
+    KEY `node` (`node`),
+    KEY `place_time` (`place_time`)
+  ) ENGINE=InnoDB;
+
+INSERT INTO `schema_migrations` (`version`) VALUES ('0005-job-placements');
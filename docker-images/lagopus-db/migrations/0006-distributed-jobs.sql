@@ -0,0 +1,14 @@
+USE lagopus;
+# Distributed jobs run several pods under one job ID, each with the job's
+# cpus and memory, exchanging corpus entries through the job directory.
+
+ALTER TABLE `jobs` ADD COLUMN `pods` int(11) NOT NULL DEFAULT 1 AFTER `cpus`;
+ALTER TABLE `job_queue` ADD COLUMN `pods` int(11) NOT NULL DEFAULT 1 AFTER `cpus`;
+
+# one placement per pod
+ALTER TABLE `job_placements`
+  ADD COLUMN `pod` int(11) NOT NULL DEFAULT 0 AFTER `job_id`,
+  DROP PRIMARY KEY,
+  ADD PRIMARY KEY (`job_id`, `pod`);
+
+INSERT INTO `schema_migrations` (`version`) VALUES ('0006-distributed-jobs');
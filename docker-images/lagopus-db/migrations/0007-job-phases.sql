@@ -0,0 +1,23 @@
+USE lagopus;
+# Jobs run in phases, each its own k8s job: fuzz, then minimize, where crashes
+# are triaged and the corpus minimized with the job's minimize_cpus and
+# minimize_memory. The queue entry is reused for each phase.
+
+ALTER TABLE `jobs`
+  ADD COLUMN `phase` varchar(16) NOT NULL DEFAULT 'fuzz',  # fuzz, minimize, done
+  ADD COLUMN `phase_time` datetime(6),                     # UTC, when phase began
+  ADD COLUMN `minimize_cpus` int(11),
+  ADD COLUMN `minimize_memory` int(11);                    # Mi
+
+# jobs from before phases did everything in one pod
+UPDATE `jobs` SET `phase` = 'done' WHERE `status` NOT IN ('Queued');
+
+ALTER TABLE `job_queue` ADD COLUMN `phase` varchar(16) NOT NULL DEFAULT 'fuzz' AFTER `job_id`;
+
+# each phase is placed separately
+ALTER TABLE `job_placements`
+  ADD COLUMN `phase` varchar(16) NOT NULL DEFAULT 'fuzz' AFTER `job_id`,
+  DROP PRIMARY KEY,
+  ADD PRIMARY KEY (`job_id`, `phase`, `pod`);
+
+INSERT INTO `schema_migrations` (`version`) VALUES ('0007-job-phases');
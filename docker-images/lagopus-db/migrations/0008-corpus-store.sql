@@ -0,0 +1,12 @@
+USE lagopus;
+# Jobs are seeded from and add their corpus to a corpus in the corpus store on
+# the shared volume. Versions of a corpus are named after the job that made
+# them.
+
+ALTER TABLE `jobs`
+  ADD COLUMN `corpus` varchar(128),           # name in the corpus store
+  ADD COLUMN `corpus_seed` varchar(128),      # version the job was seeded from
+  ADD COLUMN `corpus_version` varchar(128);   # version made from the job's
+                                              # results; empty if it made none
+
+INSERT INTO `schema_migrations` (`version`) VALUES ('0008-corpus-store');
@@ -0,0 +1,20 @@
+USE lagopus;
+# Fuzzers stream crashes, corpus inputs and stats snapshots to the job
+# directory while they run. The scanner records each file it ingests from a
+# stream, so a job's results can be seen and fetched before it's done.
+
+CREATE TABLE `job_artifacts` (
+    `job_id` varchar(128) NOT NULL,
+    `path` varchar(512) NOT NULL,     # in the assembled working directory
+    `pod` int(11) NOT NULL,
+    `kind` varchar(16) NOT NULL,      # corpus, crash, hang, stats, log
+    `sha1` char(40) NOT NULL,
+    `size` bigint NOT NULL,
+    `segment` varchar(255) NOT NULL,  # latest segment with the file in it,
+                                      # relative to the job directory
+    `stream_time` datetime(6),        # UTC
+    PRIMARY KEY (`job_id`, `path`),
+    KEY `job_kind` (`job_id`, `kind`)
+  ) ENGINE=InnoDB;
+
+INSERT INTO `schema_migrations` (`version`) VALUES ('0009-result-streams');
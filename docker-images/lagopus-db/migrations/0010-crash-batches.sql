@@ -0,0 +1,17 @@
+USE lagopus;
+# Fuzzers and triage workers push crashes to /api/crashes/batch, and retry
+# batches that fail. Each batch carries a key; the key of every batch applied
+# is recorded in the same transaction as its crashes, so a retried batch is
+# recognized and not applied twice.
+
+CREATE TABLE `crash_batches` (
+    `batch_key` varchar(128) NOT NULL,
+    `accepted` int(11) NOT NULL,      # crashes stored
+    `duplicates` int(11) NOT NULL,    # crashes dropped as duplicates within
+                                      # the batch
+    `create_time` datetime(6) NOT NULL,  # UTC
+    PRIMARY KEY (`batch_key`),
+    KEY `create_time` (`create_time`)
+  ) ENGINE=InnoDB;
+
+INSERT INTO `schema_migrations` (`version`) VALUES ('0010-crash-batches');
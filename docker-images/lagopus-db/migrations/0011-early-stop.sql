@@ -0,0 +1,11 @@
+USE lagopus;
+# Jobs whose coverage has stopped growing are stopped before their deadline,
+# as decided by their plateau policy, so their cores go to queued jobs. Why a
+# job was stopped is recorded on it.
+
+ALTER TABLE `jobs`
+  ADD COLUMN `plateau_policy` varchar(64),  # NULL for the server's default
+  ADD COLUMN `stop_time` datetime(6),       # UTC, when stopped early
+  ADD COLUMN `stop_reason` varchar(1024);
+
+INSERT INTO `schema_migrations` (`version`) VALUES ('0011-early-stop');
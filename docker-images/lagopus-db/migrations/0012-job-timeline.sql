@@ -0,0 +1,19 @@
+USE lagopus;
+# Each step of each pod's phases, e.g. setting up the target, fuzzing,
+# triaging crashes, minimizing the corpus, is recorded as a span, so it's
+# plain where a job's time goes.
+
+CREATE TABLE `job_spans` (
+    `job_id` varchar(128) NOT NULL,
+    `phase` varchar(16) NOT NULL,      # fuzz, minimize
+    `pod` int(11) NOT NULL,
+    `name` varchar(64) NOT NULL,
+    `start_time` datetime(6) NOT NULL, # UTC
+    `end_time` datetime(6) NOT NULL,   # UTC
+    `cpu_seconds` double,              # used by the pod during the span
+    `memory_peak` bigint,              # pod's peak memory by the end, bytes
+    `detail` varchar(255),
+    PRIMARY KEY (`job_id`, `phase`, `pod`, `name`, `start_time`)
+  ) ENGINE=InnoDB;
+
+INSERT INTO `schema_migrations` (`version`) VALUES ('0012-job-timeline');
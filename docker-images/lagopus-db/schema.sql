@@ -1,4 +1,11 @@
 USE lagopus;
+# Baseline schema. Changes since are made by the files in migrations/, which
+# are applied on top of this both on first start and by lagopus-migrate.
+CREATE TABLE `schema_migrations` (
+    `version` varchar(128) NOT NULL,
+    `applied_time` timestamp DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (`version`)
+  ) ENGINE=InnoDB;
 CREATE TABLE `jobs` (
     `job_id` varchar(128) NOT NULL,
     `status` varchar(64) NOT NULL,
@@ -22,4 +29,17 @@ CREATE TABLE `crashes` (
     `create_time` timestamp,
     PRIMARY KEY (`job_id`, `backtrace_hash`)
   ) ENGINE=InnoDB;
-
+CREATE TABLE `scans` (
+    `job_id` varchar(128) NOT NULL,
+    `results_file` varchar(255) NOT NULL,
+    `results_size` bigint,
+    `results_mtime` datetime(6),  # UTC
+    `results_hash` char(40),      # sha1
+    `status` varchar(16) NOT NULL,  # running, complete, failed
+    `rows_imported` int(11),
+    `scan_start` datetime(6),     # UTC
+    `scan_finish` datetime(6),    # UTC
+    `error` text,
+    PRIMARY KEY (`job_id`, `results_file`),
+    KEY `status_finish` (`status`, `scan_finish`)
+  ) ENGINE=InnoDB;
@@ -0,0 +1,34 @@
+#!/bin/bash
+#
+# afl-fuzz wrapper, used as the fuzzer binary in the afl-multicore config that
+# entrypoint.sh generates. Pins each instance to its own CPU.
+#
+# afl-multicore names instances <session>000, <session>001, ... and passes the
+# name with -M or -S; instance N runs on the Nth CPU in LAGOPUS_CPUS. AFL's own
+# CPU selection is turned off, since it can't tell which CPUs the container is
+# allowed to use.
+
+ARGS=("$@")
+NAME=""
+while [ $# -gt 0 ]; do
+  case "$1" in
+    -M|-S)
+      NAME="$2"
+      shift
+      ;;
+  esac
+  shift
+done
+
+read -ra CPUS <<< "$LAGOPUS_CPUS"
+if [ ${#CPUS[@]} -eq 0 ]; then
+  exec afl-fuzz "${ARGS[@]}"
+fi
+
+INDEX=$(echo "$NAME" | grep -o '[0-9]*$')
+INDEX=$((10#${INDEX:-0}))
+CPU=${CPUS[$((INDEX % ${#CPUS[@]}))]}
+
+printf "Pinning %s to CPU %d\n" "$NAME" "$CPU"
+export AFL_NO_AFFINITY=1
+exec taskset -c "$CPU" afl-fuzz "${ARGS[@]}"
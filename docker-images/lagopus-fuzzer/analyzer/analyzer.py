@@ -5,6 +5,43 @@ import json
 import pprint
 
 from crash_analysis.crash_result import CrashResult
+from crash_analysis.stack_parsing import stack_analyzer
+
+
+def get_frames(cr):
+    """
+    Flatten the parsed stack frames of a crash.
+
+    Frames the analyzer ignores when computing the crash state (sanitizer
+    runtime, libc, etc.) get a depth of None; the rest are numbered from the
+    top of their thread's stack, so that depth 0 is the first interesting
+    frame.
+
+    :param cr: CrashResult
+    :return: list of dicts, one per frame
+    """
+    state = cr.get_symbolized_data()
+    frames = []
+    for thread, stack in enumerate(state.frames):
+        depth = 0
+        for index, frame in enumerate(stack):
+            if frame is None:
+                continue
+            if stack_analyzer.ignore_stack_frame(frame.function_name, state):
+                frame_depth = None
+            else:
+                frame_depth = depth
+                depth += 1
+            frames.append({
+                'thread': thread,
+                'frame': index,
+                'depth': frame_depth,
+                'function': frame.function_name,
+                'file': frame.filename,
+                'line': int(frame.fileline) if str(frame.fileline).isdigit() else None,
+                'module': frame.module_name,
+            })
+    return frames
 
 
 if __name__ == '__main__':
@@ -27,6 +64,7 @@ if __name__ == '__main__':
             'stacktrace': cr.get_stacktrace(),
             'output': cr.output,
             'return_code': cr.return_code,
+            'frames': get_frames(cr),
     }
 
     print(json.dumps(result, indent=4))
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) Quentin Young 2020
+# MIT License
+#
+# Node-local cache of unpacked targets.
+#
+# Every pod used to copy its job's target zip across the shared volume and
+# unzip it, so pods of the same target starting on the same node did the same
+# work over and over. The cache keeps each target unpacked once per node, in a
+# hostPath directory, keyed by the SHA-1 of its zip:
+#
+#   <cache>/targets/<sha1>/       the unpacked zip
+#   <cache>/targets/<sha1>.used   touched whenever a pod uses it
+#
+# A target is unpacked into a staging directory and renamed into place, so a
+# directory in targets/ is always complete, and evicted by renaming it out of
+# the way first. Pods racing to unpack the same target take a lock, so only
+# one of them does the work.
+#
+# `fetch` sets a pod's working directory up from the cache, filling it on a
+# miss. `prune` is run on every node by the lagopus-cache DaemonSet, and keeps
+# the cache under its size limit by evicting the least recently used targets.
+
+import argparse
+import fcntl
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# targets used more recently than this aren't evicted, so that a pod doesn't
+# lose its target halfway through copying it
+MIN_IDLE = 600
+# staging directories older than this were left by pods that died
+STALE_STAGING = 3600
+
+
+def copy_hashed(src, dst):
+    """
+    Copy a file, hashing it on the way.
+
+    :return: SHA-1 hex digest of its contents
+    """
+    digest = hashlib.sha1()
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        for chunk in iter(lambda: fin.read(1024 * 1024), b""):
+            digest.update(chunk)
+            fout.write(chunk)
+    return digest.hexdigest()
+
+
+def fill(targets, digest, zip_path):
+    """
+    Unpack a target into the cache, unless another pod already has.
+
+    :param targets: targets directory of the cache
+    :param digest: SHA-1 of the target zip
+    :param zip_path: the target zip, on the shared volume
+    :return: whether it was already there
+    """
+    entry = os.path.join(targets, digest)
+    with open(entry + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.isdir(entry):
+            return True
+
+        staging = tempfile.mkdtemp(prefix=".{}.".format(digest), dir=targets)
+        try:
+            local_zip = os.path.join(staging, "target.zip")
+            actual = copy_hashed(zip_path, local_zip)
+            if actual != digest:
+                raise ValueError(
+                    "{} has SHA-1 {}, expected {}".format(zip_path, actual, digest)
+                )
+            # unzip, unlike zipfile, keeps the target executable
+            subprocess.run(
+                ["unzip", "-q", local_zip, "-d", os.path.join(staging, "tree")],
+                check=True,
+            )
+            os.rename(os.path.join(staging, "tree"), entry)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+    return False
+
+
+def fetch(cache, digest, zip_path, workdir):
+    """
+    Set a pod's working directory up with its target from the cache.
+
+    :param cache: cache directory
+    :param digest: SHA-1 of the target zip
+    :param zip_path: the target zip, on the shared volume, for a miss
+    :param workdir: working directory to put the target in
+    :return: whether the target was in the cache
+    """
+    targets = os.path.join(cache, "targets")
+    os.makedirs(targets, exist_ok=True)
+    entry = os.path.join(targets, digest)
+    hit = os.path.isdir(entry) or fill(targets, digest, zip_path)
+
+    with open(entry + ".used", "a"):
+        os.utime(entry + ".used")
+    # a copy, not links; the pod is free to change its working directory
+    subprocess.run(["cp", "-a", entry + "/.", workdir], check=True)
+    return hit
+
+
+def tree_size(path):
+    """
+    :return: total size of the files under a directory, in bytes
+    """
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def evict(targets, name):
+    """
+    Remove a target from the cache, so that no pod sees it half removed.
+    """
+    trash = tempfile.mkdtemp(prefix=".evict.", dir=targets)
+    os.rename(os.path.join(targets, name), os.path.join(trash, name))
+    shutil.rmtree(trash, ignore_errors=True)
+    for suffix in [".used", ".lock"]:
+        try:
+            os.unlink(os.path.join(targets, name + suffix))
+        except FileNotFoundError:
+            pass
+
+
+def prune(cache, max_bytes):
+    """
+    Evict the least recently used targets until the cache fits its limit.
+
+    :param cache: cache directory
+    :param max_bytes: most bytes of unpacked targets to keep
+    :return: tuple of (targets evicted, bytes in the cache afterwards)
+    """
+    targets = os.path.join(cache, "targets")
+    try:
+        names = os.listdir(targets)
+    except FileNotFoundError:
+        return 0, 0
+
+    now = time.time()
+    entries = []
+    for name in names:
+        path = os.path.join(targets, name)
+        if name.startswith("."):
+            # left behind by a pod that died while unpacking or evicting
+            if now - os.lstat(path).st_mtime > STALE_STAGING:
+                shutil.rmtree(path, ignore_errors=True)
+            continue
+        if not os.path.isdir(path):
+            # locks of targets that failed to unpack
+            base = os.path.splitext(path)[0]
+            stale = now - os.lstat(path).st_mtime > STALE_STAGING
+            if stale and not os.path.isdir(base):
+                os.unlink(path)
+            continue
+        try:
+            used = os.stat(path + ".used").st_mtime
+        except FileNotFoundError:
+            used = os.stat(path).st_mtime
+        entries.append((used, name, tree_size(path)))
+
+    total = sum(size for _, _, size in entries)
+    evicted = 0
+    for used, name, size in sorted(entries):
+        if total <= max_bytes or now - used < MIN_IDLE:
+            break
+        evict(targets, name)
+        total -= size
+        evicted += 1
+    return evicted, total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Node-local cache of unpacked targets")
+    subparsers = parser.add_subparsers(dest="command")
+    parser_fetch = subparsers.add_parser(
+        "fetch",
+        help="Set a working directory up with a target from the cache, filling "
+        "the cache on a miss; prints hit or miss",
+    )
+    parser_fetch.add_argument("cache", help="Cache directory")
+    parser_fetch.add_argument("hash", help="SHA-1 of the target zip")
+    parser_fetch.add_argument("zip", help="Target zip on the shared volume")
+    parser_fetch.add_argument("workdir", help="Working directory")
+    parser_prune = subparsers.add_parser(
+        "prune", help="Evict the least recently used targets from the cache"
+    )
+    parser_prune.add_argument("cache", help="Cache directory")
+    parser_prune.add_argument(
+        "--max-gb", type=int, default=20, help="Most GB of targets to keep"
+    )
+    parser_prune.add_argument(
+        "--interval",
+        type=int,
+        default=0,
+        help="Seconds between passes; if 0, prune once and exit",
+    )
+    args = parser.parse_args()
+
+    if args.command == "fetch":
+        hit = fetch(args.cache, args.hash, args.zip, args.workdir)
+        print("hit" if hit else "miss")
+    elif args.command == "prune":
+        while True:
+            evicted, total = prune(args.cache, args.max_gb * 1024 ** 3)
+            print("Evicted {} targets; cache holds {} bytes".format(evicted, total))
+            sys.stdout.flush()
+            if not args.interval:
+                break
+            time.sleep(args.interval)
+    else:
+        parser.print_help()
+        sys.exit(1)
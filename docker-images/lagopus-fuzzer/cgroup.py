@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) Quentin Young 2020
+# MIT License
+#
+# Resource usage of the pod, from its cgroup.
+#
+# free and mpstat report on the whole node, not on the container, so the
+# memory the monitors used to report had nothing to do with the job and an
+# OOM kill coming was invisible. The container's cgroup knows what it has
+# actually used: CPU time, how often it was throttled for running over its CPU
+# limit, and its memory use, peak and limit. Both cgroup v2 and v1 are read;
+# anything neither has is left out.
+#
+#   python3 /cgroup.py influx              InfluxDB fields, for the monitors
+#   python3 /cgroup.py usage --interval 2  one line summary, for the fuzz loop
+
+import argparse
+import os
+import sys
+import time
+
+CGROUP = "/sys/fs/cgroup"
+
+# cgroup v1 controllers are mounted separately, or together, depending on the
+# node
+V1_CPU = ["cpu", "cpu,cpuacct", "cpuacct"]
+V1_MEMORY = ["memory"]
+
+# cgroup v1 reports no memory limit as a huge number
+V1_NO_LIMIT = 1 << 60
+
+MIB = 1024 * 1024
+
+
+def read_int(path):
+    """
+    :return: the integer a file starts with, or None if it can't be read
+    """
+    try:
+        with open(path) as f:
+            return int(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def read_keyed(path):
+    """
+    :return: dict of the "<key> <value>" lines of a file, empty if it can't
+             be read
+    """
+    values = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                key, _, value = line.partition(" ")
+                try:
+                    values[key] = int(value)
+                except ValueError:
+                    pass
+    except OSError:
+        pass
+    return values
+
+
+def v1_path(controllers, name):
+    """
+    :return: path of a cgroup v1 file under the first controller that has it,
+             or None
+    """
+    for controller in controllers:
+        path = os.path.join(CGROUP, controller, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def is_v2():
+    return os.path.exists(os.path.join(CGROUP, "cgroup.controllers"))
+
+
+def cpu_stat():
+    """
+    :return: dict of usage (CPU seconds used), periods (CFS periods elapsed),
+             throttled (periods in which the cgroup was throttled) and
+             throttled_time (seconds it spent throttled); None where unknown
+    """
+    if is_v2():
+        stat = read_keyed(os.path.join(CGROUP, "cpu.stat"))
+        usage = stat.get("usage_usec")
+        throttled_time = stat.get("throttled_usec")
+        return {
+            "usage": usage / 1e6 if usage is not None else None,
+            "periods": stat.get("nr_periods"),
+            "throttled": stat.get("nr_throttled"),
+            "throttled_time": throttled_time / 1e6
+            if throttled_time is not None
+            else None,
+        }
+
+    usage = read_int(v1_path(V1_CPU, "cpuacct.usage") or "")
+    stat = read_keyed(v1_path(V1_CPU, "cpu.stat") or "")
+    throttled_time = stat.get("throttled_time")
+    return {
+        "usage": usage / 1e9 if usage is not None else None,
+        "periods": stat.get("nr_periods"),
+        "throttled": stat.get("nr_throttled"),
+        "throttled_time": throttled_time / 1e9 if throttled_time is not None else None,
+    }
+
+
+def cpu_limit():
+    """
+    :return: number of CPUs' worth of time the cgroup may use, or None if it
+             isn't limited
+    """
+    if is_v2():
+        try:
+            with open(os.path.join(CGROUP, "cpu.max")) as f:
+                quota, period = f.read().split()
+            return int(quota) / int(period)
+        except (OSError, ValueError):
+            return None
+
+    quota = read_int(v1_path(V1_CPU, "cpu.cfs_quota_us") or "")
+    period = read_int(v1_path(V1_CPU, "cpu.cfs_period_us") or "")
+    if not quota or quota < 0 or not period:
+        return None
+    return quota / period
+
+
+def memory_stat():
+    """
+    :return: dict of current (bytes in use), peak (most bytes ever in use),
+             limit (bytes the cgroup may use) and oom_kills (processes killed
+             for running out of it); None where unknown
+    """
+    if is_v2():
+        limit = read_int(os.path.join(CGROUP, "memory.max"))
+        return {
+            "current": read_int(os.path.join(CGROUP, "memory.current")),
+            # only on kernels from 5.19 on
+            "peak": read_int(os.path.join(CGROUP, "memory.peak")),
+            "limit": limit,
+            "oom_kills": read_keyed(os.path.join(CGROUP, "memory.events")).get(
+                "oom_kill"
+            ),
+        }
+
+    limit = read_int(v1_path(V1_MEMORY, "memory.limit_in_bytes") or "")
+    return {
+        "current": read_int(v1_path(V1_MEMORY, "memory.usage_in_bytes") or ""),
+        "peak": read_int(v1_path(V1_MEMORY, "memory.max_usage_in_bytes") or ""),
+        "limit": limit if limit is not None and limit < V1_NO_LIMIT else None,
+        "oom_kills": read_keyed(v1_path(V1_MEMORY, "memory.oom_control") or "").get(
+            "oom_kill"
+        ),
+    }
+
+
+def influx_fields():
+    """
+    :return: dict of the fields the monitors report to InfluxDB; memory is in
+             MiB
+    """
+    cpu = cpu_stat()
+    memory = memory_stat()
+    fields = {
+        "cpu_hours": cpu["usage"] / 3600 if cpu["usage"] is not None else None,
+        "cpu_periods": cpu["periods"],
+        "cpu_throttled": cpu["throttled"],
+        "cpu_throttled_seconds": cpu["throttled_time"],
+        "oom_kills": memory["oom_kills"],
+    }
+    for key in ["current", "peak", "limit"]:
+        name = "memory" if key == "current" else "memory_" + key
+        fields[name] = memory[key] / MIB if memory[key] is not None else None
+    return {k: v for k, v in fields.items() if v is not None}
+
+
+def usage(interval):
+    """
+    Sample the cgroup's CPU use over an interval.
+
+    :param interval: seconds to sample for
+    :return: one line summary of the cgroup's CPU and memory use
+    """
+    before = cpu_stat()
+    time.sleep(interval)
+    after = cpu_stat()
+    memory = memory_stat()
+
+    summary = []
+    if before["usage"] is not None and after["usage"] is not None:
+        cores = (after["usage"] - before["usage"]) / interval
+        limit = cpu_limit()
+        summary.append(
+            "cpu: {:.2f} cores{}".format(
+                cores, " of {:g}".format(limit) if limit else ""
+            )
+        )
+    if before["periods"] is not None and after["periods"] is not None:
+        periods = after["periods"] - before["periods"]
+        throttled = after["throttled"] - before["throttled"]
+        summary.append(
+            "throttled: {:.0f}%".format(100 * throttled / periods if periods else 0)
+        )
+    if memory["current"] is not None:
+        summary.append(
+            "mem: {:.0f}Mi{}".format(
+                memory["current"] / MIB,
+                " of {:.0f}Mi".format(memory["limit"] / MIB)
+                if memory["limit"]
+                else "",
+            )
+        )
+    if memory["oom_kills"]:
+        summary.append("oom kills: {}".format(memory["oom_kills"]))
+    return ", ".join(summary) or "no cgroup stats"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resource usage of the pod")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser(
+        "influx", help="Print usage as InfluxDB line protocol fields"
+    )
+    parser_usage = subparsers.add_parser(
+        "usage", help="Print a summary of usage over an interval"
+    )
+    parser_usage.add_argument(
+        "--interval", type=float, default=2, help="Seconds to sample CPU use for"
+    )
+    args = parser.parse_args()
+
+    if args.command == "influx":
+        print(",".join("{}={}".format(k, v) for k, v in influx_fields().items()))
+    elif args.command == "usage":
+        print(usage(args.interval))
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) Quentin Young 2020
+# MIT License
+#
+# Incremental corpus minimization.
+#
+# The seed corpus a job starts from is usually the minimized corpus of an
+# earlier job, so most of what a job ends up with is already minimal. Rather
+# than minimizing everything again from scratch, this treats the seed corpus as
+# minimal and only evaluates inputs it doesn't have, keeping those that reach
+# coverage the corpus so far doesn't.
+#
+# The coverage of each input is recorded in a signature file alongside the
+# corpus, so the next job minimizing against it doesn't have to run the seed
+# corpus again:
+#
+#   {"target": "<sha1 of target binary>"}
+#   {"input": "<sha1 of input>", "features": [...]}
+#   ...
+#
+# Features are edge tuples and hit count buckets from afl-showmap for AFL, and
+# the features libFuzzer reports in its merge control file for libFuzzer.
+# They're only meaningful for the binary they came from, so signatures
+# recorded for a different target are ignored.
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from multiprocessing import Pool
+
+# seconds afl-showmap may run the target on one input
+SHOWMAP_TIMEOUT = 10
+
+
+def file_hash(path):
+    """
+    :return: SHA-1 hex digest of a file's contents
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_signatures(path, target):
+    """
+    :param path: signature file
+    :param target: SHA-1 of the target binary
+    :return: dict mapping input SHA-1 to its features; empty if there's no
+             signature file or it was recorded for another target
+    """
+    signatures = {}
+    try:
+        with gzip.open(path, "rt") as f:
+            header = json.loads(f.readline() or "{}")
+            if header.get("target") != target:
+                print("Signatures in {} are for another target".format(path))
+                return signatures
+            for line in f:
+                entry = json.loads(line)
+                signatures[entry["input"]] = entry["features"]
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError) as e:
+        print("Ignoring unreadable signatures {}: {}".format(path, e))
+        signatures = {}
+    return signatures
+
+
+def save_signatures(path, target, signatures):
+    """
+    :param path: signature file
+    :param target: SHA-1 of the target binary
+    :param signatures: dict mapping input SHA-1 to its features
+    """
+    with gzip.open(path, "wt") as f:
+        f.write(json.dumps({"target": target}) + "\n")
+        for digest in sorted(signatures):
+            f.write(
+                json.dumps({"input": digest, "features": signatures[digest]}) + "\n"
+            )
+
+
+def list_inputs(directory, driver):
+    """
+    :param directory: AFL sync dir, or libFuzzer corpus dir
+    :param driver: fuzzing driver, one of [afl, libFuzzer]
+    :return: paths of the inputs in it
+    """
+    if driver == "libFuzzer":
+        with os.scandir(directory) as entries:
+            return [e.path for e in entries if e.is_file()]
+
+    inputs = []
+    with os.scandir(directory) as instances:
+        for instance in instances:
+            queue = os.path.join(instance.path, "queue")
+            if not os.path.isdir(queue):
+                continue
+            with os.scandir(queue) as entries:
+                inputs += [
+                    e.path for e in entries if e.name.startswith("id:") and e.is_file()
+                ]
+    return inputs
+
+
+def unique_inputs(paths, exclude=()):
+    """
+    :param paths: input files
+    :param exclude: SHA-1s of inputs to leave out
+    :return: dict mapping SHA-1 to the path of one input with those contents
+    """
+    inputs = {}
+    for path in paths:
+        digest = file_hash(path)
+        if digest not in exclude:
+            inputs.setdefault(digest, path)
+    return inputs
+
+
+def showmap(job):
+    """
+    Run the target on one input under afl-showmap.
+
+    :param job: tuple of (target, input path)
+    :return: sorted list of tuple << 8 | hit bucket, or None if the input
+             crashed or hung the target
+    """
+    target, path = job
+    with tempfile.NamedTemporaryFile(prefix="showmap") as out, open(path, "rb") as f:
+        proc = subprocess.run(
+            [
+                "afl-showmap",
+                "-q",
+                "-m",
+                "none",
+                "-t",
+                str(SHOWMAP_TIMEOUT * 1000),
+                "-o",
+                out.name,
+                "--",
+                target,
+            ],
+            stdin=f,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        if proc.returncode != 0:
+            return None
+        features = []
+        for line in out:
+            edge, bucket = line.split(b":")
+            features.append(int(edge) << 8 | int(bucket))
+    return sorted(features)
+
+
+def minimize_afl(target, seeds, candidates, signatures, jobs):
+    """
+    Pick the candidates that add coverage to the seed corpus.
+
+    Candidates are tried smallest first, as afl-cmin prefers small inputs.
+
+    :param target: target binary
+    :param seeds: dict of SHA-1 to path of the seed corpus
+    :param candidates: dict of SHA-1 to path of inputs to evaluate
+    :param signatures: features already known, by SHA-1; updated in place
+    :param jobs: number of afl-showmap processes to run at once
+    :return: SHA-1s of the candidates to keep
+    """
+    unknown = sorted(d for d in seeds if d not in signatures)
+    print(
+        "{} of {} seed inputs have signatures".format(
+            len(seeds) - len(unknown), len(seeds)
+        )
+    )
+    ordered = sorted(candidates, key=lambda d: (os.path.getsize(candidates[d]), d))
+    work = [(target, seeds[d]) for d in unknown]
+    work += [(target, candidates[d]) for d in ordered]
+
+    with Pool(jobs) as pool:
+        results = pool.map(showmap, work, chunksize=16)
+
+    for digest, features in zip(unknown + ordered, results):
+        if features is not None:
+            signatures[digest] = features
+
+    covered = set()
+    for digest in seeds:
+        covered.update(signatures.get(digest, ()))
+
+    keep = []
+    for digest in ordered:
+        features = signatures.get(digest)
+        if features is None or covered.issuperset(features):
+            continue
+        covered.update(features)
+        keep.append(digest)
+    return keep
+
+
+def minimize_libfuzzer(target, seeds, candidates, signatures):
+    """
+    Pick the candidates that add coverage to the seed corpus.
+
+    libFuzzer's merge records the features of every input it runs in a control
+    file, and resumes from one that's been partly processed. Writing out the
+    seed corpus as already processed, with the features it was recorded with,
+    means only the candidates are run.
+
+    :param target: target binary
+    :param seeds: dict of SHA-1 to path of the seed corpus
+    :param candidates: dict of SHA-1 to path of inputs to evaluate
+    :param signatures: features already known, by SHA-1; updated in place
+    :return: SHA-1s of the candidates to keep
+    """
+    # seeds without signatures are run as well, but first, so that they're
+    # still part of the initial corpus
+    known = sorted(d for d in seeds if d in signatures)
+    unknown = sorted(d for d in seeds if d not in signatures)
+    ordered = sorted(candidates)
+    digests = known + unknown + ordered
+    print("{} of {} seed inputs have signatures".format(len(known), len(seeds)))
+
+    # merge adds what it keeps to the first directory, under the SHA-1 of its
+    # contents, and never removes anything from it
+    workdir = tempfile.mkdtemp(prefix="cmin")
+    try:
+        initial = os.path.join(workdir, "seed")
+        new = os.path.join(workdir, "new")
+        os.mkdir(initial)
+        os.mkdir(new)
+        files = []
+        for digest in digests:
+            if digest in seeds:
+                directory, src = initial, seeds[digest]
+            else:
+                directory, src = new, candidates[digest]
+            files.append(os.path.join(directory, digest))
+            os.symlink(os.path.abspath(src), files[-1])
+
+        control = os.path.join(workdir, "merge.ctl")
+        with open(control, "w") as ctl:
+            ctl.write("{}\n{}\n".format(len(files), len(seeds)))
+            for path in files:
+                ctl.write(path + "\n")
+            for i, digest in enumerate(known):
+                ctl.write("STARTED {} {}\n".format(i, os.path.getsize(seeds[digest])))
+                ctl.write(
+                    "FT {} {}\n".format(i, " ".join(map(str, signatures[digest])))
+                )
+                ctl.write("COV {}\n".format(i))
+
+        subprocess.run(
+            [
+                target,
+                "-merge=1",
+                "-rss_limit_mb=0",
+                "-merge_control_file={}".format(control),
+                initial,
+                new,
+            ],
+            check=True,
+        )
+
+        index = {path: digest for path, digest in zip(files, digests)}
+        with open(control) as ctl:
+            lines = ctl.read().splitlines()
+        # the file list is rewritten if libFuzzer didn't like ours
+        listed = lines[2 : 2 + int(lines[0])]
+        for line in lines[2 + len(listed) :]:
+            fields = line.split()
+            if fields and fields[0] == "FT":
+                digest = index.get(listed[int(fields[1])])
+                if digest:
+                    signatures[digest] = [int(f) for f in fields[2:]]
+
+        kept = set(os.listdir(initial))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return [d for d in ordered if d in kept]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Minimize new inputs against an already minimal seed corpus"
+    )
+    parser.add_argument("--driver", choices=["afl", "libFuzzer"], required=True)
+    parser.add_argument("--target", required=True, help="Target binary")
+    parser.add_argument("--seed", required=True, help="Seed corpus directory")
+    parser.add_argument(
+        "--signatures",
+        action="append",
+        default=[],
+        help="Signature file recorded for the seed corpus; may be given more than once",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="Number of processes to run"
+    )
+    parser.add_argument(
+        "-o", "--output", required=True, help="Directory to write the corpus to"
+    )
+    parser.add_argument(
+        "--save", required=True, help="Signature file to write for the corpus"
+    )
+    parser.add_argument(
+        "inputs", nargs="+", help="AFL sync dirs or libFuzzer corpus dirs to minimize"
+    )
+    args = parser.parse_args()
+
+    target = file_hash(args.target)
+    signatures = {}
+    for path in args.signatures:
+        signatures.update(load_signatures(path, target))
+
+    seeds = unique_inputs(
+        os.path.join(args.seed, name) for name in os.listdir(args.seed)
+    )
+    paths = []
+    for directory in args.inputs:
+        paths += list_inputs(directory, args.driver)
+    candidates = unique_inputs(paths, exclude=seeds)
+    print(
+        "Minimizing {} new inputs against {} seed inputs".format(
+            len(candidates), len(seeds)
+        )
+    )
+
+    target_path = os.path.abspath(args.target)
+    if args.driver == "afl":
+        keep = minimize_afl(target_path, seeds, candidates, signatures, args.jobs)
+    else:
+        keep = minimize_libfuzzer(target_path, seeds, candidates, signatures)
+
+    # inputs are named by their contents, same as in the sync directory
+    os.makedirs(args.output, exist_ok=True)
+    corpus = dict(seeds)
+    corpus.update((d, candidates[d]) for d in keep)
+    for digest, path in corpus.items():
+        shutil.copyfile(path, os.path.join(args.output, digest))
+
+    save_signatures(
+        args.save, target, {d: signatures[d] for d in corpus if d in signatures}
+    )
+    print(
+        "Kept {} of {} new inputs; corpus has {} inputs".format(
+            len(keep), len(candidates), len(corpus)
+        )
+    )
+    sys.stdout.flush()
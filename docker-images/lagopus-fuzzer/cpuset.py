@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) Quentin Young 2020
+# MIT License
+#
+# Print the CPUs this container is allowed to run on, one per line.
+#
+# Containers see every CPU on the host in /proc/cpuinfo and sysfs, but with the
+# static CPU manager policy k8s only lets them run on the cores it assigned
+# them, by way of the cpuset cgroup. Read the effective cpuset from whichever
+# cgroup version is mounted, falling back to the scheduler affinity mask.
+
+import os
+import sys
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+
+def parse_cpulist(cpulist):
+    """
+    :param cpulist: kernel CPU list, e.g. "0-3,8,10-11"
+    :return: list of CPU numbers
+    """
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def cgroup_paths():
+    """
+    :return: dict of this process's cgroup path keyed by controller; the
+             cgroup v2 path is keyed by ""
+    """
+    paths = {}
+    with open("/proc/self/cgroup") as cgroup:
+        for line in cgroup:
+            _, controllers, path = line.rstrip("\n").split(":", 2)
+            for controller in controllers.split(","):
+                paths[controller] = path
+    return paths
+
+
+def read_first(candidates):
+    for candidate in candidates:
+        try:
+            with open(candidate) as f:
+                contents = f.read().strip()
+        except OSError:
+            continue
+        if contents:
+            return contents
+    return None
+
+
+def cgroup_cpus():
+    """
+    :return: CPUs in the effective cpuset of this process's cgroup, or None if
+             it can't be read
+    """
+    try:
+        paths = cgroup_paths()
+    except OSError:
+        return None
+
+    candidates = []
+    if "cpuset" in paths:
+        # cgroup v1; the container's own cgroup is usually mounted at the
+        # controller root, but try the full path in case it isn't
+        base = os.path.join(CGROUP_ROOT, "cpuset")
+        for d in [base + paths["cpuset"], base]:
+            candidates += [
+                os.path.join(d, "cpuset.effective_cpus"),
+                os.path.join(d, "cpuset.cpus"),
+            ]
+    if "" in paths:
+        # cgroup v2, possibly mounted at /sys/fs/cgroup/unified in hybrid mode
+        for base in [CGROUP_ROOT, os.path.join(CGROUP_ROOT, "unified")]:
+            for d in [base + paths[""], base]:
+                candidates.append(os.path.join(d, "cpuset.cpus.effective"))
+
+    cpulist = read_first(candidates)
+    return parse_cpulist(cpulist) if cpulist else None
+
+
+def allowed_cpus():
+    """
+    :return: sorted list of CPUs this process may run on
+    """
+    affinity = os.sched_getaffinity(0)
+    cpus = cgroup_cpus()
+    if cpus:
+        cpus = [c for c in cpus if c in affinity] or sorted(affinity)
+    else:
+        cpus = sorted(affinity)
+    return sorted(cpus)
+
+
+if __name__ == "__main__":
+    cpus = allowed_cpus()
+
+    # the scheduler asks for the job's cores to come from this NUMA node; say
+    # so if the kubelet didn't oblige
+    numa_node = os.environ.get("NUMA_NODE")
+    if numa_node:
+        cpulist = read_first(
+            ["/sys/devices/system/node/node{}/cpulist".format(numa_node)]
+        )
+        if cpulist and not set(cpus) <= set(parse_cpulist(cpulist)):
+            print(
+                "CPUs {} are not all on NUMA node {}".format(cpus, numa_node),
+                file=sys.stderr,
+            )
+
+    print("\n".join(str(c) for c in cpus))
@@ -0,0 +1,194 @@
+#!/bin/bash
+#
+# Fuzz phase. Sourced by entrypoint.sh once the target is set up in the working
+# directory.
+#
+# Fuzzes until the deadline, streaming what the fuzzers produce to
+# $JOBDATA/stream/pod-<pod> as it appears, then tells the server this pod is
+# done. The minimize phase picks the pod's output up from there.
+#
+# If k8s kills the pod first, it streams what's left and fails, so the job runs
+# it again; entrypoint.sh then restores what it streamed, and the fuzzers
+# resume from it rather than starting over (RESUMED=1).
+
+span_begin start
+
+# CPUs this container may run on. With the static CPU manager policy these are
+# exactly the cores k8s assigned the job; run one fuzzer instance per CPU, each
+# pinned to its own.
+CPUS=($(python3 /cpuset.py))
+if [ ${#CPUS[@]} -lt "$CORES" ]; then
+  printf "Only %d CPUs available; running %d instances instead of %d\n" ${#CPUS[@]} ${#CPUS[@]} "$CORES"
+  CORES=${#CPUS[@]}
+fi
+CPUS=("${CPUS[@]:0:$CORES}")
+export LAGOPUS_CPUS="${CPUS[*]}"
+printf "Pinning fuzzer instances to CPUs: %s\n" "$LAGOPUS_CPUS"
+
+# stream new crashes, corpus inputs and stats to the job directory, so nothing
+# is lost if the pod is killed before it's done. Started before the fuzzers so
+# it can tell the seed corpus from what they find.
+python3 /stream.py --driver "$DRIVER" --pod "$POD_INDEX" "$JOBDATA/stream" . &> stream.log &
+STREAM_PID=$!
+
+if [ "$DRIVER" == "afl" ]; then
+  # Check appropriate system parameters
+  # swapoff -a
+  # aka sysctl -w kernel.core_pattern=core
+  # but we may not have `sysctl` for some reason
+  # echo core >/proc/sys/kernel/core_pattern
+  # this path doesn't seem to exist in virtualized devices (kvm, docker)
+  # bash -c 'cd /sys/devices/system/cpu; echo performance | tee cpu*/cpufreq/scaling_governor'
+  # one master and CORES-1 secondaries, each pinned to its own CPU by
+  # afl-pin.sh. In distributed jobs only the first pod runs a master, so the
+  # deterministic stages aren't repeated on every pod, and instance names get
+  # the pod index so crashes from different pods don't collide.
+  AFLMCC_PINNED="./target.pinned.conf"
+  if [ "$PODS" -gt 1 ]; then
+    MASTERS=$((POD_INDEX == 0 ? 1 : 0))
+    jq --argjson masters $MASTERS --arg pod "$POD_INDEX" \
+      '.fuzzer = "/afl-pin.sh" | .master_instances = $masters | .session = .session + "_p" + $pod + "_"' \
+      $AFLMCC > $AFLMCC_PINNED
+  else
+    jq '.fuzzer = "/afl-pin.sh" | .master_instances = 1' $AFLMCC > $AFLMCC_PINNED
+  fi
+  # instances resume from the queues restored from the checkpoint
+  if [ "$RESUMED" == "1" ] && [ -n "$(ls -A $RESULT)" ]; then
+    AFLMCC_CMD=resume
+  else
+    AFLMCC_CMD=start
+  fi
+  afl-multicore -s 1 -v -c $AFLMCC_PINNED $AFLMCC_CMD $CORES
+  COUNTFUZZER_CMD="pgrep -c afl-fuzz"
+elif [ "$DRIVER" == "libFuzzer" ]; then
+  # one worker per CPU, like -jobs=$CORES -workers=$CORES but with each worker
+  # pinned; workers pick up each other's finds by reloading the corpus, and log
+  # to fuzz-N.log as they would under -jobs
+  for i in "${!CPUS[@]}"; do
+    taskset -c "${CPUS[$i]}" ./target -max_total_time=$FUZZER_TIMEOUT -rss_limit_mb=0 $CORPUS &> fuzz-$i.log &
+    echo $! > fuzz-$i.pid
+  done
+  COUNTFUZZER_CMD="pgrep -fc rss_limit_mb"
+else
+  printf "Fuzzing driver '%s' unsupported; exiting\n" "$DRIVER"
+  exit 1
+fi
+
+# share new corpus entries with the job's other pods
+if [ "$PODS" -gt 1 ]; then
+  if [ "$DRIVER" == "afl" ]; then
+    SYNC_LOCAL=$RESULT
+  else
+    SYNC_LOCAL=$CORPUS
+  fi
+  python3 /sync.py --driver "$DRIVER" --pod "$POD_INDEX" "$SYNC_LOCAL" "$JOBDATA/sync" &> sync.log &
+  SYNC_PID=$!
+fi
+
+# analyze crashes as they're found and push them to the server, at idle
+# priority so it only gets CPU time the fuzzers leave
+if [ "$LAGOPUS_SERVER" != "" ]; then
+  TRIAGE_CMD=(python3 /triage.py --driver "$DRIVER" --target $TARGET --server "$LAGOPUS_SERVER" --job "$JOB_ID" .)
+  if chrt -i 0 true 2>/dev/null; then
+    chrt -i 0 "${TRIAGE_CMD[@]}" &> triage.log &
+  else
+    nice -n 19 "${TRIAGE_CMD[@]}" &> triage.log &
+  fi
+  TRIAGE_PID=$!
+fi
+
+# health check indicator
+touch started
+span_end
+
+span_begin fuzz
+
+# Loop on pushing out stats
+FUZZERS_ALIVE=1
+ELAPSED_TIME=$(($(date -u +%s) - STARTTIME))
+
+# the server stops jobs early by writing $JOBDATA/stop, e.g. once their coverage
+# has plateaued; pods then finish as they would at the deadline
+while [ "$FUZZERS_ALIVE" -ne "0" ] && [ ! -f /shouldexit ] && [ ! -f "$JOBDATA/stop" ] && [ ! $ELAPSED_TIME -gt $FUZZER_TIMEOUT ]; do
+	FUZZERS_ALIVE=$(eval "$COUNTFUZZER_CMD")
+	ELAPSED_TIME=$(($(date -u +%s) - STARTTIME))
+	# the container's own usage, sampled over 2 seconds
+	USAGE=$(python3 /cgroup.py usage --interval 2)
+	printf "%d fuzzers alive, %s\n" "$FUZZERS_ALIVE" "$USAGE"
+
+	if [ ! -z "$INFLUXDB" ]; then
+          if [ "$DRIVER" == "afl" ]; then
+	    bash /monitor-afl.sh -i "$INFLUXDB_HOST" -p $INFLUXDB_PORT -d "$INFLUXDB_DB" -m "$INFLUXDB_MEASUREMENT" $RESULT
+          elif [ "$DRIVER" == "libFuzzer" ]; then
+	    bash /monitor-libfuzzer.sh -i "$INFLUXDB_HOST" -p $INFLUXDB_PORT -d "$INFLUXDB_DB" -m "$INFLUXDB_MEASUREMENT"
+	  fi
+	fi
+	sleep 1
+done
+
+if [ "$FUZZERS_ALIVE" == "0" ]; then
+  printf "No fuzzers alive, exiting.\n"
+  STOP_REASON="no fuzzers alive"
+fi
+
+if [ $ELAPSED_TIME -gt $FUZZER_TIMEOUT ]; then
+  printf "Elapsed time %d greater than specified timeout %d\n" "$ELAPSED_TIME" "$FUZZER_TIMEOUT"
+  STOP_REASON="deadline"
+fi
+
+if [ "$FUZZERS_ALIVE" == "0" ]; then
+  printf "No fuzzers alive, exiting.\n"
+fi
+
+if [ -f /shouldexit ]; then
+  printf "Graceful exit requested, exiting.\n"
+  STOP_REASON="killed"
+fi
+
+if [ -f "$JOBDATA/stop" ]; then
+  printf "Job stopped by the server: %s\n" "$(cat "$JOBDATA/stop")"
+  STOP_REASON="stopped early"
+fi
+span_end "$STOP_REASON"
+
+span_begin stop
+
+if [ -n "$SYNC_PID" ]; then
+  kill "$SYNC_PID"
+fi
+
+if [ -n "$TRIAGE_PID" ]; then
+  kill -TERM "$TRIAGE_PID"
+  wait "$TRIAGE_PID"
+fi
+
+if [ "$DRIVER" == "afl" ]; then
+	afl-multikill -S $(jq -r .session $AFLMCC_PINNED)
+elif [ "$DRIVE" == "libFuzzer" ]; then
+	# FIXME: This doesn't work when the binary has custom handlers for
+	# SIGUSR1, and while good fuzzing targets should already have taken
+	# care of this, we should still detect when they don't die and
+	# forcefully kill them
+	kill -SIGUSR1 "$TARGET"
+fi
+
+# stream whatever's left and mark this pod done; the server counts the pods
+# that are to tell when the minimize phase can start. When the pod is being
+# killed it's only checkpointed.
+kill -TERM "$STREAM_PID"
+wait "$STREAM_PID"
+span_end
+
+# fail, so that k8s runs the pod again and it resumes
+if [ -f /shouldexit ]; then
+  printf "Checkpointed; exiting to be resumed\n"
+  exit 1
+fi
+
+# tell the server so the minimize phase is queued right away
+if [ "$LAGOPUS_SERVER" != "" ]; then
+  curl -fsS -X POST -H "Content-Type: application/json" -d '{"phase": "fuzz"}' \
+    "http://$LAGOPUS_SERVER/api/jobs/$JOB_ID/phase" || printf "Failed to notify server of phase completion\n"
+fi
+
+exit 0
@@ -0,0 +1,175 @@
+#!/bin/bash
+#
+# Minimize phase. Sourced by entrypoint.sh once the target is set up in the
+# working directory.
+#
+# Assembles the output every pod of the fuzz phase streamed, analyzes crashes,
+# minimizes the corpus, and uploads jobresults.zip for the scanner and the
+# corpus, packed into a segment, for the corpus store.
+
+# the seed corpus, before the libFuzzer corpus from the fuzz phase lands on top
+# of it; the corpus is minimized against this
+span_begin assemble
+SEED="./seed"
+cp -r $CORPUS $SEED
+
+# put the output of every pod back together from what they streamed
+python3 /stream.py --assemble "$JOBDATA/stream" .
+span_end
+
+span_begin collect
+
+# collect results based on the driver
+mkdir jobresults
+mkdir jobresults/crashes    # for bug-triggering corpus inputs
+mkdir jobresults/misc       # for miscellaneous job foo
+
+# Collect and analyze crashes
+sqlite3 ./jobresults/crashes/crashes.db "create table analysis (sample TEXT PRIMARY KEY, type TEXT, is_crash INTEGER, is_security_issue INTEGER, should_ignore INTEGER, backtrace TEXT, output TEXT, return_code INTEGER);"
+# parsed stack frames of each sample's backtrace, for searching crashes by
+# function and file
+sqlite3 ./jobresults/crashes/crashes.db "create table frames (sample TEXT, thread INTEGER, frame INTEGER, depth INTEGER, function TEXT, file TEXT, line INTEGER, module TEXT, PRIMARY KEY (sample, thread, frame));"
+
+if [ "$DRIVER" == "afl" ]; then
+  # in the afl case, afl uses /jobdata/results as its sync dir
+
+  # afl-collect will do some deduplication for us; it also has the ability to
+  # do crash analysis via gdb exploitable, but in practice this doesn't work
+  # very well - especially on *SAN binaries, which it sees as exiting cleanly
+  # because stack dumping is performed by *SAN itself - so it's turned off in
+  # favor of CF's implementation
+  afl-collect -j $CORES $RESULT ./jobresults/crashes/ -- $TARGET
+elif [ "$DRIVER" == "libFuzzer" ]; then
+  # in the libFuzzer case, corpus data is written to /jobdata/results
+
+  # presently libFuzzer kills itself when it finds a bug, and just writes a
+  # normal corpus file but prefixed with the type of bug it found, into the
+  # current directory
+  cp -r ./crash* jobresults/crashes/
+  cp -r ./leak* jobresults/crashes/
+  cp -r ./*slow* jobresults/crashes/
+
+  # logs - need to be copied before minimize, otherwise lf will overwrite them
+  cp fuzz*.log jobresults/misc/
+
+  # Coverage data
+  cp ./*.gcda jobresults/misc/
+  cp ./*.profraw jobresults/misc/
+fi
+
+cp sync-*.log jobresults/misc/ 2>/dev/null
+span_end
+
+span_begin triage
+
+for file in ./jobresults/crashes/*; do
+  fname=$(basename "$file")
+  if [ "$(basename "$file")" == "gdb_script" ] || [ "$(basename "$file")" == "crashes.db" ]; then continue; fi
+
+  # run test case and collect output
+  if [ "$DRIVER" == "afl" ]; then
+    # FIXME: need to parse & use the actual execution line from target.conf
+    $TARGET < "$file" &> output.txt
+    EC=$?
+  elif [ "$DRIVER" == "libFuzzer" ]; then
+    # FIXME: need to use the same invocation format as the fuzz run
+    $TARGET "$file" &> output.txt
+    EC=$?
+
+    if [ $EC -eq 0 ]; then
+      printf "Crash on input %s does not reproduce; pulling trace from logs\n", "$fname"
+      # Find log file corresponding to this crash
+      for LF_LOG in ./jobresults/misc/fuzz-*.log; do
+        ARTIFACT=$(basename "$(grep "Test unit written to" "$LF_LOG" | awk -F' ' '{print $NF}')")
+	if [ "$ARTIFACT" = "$fname" ]; then
+	  # FIXME: really should be parsing the whole line here; if a stack
+	  # trace is more than 300 lines this will cause issues
+          tail -n 300 "$LF_LOG" > output.txt
+	  EC=101
+	  break
+	fi
+      done
+    fi
+  fi
+
+  # Perform some more analysis with ClusterFuzz's crash analysis tooling
+  # FIXME: need to feed crash log and then only save the actual stack trace
+  # lines, or figure out how to get the crash analyzer to only return the stack
+  # trace instead of the entire output
+  /analyzer/analyzer.py --outputfile output.txt --exitcode $EC > analysis.json
+  ANALYSIS_JSON=$(cat analysis.json)
+
+  DB_SAMPLE="$fname"
+  DB_TYPE="$(echo "$ANALYSIS_JSON" | jq -r .type)"
+  DB_IS_CRASH="$(echo "$ANALYSIS_JSON" | jq .is_crash | sed -e 's/true/1/' -e 's/false/0/')"
+  DB_IS_SECURITY_ISSUE="$(echo "$ANALYSIS_JSON" | jq .is_security_issue | sed -e 's/true/1/' -e 's/false/0/')"
+  DB_SHOULD_IGNORE="$(echo "$ANALYSIS_JSON" | jq .should_ignore | sed -e 's/true/1/' -e 's/false/0/')"
+  DB_BACKTRACE="$(echo "$ANALYSIS_JSON" | jq -r .stacktrace)"
+  DB_OUTPUT="$(echo "$ANALYSIS_JSON" | jq -r .output)"
+  DB_RC="$(echo "$ANALYSIS_JSON" | jq -r .return_code)"
+
+  # we do what has to be done, not because we wish to, but because we must
+  python3 - <<-EOF
+	import sqlite3 as sq; c = sq.connect("jobresults/crashes/crashes.db");
+	c.execute("insert into analysis (sample, type, is_crash, is_security_issue, should_ignore, backtrace, output, return_code) values (?, ?, ?, ?, ?, ?, ?, ?)", ("""$DB_SAMPLE""", """$DB_TYPE""", $DB_IS_CRASH, $DB_IS_SECURITY_ISSUE, $DB_SHOULD_IGNORE, """$DB_BACKTRACE""", """$DB_OUTPUT""", $DB_RC))
+	import json; frames = json.load(open("analysis.json"))["frames"];
+	c.executemany("insert into frames (sample, thread, frame, depth, function, file, line, module) values (?, ?, ?, ?, ?, ?, ?, ?)", [("""$DB_SAMPLE""", f["thread"], f["frame"], f["depth"], f["function"], f["file"], f["line"], f["module"]) for f in frames])
+	c.commit(); c.close();
+	EOF
+done
+span_end "$(sqlite3 ./jobresults/crashes/crashes.db "select count(*) from analysis") crashes"
+
+# Minimize corpus
+span_begin minimize
+printf "Minimizing corpus...\n"
+
+# The seed corpus is taken to be minimal already, so only the inputs the fuzz
+# phase found are evaluated, against the coverage recorded for the seed corpus
+# in the zip's $SEED_SIGNATURES and the corpus store's $STORE_SIGNATURES. The
+# new corpus's coverage is written alongside it for the next job. The corpus is
+# uploaded packed, so it's a couple of files on the shared volume rather than
+# one per input.
+# TODO: afl-tmin is turned off because it takes so long; for libFuzzer the
+# same is available via -minimize_crash
+SEED_SIGNATURES="./corpus-coverage.jsonl.gz"
+if [ "$DRIVER" == "afl" ]; then
+  CMIN_INPUTS=$RESULT
+elif [ "$DRIVER" == "libFuzzer" ]; then
+  CMIN_INPUTS=$CORPUS
+fi
+python3 /cmin.py --driver "$DRIVER" --target $TARGET --seed $SEED \
+  --signatures $SEED_SIGNATURES --signatures "$STORE_SIGNATURES" -j $CORES \
+  -o ./minimized --save ./minimized-coverage.jsonl.gz $CMIN_INPUTS
+python3 /lagopus_segment.py pack ./minimized ./minimized
+
+if [ "$DRIVER" == "afl" ]; then
+  # FIXME: these will overwrite each other in the copy
+  printf "Copying miscellaneous datum...\n"
+  find $RESULT -print0 -type f -name 'fuzzer_stats' | xargs cp -t jobresults/misc
+fi
+
+span_end
+
+# upload results
+span_begin zip
+zip -r jobresults.zip jobresults
+span_end
+
+span_begin upload
+# the index goes last; the server only reads the corpus once told this phase
+# is done, but a segment with an index is complete either way
+cp ./minimized.seg "$JOBDATA/corpus.seg"
+cp ./minimized.idx "$JOBDATA/corpus.idx"
+cp ./minimized-coverage.jsonl.gz "$JOBDATA/corpus-coverage.jsonl.gz"
+
+cp jobresults.zip "$JOBDATA"
+span_end
+
+# tell the server results are ready so they get scanned right away
+if [ "$LAGOPUS_SERVER" != "" ]; then
+  curl -fsS -X POST "http://$LAGOPUS_SERVER/api/jobs/$JOB_ID/result" || printf "Failed to notify server of results\n"
+  curl -fsS -X POST -H "Content-Type: application/json" -d '{"phase": "minimize"}' \
+    "http://$LAGOPUS_SERVER/api/jobs/$JOB_ID/phase" || printf "Failed to notify server of phase completion\n"
+fi
+
+exit 0
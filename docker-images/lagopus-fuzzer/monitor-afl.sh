@@ -73,6 +73,20 @@ TOTAL_PATHS=0
 CURRENT_PATH=0
 AVG_EPS=0
 
+# Each instance also gets its own point, tagged with its ID, so a slow or stuck
+# instance doesn't disappear into the totals
+INSTANCE_POINTS=""
+# Add a point for one fuzzer instance
+#
+# $1: instance ID
+# $2: fields
+instance_point() {
+  local tags
+  tags="job_id=$JOB_ID,host=$HOSTNAME,pod=${JOB_COMPLETION_INDEX:-0}"
+  tags="$tags,instance=$(echo "$1" | sed 's/\([ ,=]\)/\\\1/g')"
+  INSTANCE_POINTS+="${INFLUX_MEASUREMENT}_instances,$tags $2"$'\n'
+}
+
 for i in $(find . -maxdepth 2 -iname fuzzer_stats | sort); do
   sed 's/[ ]*:[ ]*/="/;s/$/"/' "$i" >"$TMP"
   # Import fuzzer_stats into bash vars
@@ -82,13 +96,25 @@ for i in $(find . -maxdepth 2 -iname fuzzer_stats | sort); do
   RUN_DAYS=$((RUN_UNIX / 60 / 60 / 24))
   RUN_HRS=$(((RUN_UNIX / 60 / 60) % 24))
 
+  INSTANCE=$(basename "$(dirname "$i")")
+  # seconds since it last found a path, and since it last wrote its stats; AFL
+  # writes them every minute or so, so an instance that stops is stuck
+  SINCE_PATH=$((CUR_TIME - (last_path > 0 ? last_path : start_time)))
+  SINCE_UPDATE=$((CUR_TIME - last_update))
+  INSTANCE_FIELDS="execs=$execs_done,total_paths=$paths_total,pending_fav=$pending_favs"
+  INSTANCE_FIELDS="$INSTANCE_FIELDS,crashes=$unique_crashes,hangs=$unique_hangs"
+  INSTANCE_FIELDS="$INSTANCE_FIELDS,since_last_path=$SINCE_PATH,since_update=$SINCE_UPDATE"
+
   if ! kill -0 "$fuzzer_pid" 2>/dev/null; then
       echo "  Instance is dead or running remotely, skipping."
       echo
     DEAD_CNT=$((DEAD_CNT + 1))
+    instance_point "$INSTANCE" "alive=0,execs_per_sec=0,$INSTANCE_FIELDS"
     continue
   fi
 
+  instance_point "$INSTANCE" "alive=1,execs_per_sec=$execs_per_sec,$INSTANCE_FIELDS"
+
   ALIVE_CNT=$((ALIVE_CNT + 1))
 
   #PATH_PERC=$((cur_path * 100 / paths_total))
@@ -107,9 +133,8 @@ done
 
 rm -f "$TMP"
 
-TOTAL_DAYS=$((TOTAL_TIME / 60 / 60 / 24))
-TOTAL_HRS=$(((TOTAL_TIME / 60 / 60) % 24))
-TOTAL_MEM=$(free --mega | grep Mem | tr -s ' ' | cut -d' ' -f3)
+# CPU and memory used by this container, rather than by the whole node
+RESOURCE_FIELDS=$(python3 /cgroup.py influx)
 AVG_EPS=$(($TOTAL_EPS / $ALIVE_CNT))
 
 test "$TOTAL_TIME" = "0" && TOTAL_TIME=1
@@ -120,6 +145,7 @@ echo "Pushing to database $INFLUX_DATABASE"
 TAGS="job_id=$JOB_ID"
 TAGS="$TAGS,target=$(basename "$(echo "$command_line" | sed -n 's/^.*-- //p')" | sed 's/\([ ,=]\)/\\\1/g')"
 TAGS="$TAGS,host=$(hostname)"
+TAGS="$TAGS,pod=${JOB_COMPLETION_INDEX:-0}"
 
 FIELDS="alive=$ALIVE_CNT"
 FIELDS="$FIELDS,crashes=$TOTAL_CRASHES"
@@ -130,8 +156,14 @@ FIELDS="$FIELDS,pending=$TOTAL_PENDING"
 FIELDS="$FIELDS,pending_fav=$TOTAL_PFAV"
 FIELDS="$FIELDS,total_paths=$TOTAL_PATHS"
 FIELDS="$FIELDS,current_path=$CURRENT_PATH"
-FIELDS="$FIELDS,cpu_hours=$TOTAL_HRS"
-FIELDS="$FIELDS,memory=$TOTAL_MEM"
+if [ -n "$RESOURCE_FIELDS" ]; then
+  FIELDS="$FIELDS,$RESOURCE_FIELDS"
+fi
+# without cgroup stats, count the time the instances have been running
+case ",$RESOURCE_FIELDS" in
+  *,cpu_hours=*) ;;
+  *) FIELDS="$FIELDS,cpu_hours=$(awk -v t="$TOTAL_TIME" 'BEGIN { print t / 3600 }')" ;;
+esac
 
 echo "Creating DB"
 influx -host "$INFLUX_HOST" -port "$INFLUX_PORT" -execute "CREATE DATABASE \"$INFLUX_DATABASE\""
@@ -140,5 +172,13 @@ CMD="influx -host \"$INFLUX_HOST\" -port \"$INFLUX_PORT\" -database \"$INFLUX_DA
 echo "Executing: $CMD"
 eval "$CMD"
 
+# one line per instance; the CLI takes one point at a time, so these go
+# straight to the HTTP API
+if [ -n "$INSTANCE_POINTS" ]; then
+  echo "Pushing stats of each instance"
+  curl -sS -XPOST "http://$INFLUX_HOST:$INFLUX_PORT/write?db=$INFLUX_DATABASE" --data-binary "$INSTANCE_POINTS" \
+    || echo "Failed to push stats of each instance"
+fi
+
 exit 0
 
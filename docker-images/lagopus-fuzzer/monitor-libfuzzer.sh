@@ -41,27 +41,54 @@ TOTAL_HANGS=0
 TOTAL_PFAV=0
 TOTAL_PENDING=0
 TOTAL_PATHS=0
-TOTAL_HRS=0
-TOTAL_MEM=0
 CURRENT_PATH=0
 AVG_EPS=0
 
+# Each instance also gets its own point, tagged with its ID, so a slow or stuck
+# instance doesn't disappear into the totals
+INSTANCE_POINTS=""
+# Add a point for one fuzzer instance
+#
+# $1: instance ID
+# $2: fields
+instance_point() {
+  local tags
+  tags="job_id=$JOB_ID,host=$HOSTNAME,pod=${JOB_COMPLETION_INDEX:-0}"
+  tags="$tags,instance=$(echo "$1" | sed 's/\([ ,=]\)/\\\1/g')"
+  INSTANCE_POINTS+="${INFLUX_MEASUREMENT}_instances,$tags $2"$'\n'
+}
+
 for file in ./fuzz-*.log; do
 	IFS=$'\n'
 	STATS=($(grep 'cov' "$file" | tail -n 1 | tr -s '[:blank:]' ' ' | tr -s '[:blank:]' | sed 's/#//g' | cut -d' ' -f1,4,6,8,10,12,14 | tr -s ' ' '\n' | sed -e 's/[A-Z][a-z]//g'))
 	unset IFS
 
+	# fuzz.sh starts worker N logging to fuzz-N.log, and records its PID in
+	# fuzz-N.pid
+	INSTANCE=$(basename "$file" .log)
+	INSTANCE=${INSTANCE#fuzz-}
+	if [ ! -f "fuzz-$INSTANCE.pid" ] || kill -0 "$(cat "fuzz-$INSTANCE.pid")" 2>/dev/null; then
+		ALIVE=1
+		ALIVE_CNT=$((ALIVE_CNT + 1))
+	else
+		ALIVE=0
+		DEAD_CNT=$((DEAD_CNT + 1))
+	fi
+
 	# Add stats from this fuzz log to cumulative stats
 	TOTAL_EXECS=$((TOTAL_EXECS + STATS[0]))
 	TOTAL_PATHS=$((TOTAL_PATHS + STATS[1]))
-	TOTAL_EPS=$((TOTAL_EPS + STATS[5]))
-	# XXX: Lol
-	ALIVE_CNT=$((ALIVE_CNT + 1))
+	TOTAL_EPS=$((TOTAL_EPS + STATS[5] * ALIVE))
+
+	# libFuzzer only logs on new coverage and at growing intervals, so a
+	# quiet log says nothing about whether a worker is stuck
+	instance_point "$INSTANCE" "alive=$ALIVE,execs_per_sec=$((${STATS[5]:-0} * ALIVE)),execs=${STATS[0]:-0},total_paths=${STATS[1]:-0}"
 done
 
 TOTAL_CRASHES=$(find . -maxdepth 1 -type f \( -name "crash-*" -o -name "leak-*" \) | wc -l)
 TOTAL_HANGS=$(find . -maxdepth 1 -type f -name "timeout-*" | wc -l)
-TOTAL_MEM=$(free --mega | grep Mem | tr -s ' ' | cut -d' ' -f3)
+# CPU and memory used by this container, rather than by the whole node
+RESOURCE_FIELDS=$(python3 /cgroup.py influx)
 
 echo "Pushing to database $INFLUX_DATABASE"
 
@@ -69,6 +96,7 @@ echo "Pushing to database $INFLUX_DATABASE"
 TAGS="job_id=$JOB_ID"
 TAGS="$TAGS,target=target"
 TAGS="$TAGS,host=$HOSTNAME"
+TAGS="$TAGS,pod=${JOB_COMPLETION_INDEX:-0}"
 
 FIELDS="alive=$ALIVE_CNT"
 FIELDS="$FIELDS,crashes=$TOTAL_CRASHES"
@@ -79,8 +107,9 @@ FIELDS="$FIELDS,pending=$TOTAL_PENDING"
 FIELDS="$FIELDS,pending_fav=$TOTAL_PFAV"
 FIELDS="$FIELDS,total_paths=$TOTAL_PATHS"
 FIELDS="$FIELDS,current_path=$CURRENT_PATH"
-FIELDS="$FIELDS,cpu_hours=$TOTAL_HRS"
-FIELDS="$FIELDS,memory=$TOTAL_MEM"
+if [ -n "$RESOURCE_FIELDS" ]; then
+  FIELDS="$FIELDS,$RESOURCE_FIELDS"
+fi
 
 echo "Creating DB"
 influx -host "$INFLUX_HOST" -port "$INFLUX_PORT" -execute "CREATE DATABASE \"$INFLUX_DATABASE\""
@@ -89,5 +118,13 @@ CMD="influx -host \"$INFLUX_HOST\" -port \"$INFLUX_PORT\" -database \"$INFLUX_DA
 echo "Executing: $CMD"
 eval "$CMD"
 
+# one line per instance; the CLI takes one point at a time, so these go
+# straight to the HTTP API
+if [ -n "$INSTANCE_POINTS" ]; then
+  echo "Pushing stats of each instance"
+  curl -sS -XPOST "http://$INFLUX_HOST:$INFLUX_PORT/write?db=$INFLUX_DATABASE" --data-binary "$INSTANCE_POINTS" \
+    || echo "Failed to push stats of each instance"
+fi
+
 exit 0
 
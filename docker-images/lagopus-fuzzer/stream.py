@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) Quentin Young 2020
+# MIT License
+#
+# Streams a pod's results to the job directory while it fuzzes.
+#
+# Rather than archiving everything the fuzzers produced once the fuzz phase is
+# over, which loses all of it if the pod is killed first and adds minutes to
+# the tail of every job, new crashes, corpus inputs and stats snapshots are
+# packed into segments as they appear:
+#
+#   $JOBDATA/stream/pod-<index>/<seq>.seg
+#   $JOBDATA/stream/pod-<index>/<seq>.idx
+#   $JOBDATA/stream/pod-<index>/<seq>.json
+#
+# The manifest lists the files in the segment, by their path in the working
+# directory of the minimize phase and the SHA-1 of their contents. It's written
+# last, so a segment with a manifest is complete, and segments are never
+# changed once written. Crashes and corpus inputs don't change once the
+# fuzzers have written them and are streamed once; stats are streamed again
+# when they change, at most once per snapshot interval, and the latest copy
+# wins. Logs and AFL's plot_data only ever grow, and a copy of them in every
+# snapshot would add up to many times their size, so they're streamed on the
+# last pass only. The last pass writes a `done` marker.
+#
+# Every pass also checkpoints how long the pod has fuzzed for in
+# `checkpoint`. A pod that's killed before it's done, by preemption or
+# eviction, isn't marked done, and when k8s runs it again it resumes from the
+# checkpoint: --resume puts the corpus and stats it streamed back in its
+# working directory, and the pod fuzzes for whatever's left of the deadline.
+#
+# The minimize phase puts the output of every pod back together from the
+# segments with --assemble, and the scanner ingests each segment as it's
+# written.
+#
+# Runs until SIGTERM or a graceful exit is requested, then streams what's left.
+# The pod is marked done on SIGTERM; a graceful exit means the pod is being
+# killed, so it's left to be resumed.
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import re
+import signal
+import sys
+import threading
+import time
+
+import lagopus_segment
+
+SHOULDEXIT = "/shouldexit"
+
+# AFL instance directories holding inputs pulled in from other pods; those
+# pods stream them themselves
+AFL_PEER_PREFIX = "lagopus_pod"
+
+LIBFUZZER_ARTIFACT = re.compile(r"^(crash|leak|timeout|slow-unit|oom)-")
+
+# files younger than this may still be being written, and wait for the next
+# pass unless it's the last
+SETTLE_TIME = 1
+
+# kinds of file that are streamed again when they change
+SNAPSHOT_KINDS = ("stats", "log")
+
+# files that are only ever appended to, which are streamed on the last pass
+# rather than every snapshot
+APPEND_ONLY = re.compile(r"(^|/)plot_data$|\.log$")
+
+# kinds of file put back in the working directory of a resumed pod; crashes
+# and hangs are already streamed, and logs are streamed under other names
+RESUME_KINDS = ("corpus", "stats")
+
+# not .json, which would make it look like a segment manifest
+CHECKPOINT = "checkpoint"
+
+
+def manifest_paths(directory):
+    """
+    :param directory: stream directory of one pod
+    :return: sorted paths of the complete segments in it, without extension
+    """
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted(
+        os.path.join(directory, n[: -len(".json")])
+        for n in names
+        if n.endswith(".json") and not n.startswith(".")
+    )
+
+
+def load_manifest(segment):
+    """
+    :param segment: segment path, without extension
+    :return: the segment's manifest
+    """
+    with open(segment + ".json") as f:
+        return json.load(f)
+
+
+def load_checkpoint(directory):
+    """
+    :param directory: stream directory of one pod
+    :return: the pod's last checkpoint, or None if it hasn't got one
+    """
+    try:
+        with open(os.path.join(directory, CHECKPOINT)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_atomic(path, obj):
+    """
+    Write an object as JSON so that nobody reading the file sees it half
+    written.
+    """
+    tmp = os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(obj, f)
+    os.rename(tmp, path)
+
+
+class Streamer(object):
+    """
+    Streams the output of one pod's fuzzers into its stream directory.
+
+    :param driver: fuzzing driver, one of [afl, libFuzzer]
+    :param workdir: working directory the fuzzers run in
+    :param outbox: this pod's stream directory
+    :param pod: this pod's index
+    :param snapshot_interval: least seconds between snapshots of stats
+    """
+
+    def __init__(self, driver, workdir, outbox, pod, snapshot_interval):
+        self.driver = driver
+        self.workdir = workdir
+        self.outbox = outbox
+        self.pod = pod
+        self.snapshot_interval = snapshot_interval
+        self.next_snapshot = 0
+        self.started = time.time()
+        os.makedirs(outbox, exist_ok=True)
+
+        # time fuzzed before the pod was last killed
+        checkpoint = load_checkpoint(outbox)
+        self.fuzzed = checkpoint["fuzzed"] if checkpoint else 0
+
+        # files streamed so far; when the pod's been restarted, what it
+        # streamed before is still there and isn't streamed again
+        self.streamed = set()
+        self.snapshots = {}
+        self.seq = 0
+        for segment in manifest_paths(outbox):
+            manifest = load_manifest(segment)
+            self.seq = max(self.seq, manifest["seq"] + 1)
+            for entry in manifest["files"]:
+                if entry["kind"] not in SNAPSHOT_KINDS:
+                    self.streamed.add(entry["source"])
+
+        # the seed corpus is already in the job directory; this is started
+        # before the fuzzers, so everything in the corpus now is the seed
+        if driver == "libFuzzer":
+            self.streamed.update(self.libfuzzer_corpus())
+
+    def libfuzzer_corpus(self):
+        corpus = os.path.join(self.workdir, "corpus")
+        with os.scandir(corpus) as entries:
+            return [os.path.join("corpus", e.name) for e in entries if e.is_file()]
+
+    def candidates(self):
+        """
+        :return: list of (path relative to the working directory, kind, path
+                 to stream it as)
+        """
+        files = []
+        if self.driver == "afl":
+            results = os.path.join(self.workdir, "results")
+            with os.scandir(results) as instances:
+                instances = [
+                    i.name
+                    for i in instances
+                    if i.is_dir() and not i.name.startswith(AFL_PEER_PREFIX)
+                ]
+            for instance in instances:
+                base = os.path.join("results", instance)
+                for subdir, kind in [
+                    ("queue", "corpus"),
+                    ("crashes", "crash"),
+                    ("hangs", "hang"),
+                ]:
+                    try:
+                        names = os.listdir(os.path.join(self.workdir, base, subdir))
+                    except FileNotFoundError:
+                        continue
+                    # entries synced from another instance are streamed by
+                    # the instance that found them
+                    files += [
+                        (os.path.join(base, subdir, n), kind, None)
+                        for n in names
+                        if n.startswith("id:") and ",sync:" not in n
+                    ]
+                for name in ["fuzzer_stats", "plot_data"]:
+                    files.append((os.path.join(base, name), "stats", None))
+        else:
+            files += [(p, "corpus", None) for p in self.libfuzzer_corpus()]
+            with os.scandir(self.workdir) as entries:
+                names = [e.name for e in entries if e.is_file()]
+            for name in names:
+                if LIBFUZZER_ARTIFACT.match(name):
+                    files.append((name, "crash", None))
+                elif name.startswith("fuzz-") and name.endswith(".log"):
+                    # logs get the pod index, so those of different pods don't
+                    # collide when put back together
+                    dest = "fuzz-{}-{}".format(self.pod, name[len("fuzz-") :])
+                    files.append((name, "log", dest))
+                elif name.endswith((".gcda", ".profraw")):
+                    files.append((name, "stats", None))
+
+        files.append(("sync.log", "log", "sync-{}.log".format(self.pod)))
+        return [(src, kind, dest or src) for src, kind, dest in files]
+
+    def pending(self, final):
+        """
+        :param final: whether this is the last pass
+        :return: list of (source path, kind, destination path, stat) to stream
+        """
+        snapshot = final or time.time() >= self.next_snapshot
+        settled = time.time() - SETTLE_TIME
+        pending = []
+        for src, kind, dest in self.candidates():
+            if kind in SNAPSHOT_KINDS:
+                if not snapshot or (not final and APPEND_ONLY.search(src)):
+                    continue
+            elif src in self.streamed:
+                continue
+            try:
+                st = os.stat(os.path.join(self.workdir, src))
+            except FileNotFoundError:
+                continue
+            if not final and st.st_mtime > settled:
+                continue
+            if kind in SNAPSHOT_KINDS and self.snapshots.get(src) == (
+                st.st_size,
+                st.st_mtime_ns,
+            ):
+                continue
+            pending.append((src, kind, dest, st))
+        if snapshot:
+            self.next_snapshot = time.time() + self.snapshot_interval
+        return pending
+
+    def flush(self, final=False, done=False):
+        """
+        Stream whatever's new into a segment, and checkpoint.
+
+        :param final: whether this is the last pass; everything is streamed
+        :param done: whether to mark the pod done
+        :return: number of files streamed
+        """
+        pending = self.pending(final)
+        if pending:
+            data = {}
+            files = []
+            for src, kind, dest, st in pending:
+                try:
+                    with open(os.path.join(self.workdir, src), "rb") as f:
+                        contents = f.read()
+                except FileNotFoundError:
+                    continue
+                digest = hashlib.sha1(contents).hexdigest()
+                data[digest] = contents
+                files.append(
+                    {
+                        "path": dest,
+                        "source": src,
+                        "kind": kind,
+                        "sha1": digest,
+                        "size": len(contents),
+                    }
+                )
+
+            segment = os.path.join(self.outbox, "{:06d}".format(self.seq))
+            lagopus_segment.pack(data.items(), segment)
+            manifest = {
+                "pod": self.pod,
+                "seq": self.seq,
+                "time": datetime.datetime.utcnow().isoformat(),
+                "files": files,
+            }
+            write_atomic(segment + ".json", manifest)
+            self.seq += 1
+
+            for src, kind, dest, st in pending:
+                if kind in SNAPSHOT_KINDS:
+                    self.snapshots[src] = (st.st_size, st.st_mtime_ns)
+                else:
+                    self.streamed.add(src)
+
+        write_atomic(
+            os.path.join(self.outbox, CHECKPOINT),
+            {
+                "seq": self.seq,
+                "time": datetime.datetime.utcnow().isoformat(),
+                "fuzzed": self.fuzzed + int(time.time() - self.started),
+            },
+        )
+
+        if done:
+            with open(os.path.join(self.outbox, "done"), "w") as f:
+                f.write("{}\n".format(self.seq))
+        return len(pending)
+
+
+def assemble_pod(pod, directory, kinds=None):
+    """
+    Put the streamed output of one pod back together. Segments are applied in
+    order, so the latest snapshot of a file wins.
+
+    :param pod: stream directory of the pod
+    :param directory: directory to put it in
+    :param kinds: kinds of file to write, or None for all of them
+    :return: number of files written
+    """
+    written = 0
+    for segment in manifest_paths(pod):
+        manifest = load_manifest(segment)
+        with lagopus_segment.Segment(segment) as seg:
+            for entry in manifest["files"]:
+                if kinds is not None and entry["kind"] not in kinds:
+                    continue
+                path = os.path.join(directory, entry["path"])
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                with open(path, "wb") as f:
+                    f.write(seg.get(entry["sha1"]))
+                written += 1
+    return written
+
+
+def assemble(stream, directory):
+    """
+    Put the streamed output of every pod back together, as it was laid out in
+    their working directories.
+
+    :param stream: stream directory of the job
+    :param directory: directory to put it in
+    :return: number of files written
+    """
+    try:
+        with os.scandir(stream) as pods:
+            pods = sorted(
+                p.path for p in pods if p.is_dir() and p.name.startswith("pod-")
+            )
+    except FileNotFoundError:
+        return 0
+    return sum(assemble_pod(pod, directory) for pod in pods)
+
+
+def resume(outbox, directory):
+    """
+    Put a killed pod's corpus and stats back in its working directory, so its
+    fuzzers carry on from where they were.
+
+    :param outbox: the pod's stream directory
+    :param directory: the pod's working directory
+    :return: seconds the pod fuzzed for before, or None if there's nothing to
+             resume from
+    """
+    checkpoint = load_checkpoint(outbox)
+    if checkpoint is None or os.path.exists(os.path.join(outbox, "done")):
+        return None
+    restored = assemble_pod(outbox, directory, RESUME_KINDS)
+    print(
+        "Restored {} files from {} segments".format(restored, checkpoint["seq"]),
+        file=sys.stderr,
+    )
+    return checkpoint["fuzzed"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Stream a pod's results to the job directory as they appear"
+    )
+    parser.add_argument("--driver", choices=["afl", "libFuzzer"])
+    parser.add_argument("--pod", type=int, default=0, help="This pod's index")
+    parser.add_argument(
+        "--interval", type=int, default=30, help="Seconds between passes"
+    )
+    parser.add_argument(
+        "--snapshot-interval",
+        type=int,
+        default=300,
+        help="Least seconds between snapshots of stats",
+    )
+    parser.add_argument(
+        "--assemble",
+        action="store_true",
+        help="Put the streamed output of every pod back together in the working directory",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Restore this pod's corpus and stats from its last checkpoint and "
+        "print how long it fuzzed for; exits 1 if there's nothing to resume",
+    )
+    parser.add_argument("stream", help="Stream directory in the job directory")
+    parser.add_argument(
+        "workdir", nargs="?", default=".", help="Working directory of the fuzzers"
+    )
+    args = parser.parse_args()
+
+    if args.assemble:
+        print("Assembled {} files".format(assemble(args.stream, args.workdir)))
+        sys.exit(0)
+
+    outbox = os.path.join(args.stream, "pod-{}".format(args.pod))
+
+    if args.resume:
+        fuzzed = resume(outbox, args.workdir)
+        if fuzzed is None:
+            sys.exit(1)
+        print(fuzzed)
+        sys.exit(0)
+
+    if not args.driver:
+        parser.error("--driver is required to stream")
+
+    streamer = Streamer(
+        args.driver,
+        args.workdir,
+        outbox,
+        args.pod,
+        args.snapshot_interval,
+    )
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    while not stop.wait(args.interval) and not os.path.exists(SHOULDEXIT):
+        try:
+            print("Streamed {} files".format(streamer.flush()))
+        except OSError as e:
+            # NFS hiccups shouldn't end the job's streaming; try again next
+            # pass
+            print("Stream failed: {}".format(e), file=sys.stderr)
+        sys.stdout.flush()
+
+    # a graceful exit means k8s is killing the pod; it's run again and resumes
+    done = not os.path.exists(SHOULDEXIT)
+    streamed = streamer.flush(final=True, done=done)
+    print(
+        "Streamed {} files, {}".format(streamed, "done" if done else "checkpointed")
+    )
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) Quentin Young 2020
+# MIT License
+#
+# Corpus sync agent for distributed jobs.
+#
+# Each pod of a distributed job fuzzes against its own local directory. This
+# periodically shares the inputs the pod's fuzzers find with the other pods by
+# way of the job directory, and brings theirs back:
+#
+#   $JOBDATA/sync/pod-<index>/<sha1 of contents>
+#
+# Inputs are named by their contents, so one that any pod has already shared
+# or received is never copied again. Each pass copies a bounded number of
+# inputs in each direction, so a burst of new finds, or a pod starting late
+# into a long job, can't saturate the shared volume.
+
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import time
+
+SHOULDEXIT = "/shouldexit"
+
+# AFL names the inputs it pulls in from other instances id:NNNNNN,sync:...;
+# these directories in the local sync dir hold the ones pulled in from other
+# pods, and look to AFL like other instances
+AFL_PEER_PREFIX = "lagopus_pod"
+
+
+def file_hash(path):
+    """
+    :return: SHA-1 hex digest of a file's contents
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_atomic(src, dst):
+    """
+    Copy a file so that nobody watching the destination directory sees it
+    half written.
+    """
+    tmp = os.path.join(os.path.dirname(dst), "." + os.path.basename(dst) + ".tmp")
+    shutil.copyfile(src, tmp)
+    os.rename(tmp, dst)
+
+
+class CorpusSync(object):
+    """
+    Shares new corpus entries between the pods of one job.
+
+    :param driver: fuzzing driver, one of [afl, libFuzzer]
+    :param local: AFL sync dir, or libFuzzer corpus dir
+    :param shared: directory in the job directory shared by all pods
+    :param pod: this pod's index
+    :param max_files: most inputs to copy each way per pass
+    :param max_bytes: most bytes to copy each way per pass
+    """
+
+    def __init__(self, driver, local, shared, pod, max_files, max_bytes):
+        self.driver = driver
+        self.local = local
+        self.shared = shared
+        self.outbox = os.path.join(shared, "pod-{}".format(pod))
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        os.makedirs(self.outbox, exist_ok=True)
+
+        # hashes of every input this pod has, whether found or received
+        self.seen = set(os.listdir(self.outbox))
+        # local files already hashed
+        self.exported = set()
+        # next AFL input ID in each peer's directory
+        self.next_ids = {}
+
+    def local_inputs(self):
+        """
+        :return: paths of inputs found by this pod's fuzzers
+        """
+        if self.driver == "libFuzzer":
+            # libFuzzer names new units by their SHA-1, same as we do, so
+            # received inputs are skipped by name without being hashed
+            with os.scandir(self.local) as entries:
+                return [e.path for e in entries if e.is_file()]
+
+        inputs = []
+        with os.scandir(self.local) as instances:
+            for instance in instances:
+                if not instance.is_dir() or instance.name.startswith(AFL_PEER_PREFIX):
+                    continue
+                queue = os.path.join(instance.path, "queue")
+                try:
+                    with os.scandir(queue) as entries:
+                        # entries synced from another instance were found by
+                        # that instance, which shares them itself
+                        inputs += [
+                            e.path
+                            for e in entries
+                            if e.name.startswith("id:")
+                            and ",sync:" not in e.name
+                            and e.is_file()
+                        ]
+                except FileNotFoundError:
+                    continue
+        return inputs
+
+    def export(self):
+        """
+        Copy inputs found by this pod into its outbox.
+
+        :return: tuple of (inputs copied, bytes copied)
+        """
+        files = size = 0
+        for path in sorted(set(self.local_inputs()) - self.exported):
+            if files >= self.max_files or size >= self.max_bytes:
+                break
+            name = os.path.basename(path)
+            digest = name if name in self.seen else file_hash(path)
+            self.exported.add(path)
+            if digest in self.seen:
+                continue
+            copy_atomic(path, os.path.join(self.outbox, digest))
+            self.seen.add(digest)
+            files += 1
+            size += os.path.getsize(path)
+        return files, size
+
+    def receive(self, src, digest, peer):
+        """
+        Hand an input from another pod to the local fuzzers.
+        """
+        if self.driver == "libFuzzer":
+            copy_atomic(src, os.path.join(self.local, digest))
+            return
+
+        # AFL only picks up inputs named id:NNNNNN with IDs it hasn't synced
+        # from that directory yet, so number them in arrival order
+        queue = os.path.join(self.local, AFL_PEER_PREFIX + peer, "queue")
+        if queue not in self.next_ids:
+            os.makedirs(queue, exist_ok=True)
+            self.next_ids[queue] = sum(
+                1 for name in os.listdir(queue) if name.startswith("id:")
+            )
+        name = "id:{:06d},src:{}".format(self.next_ids[queue], digest)
+        copy_atomic(src, os.path.join(queue, name))
+        self.next_ids[queue] += 1
+
+    def receive_all(self):
+        """
+        Copy inputs the other pods found into the local directory.
+
+        :return: tuple of (inputs copied, bytes copied)
+        """
+        files = size = 0
+        with os.scandir(self.shared) as peers:
+            peers = [
+                p
+                for p in peers
+                if p.is_dir() and p.name.startswith("pod-") and p.path != self.outbox
+            ]
+
+        for peer in peers:
+            for name in sorted(set(os.listdir(peer.path)) - self.seen):
+                if files >= self.max_files or size >= self.max_bytes:
+                    return files, size
+                if name.startswith("."):
+                    continue
+                src = os.path.join(peer.path, name)
+                self.receive(src, name, peer.name[len("pod-") :])
+                self.seen.add(name)
+                files += 1
+                size += os.path.getsize(src)
+        return files, size
+
+    def sync(self):
+        exported = self.export()
+        received = self.receive_all()
+        print(
+            "Shared {} inputs ({} bytes), received {} inputs ({} bytes)".format(
+                *exported, *received
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Share new corpus entries between the pods of a distributed job"
+    )
+    parser.add_argument("--driver", choices=["afl", "libFuzzer"], required=True)
+    parser.add_argument("--pod", type=int, required=True, help="This pod's index")
+    parser.add_argument(
+        "--interval", type=int, default=60, help="Seconds between passes"
+    )
+    parser.add_argument(
+        "--max-files", type=int, default=1000, help="Most inputs to copy each way per pass"
+    )
+    parser.add_argument(
+        "--max-bytes",
+        type=int,
+        default=64 * 2 ** 20,
+        help="Most bytes to copy each way per pass",
+    )
+    parser.add_argument("local", help="AFL sync dir, or libFuzzer corpus dir")
+    parser.add_argument("shared", help="Sync directory in the job directory")
+    args = parser.parse_args()
+
+    corpus_sync = CorpusSync(
+        args.driver, args.local, args.shared, args.pod, args.max_files, args.max_bytes
+    )
+
+    while not os.path.exists(SHOULDEXIT):
+        time.sleep(args.interval)
+        try:
+            corpus_sync.sync()
+        except OSError as e:
+            # NFS hiccups shouldn't end the job's syncing; try again next pass
+            print("Sync failed: {}".format(e), file=sys.stderr)
+        sys.stdout.flush()
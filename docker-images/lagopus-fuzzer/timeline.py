@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) Quentin Young 2020
+# MIT License
+#
+# Job timeline spans.
+#
+# Each step of a pod's phase, from setting up the target through fuzzing to
+# zipping and uploading results, is recorded as a span: when it began and
+# ended, how much CPU time the pod's cgroup used in between, and the cgroup's
+# peak memory by the end of it. Spans are posted to the server, which keeps
+# them with the job and shows them on the job page, so it's plain where a
+# job's wall clock time goes.
+#
+# entrypoint.sh wraps this in span_begin and span_end:
+#
+#   python3 /timeline.py cpu               CPU seconds the pod has used so far
+#   python3 /timeline.py record --name ... --start ... --cpu ...
+#
+# Resource usage comes from the pod's cgroup (cgroup.py); where it isn't
+# available, it's left out of the span.
+
+import argparse
+import json
+import sys
+import time
+import urllib.error
+import urllib.request
+
+import cgroup
+
+
+def cpu_seconds():
+    """
+    :return: CPU seconds used by the pod's cgroup so far, or None
+    """
+    return cgroup.cpu_stat()["usage"]
+
+
+def memory_peak():
+    """
+    :return: peak memory use of the pod's cgroup so far, in bytes, or None
+    """
+    return cgroup.memory_stat()["peak"]
+
+
+def record(server, job_id, span):
+    """
+    Post a span to the server.
+
+    :param server: <host>:<port> of the server
+    :param job_id: job the span belongs to
+    :param span: the span; fields that are None are left out, since the
+                 server only takes them as absent
+    :return: whether the server took it
+    """
+    span = {k: v for k, v in span.items() if v is not None}
+    request = urllib.request.Request(
+        "http://{}/api/jobs/{}/timeline".format(server, job_id),
+        data=json.dumps(span).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        urllib.request.urlopen(request, timeout=10).close()
+    except (urllib.error.URLError, OSError) as e:
+        print("Couldn't record span: {}".format(e), file=sys.stderr)
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record job timeline spans")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("cpu", help="Print CPU seconds the pod has used so far")
+    parser_record = subparsers.add_parser(
+        "record", help="Record a span that ends now"
+    )
+    parser_record.add_argument("--name", required=True, help="Name of the step")
+    parser_record.add_argument(
+        "--start", type=float, required=True, help="When it began, as a UNIX time"
+    )
+    parser_record.add_argument(
+        "--cpu", help="What `timeline.py cpu` printed when it began"
+    )
+    parser_record.add_argument("--detail", help="Anything else worth knowing")
+    parser_record.add_argument("--server", help="<host>:<port> of the server")
+    parser_record.add_argument("--job", help="Job ID")
+    parser_record.add_argument("--phase", required=True, help="Phase of the job")
+    parser_record.add_argument("--pod", type=int, default=0, help="This pod's index")
+    args = parser.parse_args()
+
+    if args.command == "cpu":
+        usage = cpu_seconds()
+        print("" if usage is None else "{:.3f}".format(usage))
+    elif args.command == "record":
+        end = time.time()
+        usage = cpu_seconds()
+        span = {
+            "name": args.name,
+            "phase": args.phase,
+            "pod": args.pod,
+            "start_time": args.start,
+            "end_time": end,
+            "cpu_seconds": usage - float(args.cpu)
+            if usage is not None and args.cpu
+            else None,
+            "memory_peak": memory_peak(),
+            "detail": args.detail or None,
+        }
+        print(
+            "Span {}: {:.1f}s{}".format(
+                args.name,
+                end - args.start,
+                ", {:.1f} CPU seconds".format(span["cpu_seconds"])
+                if span["cpu_seconds"] is not None
+                else "",
+            )
+        )
+        if args.server and args.job:
+            record(args.server, args.job, span)
+    else:
+        parser.print_help()
+        sys.exit(1)
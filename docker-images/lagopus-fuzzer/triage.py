@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) Quentin Young 2020
+# MIT License
+#
+# Live crash triage.
+#
+# Crashes used to be analyzed only in the minimize phase, so a long job showed
+# no crashes at all until it was over. This watches for the crashes the
+# fuzzers find while they run, reproduces and analyzes each one as
+# minimize.sh does, and pushes the analyses to the server in batches, so they
+# show up within seconds.
+#
+# It's meant to be run at idle priority alongside the fuzzers, so it only gets
+# CPU time they aren't using. The minimize phase analyzes every crash again
+# for the job's final results, which update the crashes ingested here, and
+# picks up any this didn't get to.
+
+import argparse
+import gzip
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+SHOULDEXIT = "/shouldexit"
+ANALYZER = "/analyzer/analyzer.py"
+
+# AFL instance directories holding inputs pulled in from other pods
+AFL_PEER_PREFIX = "lagopus_pod"
+
+LIBFUZZER_ARTIFACT = re.compile(r"^(crash|leak|timeout|slow-unit|oom)-")
+
+# seconds the target may run on one crash while it's reproduced
+REPRODUCE_TIMEOUT = 30
+# files younger than this may still be being written
+SETTLE_TIME = 1
+# lines of a libFuzzer log kept as the output of a crash that doesn't
+# reproduce; same as minimize.sh
+LOG_TAIL = 300
+
+
+class Triage(object):
+    """
+    Finds, analyzes and pushes the crashes of one pod's fuzzers.
+
+    :param driver: fuzzing driver, one of [afl, libFuzzer]
+    :param target: target binary
+    :param workdir: working directory the fuzzers run in
+    :param url: URL of the server's bulk crash ingest API
+    :param job_id: job the crashes belong to
+    :param batch_size: most crashes to push at once
+    """
+
+    def __init__(self, driver, target, workdir, url, job_id, batch_size):
+        self.driver = driver
+        self.target = os.path.abspath(target)
+        self.workdir = workdir
+        self.url = url
+        self.job_id = job_id
+        self.batch_size = batch_size
+        # samples already analyzed, so a restarted pod doesn't push them again
+        self.state = os.path.join(workdir, "triaged.txt")
+        self.triaged = set()
+        if os.path.exists(self.state):
+            with open(self.state) as f:
+                self.triaged = set(f.read().split("\n")) - {""}
+        # analyses not yet accepted by the server, and the key and length of
+        # the batch the first of them went out in
+        self.pending = []
+        self.batch = None
+
+    def crashes(self):
+        """
+        :return: list of (sample name, path) of crashes found so far; samples
+                 are named as they are in the job's final results
+        """
+        found = []
+        if self.driver == "afl":
+            results = os.path.join(self.workdir, "results")
+            with os.scandir(results) as instances:
+                instances = [
+                    i.name
+                    for i in instances
+                    if i.is_dir() and not i.name.startswith(AFL_PEER_PREFIX)
+                ]
+            for instance in instances:
+                crashdir = os.path.join(results, instance, "crashes")
+                try:
+                    names = os.listdir(crashdir)
+                except FileNotFoundError:
+                    continue
+                # afl-collect names samples after the instance that found them
+                found += [
+                    ("{}:{}".format(instance, n), os.path.join(crashdir, n))
+                    for n in names
+                    if n.startswith("id:")
+                ]
+        else:
+            with os.scandir(self.workdir) as entries:
+                found += [
+                    (e.name, e.path)
+                    for e in entries
+                    if LIBFUZZER_ARTIFACT.match(e.name) and e.is_file()
+                ]
+        return sorted(found)
+
+    def libfuzzer_log(self, name):
+        """
+        :return: the tail of the libFuzzer log that wrote an artifact, or None
+        """
+        for log in sorted(os.listdir(self.workdir)):
+            if not (log.startswith("fuzz-") and log.endswith(".log")):
+                continue
+            with open(os.path.join(self.workdir, log), errors="replace") as f:
+                lines = f.readlines()
+            if any(
+                "Test unit written to" in line and line.split()[-1].endswith(name)
+                for line in lines
+            ):
+                return "".join(lines[-LOG_TAIL:])
+        return None
+
+    def analyze(self, sample, path):
+        """
+        Reproduce a crash and analyze its output.
+
+        :return: the analysis, as pushed to the server
+        """
+        with tempfile.TemporaryDirectory(prefix="triage") as scratch:
+            output = os.path.join(scratch, "output.txt")
+            with open(output, "wb") as out:
+                try:
+                    if self.driver == "afl":
+                        # FIXME: same as minimize.sh, should use the execution
+                        # line from target.conf
+                        with open(path, "rb") as f:
+                            proc = subprocess.run(
+                                [self.target],
+                                stdin=f,
+                                stdout=out,
+                                stderr=subprocess.STDOUT,
+                                timeout=REPRODUCE_TIMEOUT,
+                            )
+                    else:
+                        proc = subprocess.run(
+                            [self.target, path],
+                            stdout=out,
+                            stderr=subprocess.STDOUT,
+                            timeout=REPRODUCE_TIMEOUT,
+                        )
+                    rc = proc.returncode
+                except subprocess.TimeoutExpired:
+                    rc = -9
+
+            if self.driver == "libFuzzer" and rc == 0:
+                print("Crash on input {} does not reproduce".format(sample))
+                tail = self.libfuzzer_log(os.path.basename(path))
+                if tail is not None:
+                    with open(output, "w") as out:
+                        out.write(tail)
+                    rc = 101
+
+            proc = subprocess.run(
+                [ANALYZER, "--outputfile", output, "--exitcode", str(rc)],
+                stdout=subprocess.PIPE,
+                check=True,
+            )
+
+        analysis = json.loads(proc.stdout)
+        return {
+            "job_id": self.job_id,
+            "sample": sample,
+            "type": analysis["type"],
+            "is_crash": analysis["is_crash"],
+            "is_security_issue": analysis["is_security_issue"],
+            "should_ignore": analysis["should_ignore"],
+            "backtrace": analysis["stacktrace"],
+            "output": analysis["output"],
+            "return_code": analysis["return_code"],
+            "frames": analysis["frames"],
+        }
+
+    def push(self):
+        """
+        Push pending analyses to the server, a batch at a time. A batch the
+        server rejects as malformed is dropped rather than sent forever, and
+        one it rejects as too large is split.
+
+        :return: number of analyses the server accepted
+        """
+        pushed = 0
+        while self.pending:
+            # a batch keeps its key and contents until the server has it, so
+            # if the server applied it but the answer got lost, sending it
+            # again is harmless
+            if self.batch is None:
+                batch_len = min(len(self.pending), self.batch_size)
+                self.batch = (uuid.uuid4().hex, batch_len)
+            batch_key, batch_len = self.batch
+            batch = self.pending[:batch_len]
+            body = "".join(json.dumps(a) + "\n" for a in batch)
+            request = urllib.request.Request(
+                self.url,
+                data=gzip.compress(body.encode()),
+                headers={
+                    "Content-Type": "application/x-ndjson",
+                    "Content-Encoding": "gzip",
+                    "Idempotency-Key": batch_key,
+                },
+            )
+            try:
+                urllib.request.urlopen(request, timeout=30).close()
+            except urllib.error.HTTPError as e:
+                if e.code == 413 and batch_len > 1:
+                    # too big for the server; try again in halves, with a new
+                    # key since it's a different batch
+                    self.batch = (uuid.uuid4().hex, batch_len // 2)
+                    continue
+                if e.code < 400 or e.code >= 500 or e.code in (408, 429):
+                    # the server may take it later
+                    raise
+                # it never will; the minimize phase analyzes these again
+                print(
+                    "Server rejected {} crashes: {}".format(batch_len, e),
+                    file=sys.stderr,
+                )
+                del self.pending[:batch_len]
+                self.batch = None
+                continue
+            with open(self.state, "a") as f:
+                f.writelines(a["sample"] + "\n" for a in batch)
+            del self.pending[: len(batch)]
+            self.batch = None
+            pushed += len(batch)
+        return pushed
+
+    def run_once(self):
+        """
+        Analyze new crashes and push what's been analyzed.
+
+        :return: tuple of (crashes analyzed, analyses pushed)
+        """
+        settled = time.time() - SETTLE_TIME
+        queued = {a["sample"] for a in self.pending}
+        analyzed = 0
+        for sample, path in self.crashes():
+            if sample in self.triaged or sample in queued:
+                continue
+            try:
+                if os.path.getmtime(path) > settled:
+                    continue
+                self.pending.append(self.analyze(sample, path))
+            except (OSError, ValueError, subprocess.CalledProcessError) as e:
+                print("Couldn't analyze {}: {}".format(sample, e), file=sys.stderr)
+            # a crash that can't be analyzed is left to the minimize phase
+            self.triaged.add(sample)
+            analyzed += 1
+            # push as we go, so the first crashes of a burst show up first
+            if len(self.pending) >= self.batch_size:
+                break
+
+        return analyzed, self.try_push()
+
+    def try_push(self):
+        """
+        Push pending analyses, keeping them for the next pass if the server
+        can't be reached or fails to handle them.
+
+        :return: number of analyses the server accepted
+        """
+        try:
+            return self.push()
+        except (urllib.error.URLError, OSError) as e:
+            print("Couldn't push crashes: {}".format(e), file=sys.stderr)
+            return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Analyze crashes as the fuzzers find them and push them to the server"
+    )
+    parser.add_argument("--driver", choices=["afl", "libFuzzer"], required=True)
+    parser.add_argument("--target", required=True, help="Target binary")
+    parser.add_argument("--server", required=True, help="<host>:<port> of the server")
+    parser.add_argument("--job", required=True, help="Job ID")
+    parser.add_argument(
+        "--interval", type=int, default=10, help="Seconds between passes"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=50, help="Most crashes to push at once"
+    )
+    parser.add_argument(
+        "workdir", nargs="?", default=".", help="Working directory of the fuzzers"
+    )
+    args = parser.parse_args()
+
+    triage = Triage(
+        args.driver,
+        args.target,
+        args.workdir,
+        "http://{}/api/crashes/batch".format(args.server),
+        args.job,
+        args.batch_size,
+    )
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    while not stop.wait(args.interval) and not os.path.exists(SHOULDEXIT):
+        try:
+            print("Analyzed {} crashes, pushed {}".format(*triage.run_once()))
+        except OSError as e:
+            print("Triage failed: {}".format(e), file=sys.stderr)
+        sys.stdout.flush()
+
+    # whatever's left is analyzed in the minimize phase
+    print("Pushed {} crashes".format(triage.try_push()))
@@ -2,170 +2,1084 @@
 # Scan job directory and update database
 
 import os
+import json
+import shutil
 import sqlite3
+import tempfile
+import contextlib
 import time
-import pprint
 import argparse
 import hashlib
-from pathlib import Path
+import datetime
+import queue
+import threading
+import multiprocessing
+import concurrent.futures
 from zipfile import ZipFile
-from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
 import mysql.connector
 
+import lagopus_blobs
+import lagopus_crashes
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
 DBCONF = {
     "user": "root",
     "password": "lagopus",
     "host": "localhost",
     "database": "lagopus",
     "raise_on_warnings": True,
-    "tables": ["jobs", "crashes"],
+    "tables": [
+        "jobs",
+        "crashes",
+        "crash_frames",
+        "blobs",
+        "blob_dicts",
+        "scans",
+        "job_artifacts",
+    ],
 }
 
+# number of crashes sent to MySQL per INSERT
+BATCH_SIZE = 500
+# crash databases up to this size are read in memory instead of from disk
+INMEMORY_CRASHDB_SIZE = 16 * 1024 * 1024
+# number of blobs recompressed with the current dictionary per sweep
+BLOB_RECOMPRESS_LIMIT = 1000
+
+
+ARTIFACT_COLUMNS = [
+    "job_id",
+    "path",
+    "pod",
+    "kind",
+    "sha1",
+    "size",
+    "segment",
+    "stream_time",
+]
+
+# longest artifact path that fits in job_artifacts
+ARTIFACT_PATH_MAX = 512
+
+# compresses blobs written by this process
+blob_codec = lagopus_blobs.BlobCodec()
+
+
+def job_time(cnx, jobid, fallback):
+    """
+    Get the creation time of a job, which crashes are partitioned by. See
+    lagopus_crashes.job_time().
+
+    :param cnx: database connection, or None
+    """
+    cursor = cnx.cursor() if cnx else None
+    jobtime = lagopus_crashes.job_time(cursor, jobid, fallback)
+    if cursor:
+        cursor.close()
+    return jobtime
+
+
+def export_to_mysql(rows, blobs, frames, cnx):
+    """
+    Upsert a batch of crashes and their stack frames into MySQL. See
+    lagopus_crashes.export(); this doesn't commit either.
+
+    :param rows: list of tuples of values for lagopus_crashes.CRASH_COLUMNS
+    :param blobs: dict of UTF-8 encoded texts referenced by rows, keyed by
+                  lagopus_blobs.blob_hash
+    :param frames: list of tuples of values for lagopus_crashes.FRAME_COLUMNS
+    :param cnx: connection to MySQL
+    """
+    cursor = cnx.cursor()
+    lagopus_crashes.export(cursor, blob_codec, rows, blobs, frames)
+    cursor.close()
+
+
+@contextlib.contextmanager
+def open_crashdb(jobresult_zip, crashdb):
+    """
+    Open the crash database inside a results zip without extracting it into
+    the working directory.
+
+    Small databases are loaded straight into an in-memory SQLite database.
+    Larger ones are streamed into a scratch directory that is removed when the
+    context exits.
+
+    :param jobresult_zip: jobresults.zip ZipFile
+    :param crashdb: name of crashes.db within the zip
+    :return: sqlite3 connection to the crash database
+    """
+    info = jobresult_zip.getinfo(crashdb)
+
+    if info.file_size <= INMEMORY_CRASHDB_SIZE and hasattr(
+        sqlite3.Connection, "deserialize"
+    ):
+        cdbcon = sqlite3.connect(":memory:")
+        try:
+            cdbcon.deserialize(jobresult_zip.read(info))
+            yield cdbcon
+        finally:
+            cdbcon.close()
+        return
+
+    with tempfile.TemporaryDirectory(prefix="lagopus-scan-") as scratch:
+        path = os.path.join(scratch, "crashes.db")
+        with jobresult_zip.open(info) as src, open(path, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        cdbcon = sqlite3.connect(path)
+        try:
+            yield cdbcon
+        finally:
+            cdbcon.close()
+
+
+def read_frames(cdbcon, samples):
+    """
+    Read the stack frames of some samples from crashes.db. Crash databases
+    from before frames were recorded don't have any.
+
+    :param cdbcon: sqlite3 connection to the crash database
+    :param samples: names of samples to read frames for
+    :return: dict of lists of (thread, frame, depth, function, file, line,
+             module) keyed by sample
+    """
+    frames = {}
+    if not cdbcon.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'frames'"
+    ).fetchone():
+        return frames
+
+    # stay under SQLite's limit on the number of query parameters
+    for i in range(0, len(samples), 500):
+        chunk = samples[i : i + 500]
+        cdbcur = cdbcon.execute(
+            "SELECT sample, thread, frame, depth, function, file, line, module FROM frames WHERE sample IN ({}) ORDER BY sample, thread, frame".format(
+                ", ".join(["?"] * len(chunk))
+            ),
+            chunk,
+        )
+        for sample, *frame in cdbcur:
+            frames.setdefault(sample, []).append(frame)
+    return frames
+
 
-def process_jobresults(jobid, jobresult_zip, crashdb, cnx):
+def process_jobresults(jobid, jobresult_zip, crashdb, cnx, batch_size=BATCH_SIZE):
     """
     Read crashes.db and export crash information into MySQL for use by the
     server.
 
+    Crashes are read from crashes.db and written to MySQL batch_size rows at a
+    time, so memory use doesn't depend on how many crashes a job found.
+    Nothing is committed; the caller commits once the whole job has been
+    exported, so a job is imported in a single transaction.
+
     :param jobid: name of the job we are processing, same as the job
                   directory
     :param jobresult_zip: jobresults.zip ZipFile
-    :param crashdb: path to sqlite3 crashes.db
+    :param crashdb: name of sqlite3 crashes.db within the zip
     :param cnx: database connection, or None to skip export
+    :param batch_size: number of crashes to send to MySQL per statement
+    :return: number of crashes exported
     """
     if not cnx:
         print("No MySQL connection provided, won't export")
 
-    crashdb = jobresult_zip.extract(crashdb)
+    create_time = utctime()
+    jobtime = job_time(cnx, jobid, create_time)
 
-    def export_to_mysql(entry, mysql_cnx):
-        """
-        Export a crash into mysql.
+    if cnx:
+        cursor = cnx.cursor()
+        blob_codec.refresh(cursor)
+        # frames are replaced wholesale when a job is imported again
+        cursor.execute(
+            "DELETE FROM crash_frames WHERE job_id = %(job_id)s", {"job_id": jobid}
+        )
+        cursor.close()
+    exported = 0
 
-        :param entry: row from crashdb as dictionary
-        :param mysql_cnx: connection to MySQL
-        """
-        mysql_cursor = mysql_cnx.cursor()
+    with open_crashdb(jobresult_zip, crashdb) as cdbcon:
+        cdbcur = cdbcon.execute(
+            "SELECT sample, type, is_crash, is_security_issue, backtrace, output, return_code FROM analysis"
+        )
 
-        entry = defaultdict(lambda: None, entry)
+        # insert into mysql
+        while True:
+            batch = cdbcur.fetchmany(batch_size)
+            if not batch:
+                break
 
-        query = "INSERT INTO crashes (job_id, type, is_security_issue, is_crash, sample_path, backtrace, backtrace_hash, return_code, create_time) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW())"
-        try:
-            mysql_cursor.execute(
-                query,
-                (
-                    jobid,
-                    entry["type"],
-                    entry["is_security_issue"],
-                    entry["is_crash"],
-                    entry["sample"],
-                    entry["backtrace"],
-                    entry["hash"],
-                    entry["return_code"],
-                ),
+            sample_frames = read_frames(cdbcon, [crash[0] for crash in batch])
+            rows, blobs, frames = lagopus_crashes.crash_rows(
+                jobid, jobtime, create_time, batch, sample_frames
             )
-        except mysql.connector.errors.IntegrityError as err:
-            print("Integrity: {}".format(err))
 
-        mysql_cnx.commit()
-        mysql_cursor.close()
+            if cnx:
+                export_to_mysql(rows, blobs, frames, cnx)
+            exported += len(rows)
+            print("{}: Exported {} crashes".format(jobid, exported))
 
-    def dict_factory(cursor, row):
-        """
-        Factory function for sqlite3 cursor.
-
-        :return: each row as a dict having structure {"colname": value}
-        """
-        rowdict = {}
-        for idx, col in enumerate(cursor.description):
-            rowdict[col[0]] = row[idx]
-        return rowdict
-
-    cdbcon = sqlite3.connect(crashdb)
-    cdbcon.row_factory = dict_factory
-    cdbcur = cdbcon.cursor()
-    result = cdbcur.execute("SELECT * FROM analysis")
-    if not result:
+    if not exported:
         print("Crash database empty, nothing to export")
-        return
 
-    result = [dict(row) for row in result.fetchall()]
+    return exported
+
+
+# ---
+# Scan ledger
+# ---
+
+LEDGER_SCHEMA = """
+CREATE TABLE `scans` (
+    `job_id` varchar(128) NOT NULL,
+    `results_file` varchar(255) NOT NULL,
+    `results_size` bigint,
+    `results_mtime` datetime(6),
+    `results_hash` char(40),
+    `status` varchar(16) NOT NULL,
+    `rows_imported` int(11),
+    `scan_start` datetime(6),
+    `scan_finish` datetime(6),
+    `error` text,
+    PRIMARY KEY (`job_id`, `results_file`),
+    KEY `status_finish` (`status`, `scan_finish`)
+  ) ENGINE=InnoDB
+"""
+
+
+def ledger_init(cnx):
+    """
+    Create the scan ledger if this database predates it.
+
+    :param cnx: database connection
+    """
+    cursor = cnx.cursor()
+    cursor.execute("SHOW TABLES LIKE 'scans'")
+    if not cursor.fetchall():
+        print("Creating scan ledger")
+        cursor.execute(LEDGER_SCHEMA)
+    cursor.close()
+
+
+def ledger_get(cnx, jobid, results_file):
+    """
+    Look up the ledger entry for a results file.
+
+    :param cnx: database connection
+    :param jobid: job the results belong to
+    :param results_file: name of the results file within the job directory
+    :return: ledger row as a dict, or None if the file has never been scanned
+    """
+    cursor = cnx.cursor(dictionary=True)
+    cursor.execute(
+        "SELECT * FROM scans WHERE job_id = %(job_id)s AND results_file = %(results_file)s",
+        {"job_id": jobid, "results_file": results_file},
+    )
+    result = cursor.fetchall()
+    cursor.close()
+    return result[0] if result else None
+
+
+def ledger_snapshot(cnx, results_file):
+    """
+    Fetch the size and mtime of every completely scanned results file in one
+    query, so a sweep can skip unchanged jobs without a lookup per job.
+
+    :param cnx: database connection
+    :param results_file: name of the results file within the job directory
+    :return: dict mapping job ID to (results_size, results_mtime)
+    """
+    cursor = cnx.cursor()
+    cursor.execute(
+        "SELECT job_id, results_size, results_mtime FROM scans WHERE status = 'complete' AND results_file = %(results_file)s",
+        {"results_file": results_file},
+    )
+    result = {jobid: (size, mtime) for jobid, size, mtime in cursor.fetchall()}
+    cursor.close()
+    return result
+
+
+def ledger_scanned(cnx, jobid, prefix):
+    """
+    Fetch the names of a job's completely scanned results files under a
+    directory, in one query.
+
+    :param cnx: database connection
+    :param jobid: job the results belong to
+    :param prefix: directory within the job directory, with trailing slash
+    :return: set of results file names
+    """
+    cursor = cnx.cursor()
+    cursor.execute(
+        "SELECT results_file FROM scans WHERE job_id = %(job_id)s AND status = 'complete' AND results_file LIKE %(prefix)s",
+        {"job_id": jobid, "prefix": prefix + "%"},
+    )
+    result = {results_file for results_file, in cursor.fetchall()}
+    cursor.close()
+    return result
+
+
+def ledger_record(cnx, jobid, results_file, **columns):
+    """
+    Create or update the ledger entry for a results file.
+
+    :param cnx: database connection
+    :param jobid: job the results belong to
+    :param results_file: name of the results file within the job directory
+    :param columns: ledger columns to set
+    """
+    columns["job_id"] = jobid
+    columns["results_file"] = results_file
+    names = list(columns.keys())
+    query = "INSERT INTO scans ({}) VALUES ({}) AS new ON DUPLICATE KEY UPDATE {}".format(
+        ", ".join(names),
+        ", ".join("%({})s".format(n) for n in names),
+        ", ".join("{0} = new.{0}".format(n) for n in names),
+    )
+    cursor = cnx.cursor()
+    cursor.execute(query, columns)
+    cnx.commit()
+    cursor.close()
+
+
+def file_hash(path):
+    """
+    :return: SHA-1 hex digest of a file's contents
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def utctime(timestamp=None):
+    """
+    :param timestamp: Unix timestamp, or None for the current time
+    :return: naive UTC datetime, as stored in the ledger's datetime columns
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    utc = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    return utc.replace(tzinfo=None)
 
-    # insert into mysql
-    for analysis in result:
-        # pull backtrace, if any, into dictionary
-        print("Exporting entry: {}".format(analysis))
 
-        analysis["hash"] = hashlib.md5(bytes(analysis["backtrace"], encoding="utf8")).hexdigest()
-        analysis["is_crash"] = bool(analysis["is_crash"])
-        analysis["is_security_issue"] = bool(analysis["is_security_issue"])
-        # unused
-        analysis["should_ignore"] = analysis["should_ignore"]
+def stream_segments(jobdir):
+    """
+    :param jobdir: absolute path to individual job directory
+    :return: names of the complete segments the job's pods have streamed,
+             relative to the job directory and without extension, in the order
+             they were written
+    """
+    segments = []
+    stream = os.path.join(jobdir, "stream")
+    try:
+        with os.scandir(stream) as pods:
+            pods = sorted(p.name for p in pods if p.name.startswith("pod-"))
+    except FileNotFoundError:
+        return segments
+
+    for pod in pods:
+        try:
+            names = os.listdir(os.path.join(stream, pod))
+        except NotADirectoryError:
+            continue
+        segments += sorted(
+            "stream/{}/{}".format(pod, n[: -len(".json")])
+            for n in names
+            if n.endswith(".json") and not n.startswith(".")
+        )
+    return segments
+
+
+def stream_state(jobdir):
+    """
+    Cheap fingerprint of a job's stream directory, which changes whenever one
+    of its pods streams a segment.
+
+    :param jobdir: absolute path to individual job directory
+    :return: tuple of (pod directory, mtime) pairs, or None if the job hasn't
+             streamed anything
+    """
+    try:
+        with os.scandir(os.path.join(jobdir, "stream")) as pods:
+            return tuple(
+                sorted(
+                    (p.name, p.stat().st_mtime_ns)
+                    for p in pods
+                    if p.name.startswith("pod-")
+                )
+            ) or None
+    except FileNotFoundError:
+        return None
+
+
+def scan_stream(jobdir, cnx):
+    """
+    Ingest the segments a job has streamed since it was last scanned.
+
+    Fuzzers stream crashes, corpus inputs and stats snapshots to the job
+    directory as they find them, in segments that are never changed once
+    written, so each segment is ingested once and has its own ledger entry.
+    Every file in a segment is recorded in job_artifacts in the same
+    transaction that marks the segment scanned; a file streamed again, like a
+    stats snapshot, is updated to point at the latest segment.
+
+    :param jobdir: absolute path to individual job directory
+    :param cnx: database connection, or None to skip export
+    :return: number of artifacts recorded, or None if there were no new
+             segments
+    """
+    jobid = os.path.basename(jobdir.strip("/"))
+    segments = stream_segments(jobdir)
+    if cnx and segments:
+        scanned = ledger_scanned(cnx, jobid, "stream/")
+        segments = [s for s in segments if s not in scanned]
+    if not segments:
+        return None
+
+    print("{}: Ingesting {} streamed segments".format(jobid, len(segments)))
+    query = "INSERT INTO job_artifacts ({}) VALUES ({}) AS new ON DUPLICATE KEY UPDATE {}".format(
+        ", ".join(ARTIFACT_COLUMNS),
+        ", ".join(["%s"] * len(ARTIFACT_COLUMNS)),
+        ", ".join("{0} = new.{0}".format(c) for c in ARTIFACT_COLUMNS[2:]),
+    )
+
+    recorded = 0
+    for segment in segments:
+        scan_start = utctime()
+        manifest_file = os.path.join(jobdir, segment + ".json")
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        stream_time = datetime.datetime.fromisoformat(manifest["time"])
+        rows = [
+            (
+                jobid,
+                entry["path"][:ARTIFACT_PATH_MAX],
+                manifest["pod"],
+                entry["kind"],
+                entry["sha1"],
+                entry["size"],
+                segment,
+                stream_time,
+            )
+            for entry in manifest["files"]
+        ]
 
         if cnx:
-            export_to_mysql(analysis, cnx)
+            cursor = cnx.cursor()
+            cursor.executemany(query, rows)
+            cursor.close()
+            # commits the artifacts along with the ledger entry
+            ledger_record(
+                cnx,
+                jobid,
+                segment,
+                status="complete",
+                rows_imported=len(rows),
+                results_size=os.path.getsize(os.path.join(jobdir, segment + ".seg")),
+                results_mtime=utctime(os.path.getmtime(manifest_file)),
+                scan_start=scan_start,
+                scan_finish=utctime(),
+                error=None,
+            )
+        recorded += len(rows)
 
-    cdbcon.close()
+    print("{}: Recorded {} streamed artifacts".format(jobid, recorded))
+    return recorded
 
 
-def scan_job(jobdir, cnx):
+def scan_job(jobdir, cnx, batch_size=BATCH_SIZE):
     """
     Scan a single job directory.
 
+    Progress is tracked in the scan ledger. A results file is only imported if
+    the ledger has no completed scan of it with the same size, mtime or
+    contents, so scanning is idempotent. A job's crashes are committed in the
+    same transaction that marks its scan complete; a scan that died partway
+    through is left marked as running and is retried on the next pass.
+
+    Whatever the job has streamed so far is ingested first, whether or not it
+    has results yet.
+
     :param jobdir: absolute path to individual job directory
-    :cnx: database connection, or None to skip export
+    :param cnx: database connection, or None to skip export
+    :param batch_size: number of crashes to send to MySQL per statement
+    :return: number of crashes and streamed artifacts imported by this call,
+             or None if the job has neither results nor newly streamed
+             segments
+    :raises: whatever went wrong if the results couldn't be imported, after
+             recording the failure in the ledger
     """
-    # dejavu, i've just been in this place before
-    if os.path.exists(jobdir + "/.scanned"):
-        print("{} already scanned, skipping".format(jobdir))
-        return
+    jobid = os.path.basename(jobdir.strip("/"))
+    results_file = "jobresults.zip"
+    jobresult_file = jobdir + "/" + results_file
+
+    streamed = scan_stream(jobdir, cnx)
+
+    try:
+        st = os.stat(jobresult_file)
+    except FileNotFoundError:
+        print("{}: No jobresults.zip, moving on".format(jobid))
+        return streamed
+
+    results = {
+        "results_size": st.st_size,
+        "results_mtime": utctime(st.st_mtime),
+    }
+
+    if cnx:
+        entry = ledger_get(cnx, jobid, results_file)
+        done = entry is not None and entry["status"] == "complete"
+
+        # dejavu, i've just been in this place before
+        if done and all(entry[k] == v for k, v in results.items()):
+            print("{} already scanned, skipping".format(jobdir))
+            return streamed or 0
+
+        # jobs scanned before the ledger existed were marked with .scanned
+        if entry is None and os.path.exists(jobdir + "/.scanned"):
+            print("{} scanned before ledger existed, recording".format(jobdir))
+            ledger_record(cnx, jobid, results_file, status="complete", **results)
+            return streamed or 0
+
+        results["results_hash"] = file_hash(jobresult_file)
+
+        if done and entry["results_hash"] == results["results_hash"]:
+            print("{} touched but unchanged, skipping".format(jobdir))
+            ledger_record(cnx, jobid, results_file, **results)
+            return streamed or 0
+
+        ledger_record(
+            cnx,
+            jobid,
+            results_file,
+            status="running",
+            rows_imported=0,
+            scan_start=utctime(),
+            scan_finish=None,
+            error=None,
+            **results
+        )
 
     print("Scanning job directory {}".format(jobdir))
+    print("Found jobresults.zip, checking for crashes")
 
-    jobresult_file = jobdir + "/jobresults.zip"
-
-    if os.path.exists(jobresult_file):
-        print("Found jobresults.zip, checking for crashes")
-        jobresult_zip = ZipFile(jobresult_file)
-        crashdbs = list(filter(lambda x: "crashes.db" in x, jobresult_zip.namelist()))
-        crashdb = crashdbs[0] if crashdbs else None
-        if crashdb is not None:
-            jobid = os.path.basename(jobdir.strip("/"))
-            print("{}: Found crashes.db".format(jobid))
-            process_jobresults(jobid, jobresult_zip, crashdb, cnx)
-        else:
-            print("No crashes.db, moving on")
-
-        # lets not visit again
-        Path(jobdir + "/.scanned").touch()
-    else:
-        print("No jobresults.zip, moving on")
+    imported = 0
+    try:
+        with ZipFile(jobresult_file) as jobresult_zip:
+            crashdbs = list(
+                filter(lambda x: "crashes.db" in x, jobresult_zip.namelist())
+            )
+            crashdb = crashdbs[0] if crashdbs else None
+            if crashdb is not None:
+                print("{}: Found crashes.db".format(jobid))
+                imported = process_jobresults(
+                    jobid, jobresult_zip, crashdb, cnx, batch_size
+                )
+            else:
+                print("No crashes.db, moving on")
+    except Exception as err:
+        if cnx:
+            cnx.rollback()
+            ledger_record(
+                cnx,
+                jobid,
+                results_file,
+                status="failed",
+                scan_finish=utctime(),
+                error=str(err),
+            )
+        raise
+
+    if cnx:
+        ledger_record(
+            cnx,
+            jobid,
+            results_file,
+            status="complete",
+            rows_imported=imported,
+            scan_finish=utctime(),
+        )
+
+    return imported + (streamed or 0)
 
 
-def scan(directory, cnx):
+def list_dirs(directory):
+    """
+    List directories under the jobs directory, whether or not they're finished
+    being set up as job directories.
+
+    Uses scandir so that the directory type comes from the listing itself
+    instead of a stat per entry; on NFS every stat is a round trip.
+
+    :param directory: jobs directory
+    :return: list of absolute paths to the directories in it
+    """
+    with os.scandir(directory) as entries:
+        return [e.path for e in entries if e.is_dir() and not e.name.startswith(".")]
+
+
+def list_jobdirs(directory):
+    """
+    List job directories under the jobs directory.
+
+    :param directory: jobs directory
+    :return: list of absolute paths to job directories
+    """
+    dirs = list_dirs(directory)
+    return list(filter(lambda x: os.path.exists(x + "/job.yaml"), dirs))
+
+
+# ---
+# Blob maintenance
+# ---
+
+
+def blob_maintenance(cnx, train=False):
+    """
+    Train a compression dictionary once there are enough blobs to train one
+    on, then gradually recompress older blobs with the current dictionary.
+
+    :param cnx: connection to MySQL
+    :param train: train a new dictionary even if there already is one
+    """
+    cursor = cnx.cursor()
+    blob_codec.refresh(cursor)
+
+    if train or blob_codec.current is None:
+        dict_id = lagopus_blobs.train(cursor, blob_codec)
+        if dict_id is not None:
+            print("Trained blob dictionary {}".format(dict_id))
+
+    recompressed = lagopus_blobs.recompress(cursor, blob_codec, BLOB_RECOMPRESS_LIMIT)
+    cnx.commit()
+    cursor.close()
+
+    if recompressed:
+        print("Recompressed {} blobs".format(recompressed))
+
+
+# ---
+# Workers
+# ---
+
+worker_cnx = None
+
+
+def worker_init(export):
+    """
+    Initializer for scan worker processes. Each worker gets its own database
+    connection, since connections can't be shared between processes.
+
+    :param export: whether to connect to MySQL
+    """
+    global worker_cnx
+    worker_cnx = lagopus_wait_connect_db(-1, CONNECT_RETRY_TIMER) if export else None
+
+
+def worker_scan_job(jobdir, batch_size):
+    """
+    Scan a single job directory in a worker process.
+
+    :return: (crashes imported or None, seconds spent)
+    """
+    start = time.monotonic()
+
+    if worker_cnx:
+        worker_cnx.ping(reconnect=True, attempts=3, delay=5)
+
+    imported = scan_job(jobdir, worker_cnx, batch_size)
+    return imported, time.monotonic() - start
+
+
+class ScanPool(object):
+    """
+    Scans job directories concurrently on a bounded pool of worker processes.
+
+    Each job is scanned in isolation; an error scanning one job is logged and
+    doesn't affect the others. If a worker dies outright the pool is replaced,
+    and whatever it was working on is picked up again by the next sweep since
+    its ledger entry is still marked as running.
+    """
+
+    def __init__(self, workers, export, batch_size=BATCH_SIZE):
+        """
+        :param workers: maximum number of jobs to scan at once
+        :param export: whether workers should export to MySQL
+        :param batch_size: number of crashes to send to MySQL per statement
+        """
+        self.workers = workers
+        self.export = export
+        self.batch_size = batch_size
+        self.executor = None
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.started = time.monotonic()
+        self.jobs = 0
+        self.rows = 0
+        self.errors = 0
+        self.reported = (self.started, 0, 0)
+        self.throughput = (0.0, 0.0)
+        # stream_state() of running jobs as of when they were last queued
+        self.streams = {}
+
+    def submit(self, jobdir):
+        """
+        Queue a job directory for scanning, unless it's already queued.
+        """
+        with self.lock:
+            if jobdir in self.inflight:
+                return
+
+            if self.executor is None:
+                # the scanner is threaded by the time workers are started, so
+                # don't fork
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=worker_init,
+                    initargs=(self.export,),
+                )
+
+            executor = self.executor
+            future = executor.submit(worker_scan_job, jobdir, self.batch_size)
+            self.inflight[jobdir] = future
+
+        future.add_done_callback(lambda f: self._done(jobdir, f, executor))
+
+    def _done(self, jobdir, future, executor):
+        with self.lock:
+            del self.inflight[jobdir]
+
+            try:
+                imported, elapsed = future.result()
+            except concurrent.futures.BrokenExecutor:
+                # every job in flight on a broken pool fails; only the first
+                # replaces it, and later ones mustn't drop its replacement
+                if executor is self.executor:
+                    print("{}: Worker died, restarting pool".format(jobdir))
+                    executor.shutdown(wait=False)
+                    self.executor = None
+                self.errors += 1
+                self.streams.pop(jobdir, None)
+                return
+            except Exception as err:
+                print("{}: Scan failed: {}".format(jobdir, err))
+                self.errors += 1
+                # so its stream is looked at again next time
+                self.streams.pop(jobdir, None)
+                return
+
+            if imported is not None:
+                self.jobs += 1
+                self.rows += imported
+                print("{}: Scanned in {:.1f}s".format(jobdir, elapsed))
+
+    def submit_stream(self, jobdir):
+        """
+        Queue a running job directory for scanning if it's streamed anything
+        since it was last queued.
+
+        :return: whether it was queued
+        """
+        state = stream_state(jobdir)
+        with self.lock:
+            if state is None or self.streams.get(jobdir) == state:
+                return False
+            self.streams[jobdir] = state
+        self.submit(jobdir)
+        return True
+
+    def wait(self):
+        """
+        Wait for every queued job to be scanned.
+        """
+        with self.lock:
+            futures = list(self.inflight.values())
+        concurrent.futures.wait(futures)
+
+    def stats(self):
+        """
+        :return: dict with the number of queued jobs, totals since startup and
+                 throughput over the last report interval
+        """
+        with self.lock:
+            return {
+                "backlog": len(self.inflight),
+                "workers": self.workers,
+                "jobs": self.jobs,
+                "rows": self.rows,
+                "errors": self.errors,
+                "jobs_per_sec": self.throughput[0],
+                "rows_per_sec": self.throughput[1],
+            }
+
+    def report(self):
+        """
+        Update throughput since the previous report and log it.
+        """
+        now = time.monotonic()
+        with self.lock:
+            then, jobs, rows = self.reported
+            elapsed = max(now - then, 1e-6)
+            self.throughput = (
+                (self.jobs - jobs) / elapsed,
+                (self.rows - rows) / elapsed,
+            )
+            self.reported = (now, self.jobs, self.rows)
+
+        print(
+            "Backlog: {backlog} jobs, throughput: {jobs_per_sec:.2f} jobs/s, "
+            "{rows_per_sec:.1f} rows/s ({jobs} jobs, {rows} rows, {errors} errors "
+            "total)".format(**self.stats())
+        )
+
+    def shutdown(self):
+        with self.lock:
+            executor = self.executor
+            self.executor = None
+        if executor:
+            executor.shutdown()
+
+
+def scan(directory, cnx, pool):
     """
     Scan jobs directory for newly finished jobs. If a new job is found and its
     jobresults.zip contains a crash database, call process_jobresults to export
     crashes into MySQL.
 
-    Once a job has been processed, we touch .scanned in the job directory in
-    order to skip processing it on subsequent scans.
+    Once a job has been processed it is recorded in the scan ledger in order to
+    skip processing it on subsequent scans. Jobs whose results match the
+    ledger are skipped here; everything else is queued onto the pool. Jobs
+    without results are queued if they've streamed anything since they were
+    last queued.
+
+    When running event driven this is only used as a reconciliation sweep to
+    catch anything the watchers missed.
 
     :param directory: jobs directory to scan
-    :param cnx: connection to MySQL database to export into
+    :param cnx: connection to MySQL database to check the ledger against, or
+                None to queue every job that has results
+    :param pool: ScanPool to queue jobs onto
+    :return: job directories that don't have results yet
     """
     print("Scanning {}".format(directory))
-    dirs = filter(
-        os.path.isdir, map(lambda x: os.path.join(directory, x), os.listdir(directory)),
-    )
-    jobdirs = list(filter(lambda x: os.path.exists(x + "/job.yaml"), dirs))
+    jobdirs = list_jobdirs(directory)
 
-    print("Job directories:")
-    pprint.pprint(jobdirs)
+    scanned = {}
+    if cnx:
+        cnx.ping(reconnect=True, attempts=3, delay=5)
+        scanned = ledger_snapshot(cnx, "jobresults.zip")
+        blob_maintenance(cnx)
+
+    unfinished = []
+    queued = 0
     # when you're not performing your duties, do they keep you in a little box?
     for jobdir in jobdirs:
-        scan_job(jobdir, cnx)
+        try:
+            st = os.stat(jobdir + "/jobresults.zip")
+        except FileNotFoundError:
+            unfinished.append(jobdir)
+            queued += pool.submit_stream(jobdir)
+            continue
+
+        jobid = os.path.basename(jobdir)
+        if scanned.get(jobid) == (st.st_size, utctime(st.st_mtime)):
+            continue
+
+        pool.submit(jobdir)
+        queued += 1
+
+    print(
+        "{} job directories, {} running, {} queued for scanning".format(
+            len(jobdirs), len(unfinished), queued
+        )
+    )
+    return unfinished
+
+
+# ---
+# Event sources
+# ---
+
+
+class NotifyHandler(BaseHTTPRequestHandler):
+    """
+    Accepts completion notifications of the form ``POST /jobs/<job_id>``, and
+    serves scanner throughput statistics at ``GET /stats``.
+
+    These are sent by the API server when a fuzzer pod reports that it has
+    finished uploading its results. This is the primary event source when the
+    jobs directory is on NFS, since inotify doesn't see writes made by other
+    NFS clients.
+    """
+
+    def do_POST(self):
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "jobs" or parts[1] in ("", ".", ".."):
+            self.send_error(404)
+            return
+
+        jobdir = os.path.join(self.server.jobsdir, parts[1])
+        if not os.path.isdir(jobdir):
+            self.send_error(404, "No such job")
+            return
+
+        print("Notified of results for {}".format(parts[1]))
+        self.server.pending.put(jobdir)
+        self.send_response(202)
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path.strip("/") != "stats":
+            self.send_error(404)
+            return
+
+        body = json.dumps(self.server.pool.stats()).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def notify_listener(directory, pending, pool, address, port):
+    """
+    Listen for completion notifications and queue the notified job
+    directories for scanning. Runs forever; meant to be run in a thread.
+
+    :param directory: jobs directory
+    :param pending: queue to put job directories onto
+    :param pool: ScanPool to report statistics for
+    :param address: address to listen on
+    :param port: port to listen on
+    """
+    httpd = HTTPServer((address, port), NotifyHandler)
+    httpd.jobsdir = directory
+    httpd.pending = pending
+    httpd.pool = pool
+    print("Listening for job notifications on {}:{}".format(address, port))
+    httpd.serve_forever()
+
+
+def inotify_watcher(directory, jobdirs, pending):
+    """
+    Watch the jobs directory with inotify and queue job directories as soon as
+    a jobresults.zip is finished being written into them. Runs forever; meant
+    to be run in a thread.
+
+    inotify isn't recursive, so the jobs directory is watched for new job
+    directories, and each job directory without results gets its own watch.
+    Finished jobs are never watched, so the number of watches tracks the number
+    of live jobs rather than the size of the job history.
+
+    :param directory: jobs directory
+    :param jobdirs: existing job directories that don't have results yet
+    :param pending: queue to put job directories onto
+    """
+    flags = inotify_simple.flags
+    inotify = inotify_simple.INotify()
+    dirmask = flags.CREATE | flags.MOVED_TO | flags.ONLYDIR
+    jobmask = flags.CLOSE_WRITE | flags.MOVED_TO
+    watches = {inotify.add_watch(directory, dirmask): directory}
+
+    def watch_job(jobdir):
+        try:
+            watches[inotify.add_watch(jobdir, jobmask)] = jobdir
+        except OSError as err:
+            print("Couldn't watch {}: {}".format(jobdir, err))
+
+    for jobdir in jobdirs:
+        watch_job(jobdir)
+
+    print("Watching {} with inotify ({} watches)".format(directory, len(watches)))
+
+    while True:
+        for event in inotify.read():
+            parent = watches.get(event.wd)
+            if parent is None:
+                continue
+            if event.mask & flags.IGNORED:
+                del watches[event.wd]
+            elif parent == directory:
+                if event.mask & flags.ISDIR:
+                    watch_job(os.path.join(directory, event.name))
+            elif event.name == "jobresults.zip":
+                pending.put(parent)
+                inotify.rm_watch(event.wd)
+
+
+def run(directory, cnx, pool, interval, address, port):
+    """
+    Scan job directories as events for them come in, falling back to a full
+    sweep every `interval` seconds. Running jobs are checked for newly
+    streamed results every STREAM_TIMER seconds.
+
+    :param directory: jobs directory to scan
+    :param cnx: connection to MySQL database to check the ledger against
+    :param pool: ScanPool to scan jobs on
+    :param interval: seconds between reconciliation sweeps
+    :param address: address to listen for completion notifications on
+    :param port: port to listen for completion notifications on, or 0 to
+                 disable notifications
+    """
+    pending = queue.Queue()
+    unfinished = scan(directory, cnx, pool)
+    running = set(unfinished)
+    seen = set(list_dirs(directory))
+
+    if port:
+        threading.Thread(
+            target=notify_listener,
+            args=(directory, pending, pool, address, port),
+            daemon=True,
+        ).start()
+
+    if inotify_simple:
+        threading.Thread(
+            target=inotify_watcher, args=(directory, unfinished, pending), daemon=True
+        ).start()
+    else:
+        print("inotify unavailable, relying on notifications and sweeps")
+
+    next_sweep = time.monotonic() + interval
+    next_report = time.monotonic() + REPORT_TIMER
+    next_stream = time.monotonic() + STREAM_TIMER
+    while True:
+        now = time.monotonic()
+        if now >= next_report:
+            pool.report()
+            next_report = now + REPORT_TIMER
+        if now >= next_sweep:
+            running = set(scan(directory, cnx, pool))
+            seen = set(list_dirs(directory))
+            next_sweep = now + interval
+        if now >= next_stream:
+            # jobs started since the last sweep are running too
+            jobdirs = set(list_dirs(directory))
+            running |= jobdirs - seen
+            seen = jobdirs
+            for jobdir in running:
+                pool.submit_stream(jobdir)
+            next_stream = now + STREAM_TIMER
+
+        timeout = min(next_sweep, next_report, next_stream) - time.monotonic()
+        timeout = max(0, timeout)
+        try:
+            jobdir = pending.get(timeout=timeout)
+        except queue.Empty:
+            continue
+
+        pool.submit(jobdir)
 
 
 def lagopus_connect_db():
@@ -210,6 +1124,12 @@ def lagopus_wait_connect_db(retry, wait):
 
 CONNECT_RETRY_TIMER = 5
 SCAN_TIMER = 15
+STREAM_TIMER = 30
+RECONCILE_TIMER = 600
+REPORT_TIMER = 60
+WORKERS = 4
+NOTIFY_ADDRESS = "127.0.0.1"
+NOTIFY_PORT = 8089
 JOBSDIR = "/jobs"
 
 if __name__ == "__main__":
@@ -219,6 +1139,46 @@ if __name__ == "__main__":
     )
     parser.add_argument("--noexport", help="don't export to MySQL", action="store_true")
     parser.add_argument("--oneshot", help="do one scan and exit", action="store_true")
+    parser.add_argument(
+        "--train-dict",
+        help="train a new blob compression dictionary and exit",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--poll",
+        help="disable event sources and do a full scan every {}s".format(SCAN_TIMER),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of job directories to scan concurrently",
+        default=WORKERS,
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        help="number of crashes to send to MySQL per INSERT",
+        default=BATCH_SIZE,
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        help="seconds between reconciliation scans in event driven mode",
+        default=RECONCILE_TIMER,
+    )
+    parser.add_argument(
+        "--notify-address",
+        type=str,
+        help="address to listen for job completion notifications on",
+        default=NOTIFY_ADDRESS,
+    )
+    parser.add_argument(
+        "--notify-port",
+        type=int,
+        help="port to listen for job completion notifications on; 0 to disable",
+        default=NOTIFY_PORT,
+    )
 
     args = parser.parse_args()
 
@@ -226,14 +1186,35 @@ if __name__ == "__main__":
         lagopus_wait_connect_db(-1, CONNECT_RETRY_TIMER) if not args.noexport else None
     )
 
+    if cnx:
+        ledger_init(cnx)
+
+    if args.train_dict:
+        if cnx:
+            blob_maintenance(cnx, train=True)
+            cnx.close()
+        exit()
+
+    pool = ScanPool(args.workers, not args.noexport, args.batch_size)
+
     if args.oneshot:
-        scan(args.jobsdir, cnx)
+        scan(args.jobsdir, cnx, pool)
+        pool.wait()
+        pool.report()
+        pool.shutdown()
         if cnx:
             cnx.close()
         exit()
 
-    while True:
-        time.sleep(SCAN_TIMER)
-        scan(args.jobsdir, cnx)
+    if args.poll:
+        while True:
+            time.sleep(SCAN_TIMER)
+            scan(args.jobsdir, cnx, pool)
+            pool.wait()
+            pool.report()
+
+    run(
+        args.jobsdir, cnx, pool, args.interval, args.notify_address, args.notify_port,
+    )
 
     cnx.close()
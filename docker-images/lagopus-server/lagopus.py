@@ -4,8 +4,19 @@
 # MIT License
 
 import os
+import copy
+import glob
+import gzip
+import hashlib
+import json
+import math
+import io
+import zlib
 import base64
+import statistics
 import tempfile
+import threading
+import time
 
 from flask import Flask, Blueprint
 from flask import render_template
@@ -15,14 +26,21 @@ from flask import request
 from flask import flash
 from flask import redirect, url_for
 from flask import jsonify
-from flask_restx import Resource, Api, Model, reqparse, fields, errors
+from flask_restx import Resource, Api, Model, reqparse, fields, errors, inputs
 from werkzeug.utils import secure_filename
+import requests
 from requests.exceptions import ConnectionError
 import mysql.connector
+from mysql.connector import errorcode
 from zipfile import ZipFile
 
 from influxdb import InfluxDBClient
 from influxdb.exceptions import InfluxDBClientError
+import zstandard
+
+import lagopus_blobs
+import lagopus_crashes
+import lagopus_segment
 
 app = Flask(__name__)
 blueprint = Blueprint("api", __name__, url_prefix="/api")
@@ -31,7 +49,12 @@ app.register_blueprint(blueprint)
 
 # Global settings ------------------------
 CONFIG = {
-    "dirs": {"base": "/lagopus", "jobs": "/lagopus/jobs",},
+    "dirs": {
+        "base": "/lagopus",
+        "jobs": "/lagopus/jobs",
+        # content addressed corpus store shared by all jobs
+        "corpora": "/lagopus/corpora",
+    },
     "database": {
         "connection": {
             "user": "root",
@@ -42,9 +65,94 @@ CONFIG = {
             "buffered": True,
             "autocommit": True,
         },
-        "tables": ["jobs", "crashes"],
+        "tables": [
+            "jobs",
+            "job_queue",
+            "job_placements",
+            "crashes",
+            "crash_frames",
+            "blobs",
+            "blob_dicts",
+            "scans",
+            "job_artifacts",
+            "crash_batches",
+            "job_spans",
+        ],
+    },
+    "jobs": {
+        "cpus": 2,
+        "memory": 200,
+        "deadline": 240,
+        # resources of the phase after fuzzing, which triages crashes and
+        # minimizes the corpus
+        "minimize_cpus": 4,
+        "minimize_memory": 1024,
+        # fuzzer image; pin a tag or digest to run every job on the same one
+        "image": "qlyoung/lagopus-fuzzer:latest",
+        # a moving tag like :latest has to be pulled every time for new images
+        # to reach the nodes; with a pinned image, IfNotPresent skips the pull
+        # on nodes that already have it
+        "image_pull_policy": "Always",
+        # hostPath on every node where pods share unpacked targets, pruned by
+        # the lagopus-cache DaemonSet; None to copy the target every time
+        "cache_path": "/var/cache/lagopus",
+    },
+    "crashes": {
+        # most bytes a batch pushed to /api/crashes/batch may decompress to
+        "batch_max_bytes": 64 * 1024 * 1024,
+        # seconds the keys of applied batches are remembered for
+        "batch_key_ttl": 7 * 24 * 3600,
+    },
+    "plateau": {
+        # seconds between checks of fuzzing jobs for a coverage plateau
+        "interval": 300,
+        # policy of jobs that don't name one
+        "default": "conservative",
+        # a job has plateaued, and is stopped, once its pods together have
+        # found no more than max_new_paths paths in the last window seconds
+        # and have no more than max_pending_fav favored paths left to explore
+        # (None for any number)
+        "policies": {
+            "off": None,
+            "conservative": {
+                "window": 4 * 3600,
+                "max_new_paths": 0,
+                "max_pending_fav": 0,
+            },
+            "aggressive": {"window": 3600, "max_new_paths": 0, "max_pending_fav": 0},
+        },
+    },
+    "instances": {
+        # only fuzzer instances that reported in this many seconds count
+        "window": 600,
+        # an instance running fewer execs/sec than this share of the median
+        # instance of its job is flagged as slow
+        "slow": 0.5,
+        # an AFL instance that hasn't updated its stats in this many seconds
+        # is flagged as stuck; AFL updates them every minute or so
+        "stale": 600,
+    },
+    # the scanner runs in the same pod and listens for result notifications
+    "scanner": {"notify": "http://localhost:8089"},
+    "scheduler": {
+        # seconds between scheduling passes
+        "interval": 10,
+        # once the job at the head of the queue has waited this many seconds,
+        # smaller jobs stop being released ahead of it
+        "backfill_wait": 3600,
+        # relative cluster share of each user; users not listed get 1
+        "shares": {},
+        # node label giving the number of NUMA nodes on it; unlabeled nodes
+        # are assumed to have one
+        "numa_label": "lagopus.io/numa-nodes",
+        # "prefer" to keep jobs within one NUMA node when possible, or
+        # "require" to hold back jobs that could fit in one NUMA node until
+        # one has room
+        "numa": "prefer",
+        # seconds a released job's pod may wait for k8s to find it a node
+        # before it stops holding back the rest of the queue
+        "pending_timeout": 600,
     },
-    "jobs": {"cpus": 2, "memory": 200, "deadline": 240,},
 }
 
 # ---
@@ -103,17 +211,47 @@ class JobCreateError(Exception):
     pass
 
 
-def lagopus_k8s_create_job(
-    job_id, driver, target, cpus, memory, deadline, namespace="default"
+class JobExistsError(JobCreateError):
+    pass
+
+
+# Jobs run in phases, each its own k8s job created from its own spec in the
+# job directory. The fuzz phase streams its pods' output to stream/ in the job
+# directory for the minimize phase, which triages crashes and minimizes the
+# corpus.
+JOB_PHASE_SPECS = {"fuzz": "job.yaml", "minimize": "minimize.yaml"}
+
+
+def lagopus_job_prepare(
+    job_id,
+    driver,
+    target,
+    cpus,
+    memory,
+    deadline,
+    pods=1,
+    minimize_cpus=None,
+    minimize_memory=None,
+    seed=None,
+    namespace="default",
 ):
     """
-    Add a new job.
+    Set up the job directory for a new job, with the rendered spec of each of
+    its phases and its target zip, and validate the target.
+
+    The job isn't created in k8s; the scheduler does that once it fits. Jobs
+    with more than one pod are created as indexed k8s jobs, each pod having
+    the given cpus and memory. The minimize phase always runs in one pod.
+
+    :param seed: manifest of a corpus in the corpus store to seed the job
+                 with, in addition to any corpus in the target zip
+    :return: path to the rendered job.yaml
     """
     lagopus_sanitycheck()
 
     env = jinja2.Environment(loader=jinja2.FileSystemLoader("./k8s/"))
 
-    # set up job directory with job.yaml and target zip
+    # set up job directory with job specs and target zip
     job = env.get_template("job.yaml")
     jobdir = CONFIG["dirs"]["jobs"] + "/" + job_id
     pathlib.Path(jobdir).mkdir(parents=True, exist_ok=True)
@@ -126,30 +264,49 @@ def lagopus_k8s_create_job(
     jobconf["cpu"] = str(cpus)
     jobconf["memory"] = "{}Mi".format(memory)
     jobconf["deadline"] = deadline
+    jobconf["pods"] = pods
     jobconf["driver"] = driver
     jobconf["namespace"] = namespace
     jobconf["jobpath"] = "jobs/" + job_id
+    jobconf["image"] = CONFIG["jobs"]["image"]
+    jobconf["image_pull_policy"] = CONFIG["jobs"]["image_pull_policy"]
+    jobconf["cache_path"] = CONFIG["jobs"]["cache_path"]
+    # pods look the target up in the node's cache by its hash
+    digest = hashlib.sha1()
+    with open(target, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    jobconf["target_hash"] = digest.hexdigest()
+
+    jobconf["phase"] = "fuzz"
 
     jobzip_path = os.path.join(jobdir, "target.zip")
-    jobspec_path = os.path.join(jobdir, "job.yaml")
+    jobspec_path = os.path.join(jobdir, JOB_PHASE_SPECS["fuzz"])
 
     with open(jobspec_path, "w") as genjob:
-        rj = job.render(**jobconf)
-        jobyaml = yaml.safe_load(rj)
-        genjob.write(rj)
+        genjob.write(job.render(**jobconf))
+
+    jobconf["phase"] = "minimize"
+    jobconf["cpu"] = str(minimize_cpus or CONFIG["jobs"]["minimize_cpus"])
+    jobconf["memory"] = "{}Mi".format(
+        minimize_memory or CONFIG["jobs"]["minimize_memory"]
+    )
+    jobconf["pods"] = 1
+    with open(os.path.join(jobdir, JOB_PHASE_SPECS["minimize"]), "w") as genjob:
+        genjob.write(job.render(**jobconf))
 
     shutil.copy(target, jobzip_path)
 
     # validate job
     with ZipFile(jobzip_path) as targetzip:
-        # Check for corpus
+        # Check for corpus; jobs seeded from the corpus store don't need one
         try:
             zip_corpus = targetzip.getinfo("corpus/")
+            if not zip_corpus.is_dir():
+                raise JobCreateError("corpus is not a directory")
         except KeyError:
-            raise JobCreateError("No corpus directory")
-
-        if not zip_corpus.is_dir():
-            raise JobCreateError("corpus is not a directory")
+            if not seed:
+                raise JobCreateError("No corpus directory")
 
         try:
             zip_target = targetzip.getinfo("target")
@@ -167,6 +324,81 @@ def lagopus_k8s_create_job(
                     "Fuzzing driver is AFL, but no afl-multicore config file named 'target.conf' found"
                 )
 
+    if seed:
+        LagopusCorpus.seed(seed, jobdir)
+
+    return jobspec_path
+
+
+def lagopus_job_place(jobyaml, placements):
+    """
+    Pin a job spec to the nodes the scheduler chose for it.
+
+    The job's single container requests whole cores with requests equal to
+    limits, so on nodes running the kubelet with the static CPU manager
+    policy it gets cores to itself. The NUMA node is a hint: the kubelet's
+    topology manager decides where the cores actually come from, and the
+    fuzzer can check the two agree.
+
+    All pods of a distributed job share one pod template, so they can only be
+    confined to the set of nodes chosen for them, and get no NUMA hint.
+
+    :param jobyaml: job spec, modified in place
+    :param placements: list of (node name, NUMA node or None) for each pod
+    """
+    nodes = sorted(set(node for node, _ in placements))
+    numa_node = placements[0][1] if len(placements) == 1 else None
+
+    podspec = jobyaml["spec"]["template"]["spec"]
+    podspec["affinity"] = {
+        "nodeAffinity": {
+            "requiredDuringSchedulingIgnoredDuringExecution": {
+                "nodeSelectorTerms": [
+                    {
+                        "matchFields": [
+                            {"key": "metadata.name", "operator": "In", "values": nodes}
+                        ]
+                    }
+                ]
+            }
+        }
+    }
+
+    if numa_node is None:
+        return
+
+    metadata = jobyaml["spec"]["template"].setdefault("metadata", {})
+    metadata.setdefault("annotations", {})["lagopus.io/numa-node"] = str(numa_node)
+    for container in podspec["containers"]:
+        container.setdefault("env", []).append(
+            {"name": "NUMA_NODE", "value": str(numa_node)}
+        )
+
+
+def lagopus_k8s_create_job(job_id, placements=None, phase="fuzz"):
+    """
+    Create a phase of a prepared job in k8s.
+
+    Every phase's k8s job is named after the job, so the previous phase's must
+    be gone first.
+
+    :param job_id: job whose directory has been set up by lagopus_job_prepare
+    :param placements: list of (node name, NUMA node or None) for each of the
+                       job's pods, or None to leave placement to k8s
+    :param phase: phase to create
+    :return: k8s API response
+    :raises JobExistsError: if the previous phase's k8s job is still there
+    """
+    jobspec_path = os.path.join(CONFIG["dirs"]["jobs"], job_id, JOB_PHASE_SPECS[phase])
+    with open(jobspec_path) as jobspec:
+        jobyaml = yaml.safe_load(jobspec)
+
+    if placements:
+        lagopus_job_place(jobyaml, placements)
+        # keep a record of exactly what was submitted
+        with open(jobspec_path, "w") as jobspec:
+            yaml.safe_dump(jobyaml, jobspec, default_flow_style=False)
+
     response = ""
     try:
         response = apis["batchv1"].create_namespaced_job(
@@ -174,7 +406,9 @@ def lagopus_k8s_create_job(
         )
     except ApiException as e:
         app.logger.error("k8s API exception: {}".format(e))
-        raise JobCreateError(message="Kubernetes API exception: {}".format(str(e)))
+        if e.status == 409:
+            raise JobExistsError("Kubernetes job {} still exists".format(job_id))
+        raise JobCreateError("Kubernetes API exception: {}".format(str(e)))
     finally:
         app.logger.error("k8s API response:\n{}".format(response))
 
@@ -229,6 +463,123 @@ def lagopus_k8s_get_nodes():
     return nodes
 
 
+K8S_QUANTITY_SUFFIXES = [
+    ("Ki", 2 ** 10),
+    ("Mi", 2 ** 20),
+    ("Gi", 2 ** 30),
+    ("Ti", 2 ** 40),
+    ("m", 1e-3),
+    ("k", 1e3),
+    ("M", 1e6),
+    ("G", 1e9),
+    ("T", 1e12),
+]
+
+
+def lagopus_k8s_quantity(quantity):
+    """
+    Convert a k8s resource quantity to a number.
+
+    :param quantity: quantity string, e.g. "3800m" or "16331872Ki"
+    :return: quantity in base units; cores for CPU, bytes for memory
+    """
+    for suffix, multiplier in K8S_QUANTITY_SUFFIXES:
+        if quantity.endswith(suffix):
+            return float(quantity[: -len(suffix)]) * multiplier
+    return float(quantity)
+
+
+def lagopus_k8s_get_capacity(namespace="default"):
+    """
+    Get the resources still free on each schedulable node, after the requests
+    of every pod that is running on it or about to.
+
+    Each node's entry has:
+
+    - cpu: cores free
+    - memory: bytes free
+    - cores: cores on the node
+    - reserved: cores held back from pods by the kubelet
+    - numa_nodes: number of NUMA nodes, from the node's numa_label
+    - pods: list of (job name or None, cores requested) for each pod on it
+
+    :param namespace: namespace jobs are created in
+    :return: tuple of (dict of the above keyed by node name, list of (job
+             name, creation time) of each job pod in the namespace that k8s
+             hasn't found a node for yet)
+    """
+    capacity = {}
+    for node in apis["corev1"].list_node().items:
+        ready = any(
+            c.type == "Ready" and c.status == "True"
+            for c in node.status.conditions or []
+        )
+        if node.spec.unschedulable or not ready:
+            continue
+        labels = node.metadata.labels or {}
+        cores = lagopus_k8s_quantity(node.status.capacity["cpu"])
+        allocatable = lagopus_k8s_quantity(node.status.allocatable["cpu"])
+        capacity[node.metadata.name] = {
+            "cpu": allocatable,
+            "memory": lagopus_k8s_quantity(node.status.allocatable["memory"]),
+            "cores": int(cores),
+            "reserved": cores - allocatable,
+            "numa_nodes": max(
+                1, int(labels.get(CONFIG["scheduler"]["numa_label"], "1"))
+            ),
+            "pods": [],
+        }
+
+    unbound = []
+    pods = apis["corev1"].list_pod_for_all_namespaces(
+        field_selector="status.phase!=Succeeded,status.phase!=Failed"
+    )
+    for pod in pods.items:
+        if not pod.spec.node_name:
+            labels = pod.metadata.labels or {}
+            if pod.metadata.namespace == namespace and "job-name" in labels:
+                unbound.append((labels["job-name"], pod.metadata.creation_timestamp))
+            continue
+        if pod.spec.node_name not in capacity:
+            continue
+        free = capacity[pod.spec.node_name]
+        podcpu = 0
+        for container in pod.spec.containers:
+            requests = (container.resources and container.resources.requests) or {}
+            for resource in ["cpu", "memory"]:
+                if resource in requests:
+                    free[resource] -= lagopus_k8s_quantity(requests[resource])
+            podcpu += lagopus_k8s_quantity(requests.get("cpu", "0"))
+        free["pods"].append(((pod.metadata.labels or {}).get("job-name"), podcpu))
+
+    return capacity, unbound
+
+
+def lagopus_k8s_get_active_jobs(namespace="default"):
+    """
+    :return: names of k8s jobs that haven't finished
+    """
+    return [
+        job.metadata.name
+        for job in apis["batchv1"].list_namespaced_job(namespace).items
+        if not job.status.completion_time and not job.status.failed
+    ]
+
+
+def lagopus_k8s_get_finished_jobs(namespace="default"):
+    """
+    :return: names of k8s jobs that have completed, or failed for good
+    """
+    return [
+        job.metadata.name
+        for job in apis["batchv1"].list_namespaced_job(namespace).items
+        if any(
+            c.type in ("Complete", "Failed") and c.status == "True"
+            for c in job.status.conditions or []
+        )
+    ]
+
+
 def lagopus_k8s_kill_job(job_id, namespace="default"):
     # FIXME: should wrap this away from k8s
     # delete job and all related resources (propagation_policy="Background")
@@ -287,6 +638,19 @@ def lagopus_db_cursor(**kwargs):
     return cnx.cursor(**kwargs)
 
 
+def lagopus_db_time(time):
+    """
+    Convert a timezone aware datetime to the naive UTC datetimes stored in the
+    database.
+
+    :param time: datetime, or None
+    :return: naive UTC datetime, or None
+    """
+    if time is not None and time.tzinfo:
+        time = time.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return time
+
+
 cnx = lagopus_db_connect()
 
 if not cnx:
@@ -300,26 +664,303 @@ class LagopusNode(object):
 
 
 class LagopusCrash(object):
-    def get(self, job_id=None):
+    def __init__(self):
+        self.codec = lagopus_blobs.BlobCodec()
+
+    def get(
+        self,
+        job_id=None,
+        type=None,
+        is_security_issue=None,
+        since=None,
+        limit=None,
+        backtraces=False,
+    ):
+        """
+        Get crashes, most recent first.
+
+        Each filter maps onto an index on the crashes table. Backtraces are
+        stored compressed in the blobs table, so they're only fetched and
+        decompressed when asked for.
+
+        :param job_id: only crashes found by this job
+        :param type: only crashes of this type
+        :param is_security_issue: only crashes that are (or aren't) likely
+                                  security issues
+        :param since: only crashes imported after this time
+        :param limit: maximum number of crashes to return
+        :param backtraces: include each crash's backtrace
+        """
         cursor = lagopus_db_cursor(dictionary=True)
         app.logger.info("Querying for crashes with job_id = '{}'".format(job_id))
-        query = "SELECT * FROM crashes WHERE job_id LIKE %(job_id)s"
-        job_id = job_id if job_id else "%"
-        cursor.execute(query, {"job_id": job_id})
+        since = lagopus_db_time(since)
+        filters = {
+            "job_id": job_id,
+            "type": type,
+            "is_security_issue": is_security_issue,
+        }
+        where = [
+            "c.{0} = %({0})s".format(k)
+            for k, v in filters.items()
+            if v is not None and v != ""
+        ]
+        if since:
+            where.append("c.create_time > %(since)s")
+        query = "SELECT c.* FROM crashes c"
+        query += " WHERE " + " AND ".join(where) if where else ""
+        query += " ORDER BY c.create_time DESC"
+        query += " LIMIT %(limit)s" if limit else ""
+        filters.update({"since": since, "limit": limit})
+        cursor.execute(query, filters)
+        result = cursor.fetchall()
+
+        if backtraces:
+            texts = lagopus_blobs.get_many(
+                lagopus_db_cursor(),
+                self.codec,
+                [c["backtrace_blob"] for c in result if c["backtrace_blob"]],
+            )
+            for c in result:
+                backtrace = texts.get(c["backtrace_blob"])
+                c["backtrace"] = backtrace.decode("utf8") if backtrace else None
+
+        return result
+
+    def search(
+        self,
+        function=None,
+        file=None,
+        q=None,
+        depth=None,
+        type=None,
+        job_id=None,
+        limit=None,
+    ):
+        """
+        Find crashes by the stack frames in their backtraces, most recent
+        first.
+
+        Frames are matched against the crash_frames index rather than the
+        backtraces themselves, so this never touches the blobs table.
+
+        :param function: only crashes with a frame in this function
+        :param file: only crashes with a frame in this file, given either as a
+                     full path or a file name
+        :param q: only crashes with a frame whose function or file matches
+                  this full text query, in boolean mode
+        :param depth: only consider the top `depth` frames of each stack that
+                      the analyzer considers interesting
+        :param type: only crashes of this type
+        :param job_id: only crashes found by this job
+        :param limit: maximum number of crashes to return
+        """
+        frame_where = []
+        if function:
+            frame_where.append("f.function = %(function)s")
+        if file:
+            frame_where.append("(f.file = %(file)s OR f.file_name = %(file)s)")
+        if q:
+            frame_where.append("MATCH (f.function, f.file) AGAINST (%(q)s IN BOOLEAN MODE)")
+        if depth:
+            frame_where.append("f.depth < %(depth)s")
+
+        query = "SELECT c.* FROM crashes c"
+        query += " WHERE (c.job_id, c.backtrace_hash) IN"
+        query += " (SELECT f.job_id, f.backtrace_hash FROM crash_frames f"
+        query += " WHERE " + " AND ".join(frame_where) + ")" if frame_where else ")"
+        query += " AND c.type = %(type)s" if type else ""
+        query += " AND c.job_id = %(job_id)s" if job_id else ""
+        query += " ORDER BY c.create_time DESC"
+        query += " LIMIT %(limit)s" if limit else ""
+
+        cursor = lagopus_db_cursor(dictionary=True)
+        cursor.execute(
+            query,
+            {
+                "function": function,
+                "file": file,
+                "q": q,
+                "depth": depth,
+                "type": type,
+                "job_id": job_id,
+                "limit": limit,
+            },
+        )
+        return cursor.fetchall()
+
+    def get_backtrace(self, job_id, backtrace_hash):
+        """
+        Get the backtrace and program output of a single crash.
+
+        :param job_id: job the crash was found by
+        :param backtrace_hash: backtrace hash of the crash
+        :return: dict with backtrace and output, or None if there's no such
+                 crash
+        """
+        cursor = lagopus_db_cursor()
+        cursor.execute(
+            "SELECT backtrace_blob, output_blob FROM crashes WHERE job_id = %(job_id)s AND backtrace_hash = %(backtrace_hash)s",
+            {"job_id": job_id, "backtrace_hash": backtrace_hash},
+        )
         result = cursor.fetchall()
+        if not result:
+            return None
+
+        blobs = dict(zip(["backtrace", "output"], result[0]))
+        texts = lagopus_blobs.get_many(
+            cursor, self.codec, [h for h in blobs.values() if h]
+        )
+        return {
+            k: texts[h].decode("utf8") if h in texts else None
+            for k, h in blobs.items()
+        }
+
+    def ingest(self, crashes, batch_key=None):
+        """
+        Store a batch of crash analyses pushed by fuzzers or triage workers.
+
+        Crashes are deduplicated within their job on their backtrace hash, the
+        same way the scanner deduplicates them, so a batch with several
+        samples of one crash stores the first, and when the job's final
+        results are imported they update what was ingested here.
+
+        The whole batch is applied in one transaction. If it has a key that's
+        already been applied, nothing is stored and the outcome of the first
+        attempt is returned, so clients can safely retry a batch they didn't
+        get an answer for.
+
+        :param crashes: list of analyses, as dicts with job_id, sample, type,
+                        is_crash, is_security_issue, backtrace, output,
+                        return_code and frames
+        :param batch_key: client chosen key identifying the batch, or None
+        :return: dict with the number of crashes accepted, the number dropped
+                 as duplicates, and whether this was a replay of a batch
+                 already applied
+        """
+        unique = {}
+        for crash in crashes:
+            backtrace = crash["backtrace"].encode("utf8")
+            signature = lagopus_crashes.backtrace_hash(backtrace)
+            unique.setdefault((crash["job_id"], signature), crash)
+        result = {
+            "accepted": len(unique),
+            "duplicates": len(crashes) - len(unique),
+            "replayed": False,
+        }
+
+        # a connection of its own, so the batch's transaction isn't mixed up
+        # with anything else on the shared one
+        batchcnx = lagopus_db_connect()
+        if not batchcnx:
+            raise ConnectionError("Couldn't connect to MySQL")
+        try:
+            batchcnx.start_transaction()
+            cursor = batchcnx.cursor()
+            create_time = datetime.datetime.utcnow()
+
+            if batch_key:
+                # a concurrent retry of the same batch waits here for this
+                # one's transaction to finish, then finds the key taken
+                try:
+                    cursor.execute(
+                        "INSERT INTO crash_batches (batch_key, accepted, duplicates, create_time) VALUES (%(batch_key)s, %(accepted)s, %(duplicates)s, %(now)s)",
+                        {
+                            "batch_key": batch_key,
+                            "accepted": result["accepted"],
+                            "duplicates": result["duplicates"],
+                            "now": create_time,
+                        },
+                    )
+                except mysql.connector.IntegrityError as e:
+                    if e.errno != errorcode.ER_DUP_ENTRY:
+                        raise
+                    batchcnx.rollback()
+                    cursor.execute(
+                        "SELECT accepted, duplicates FROM crash_batches WHERE batch_key = %(batch_key)s",
+                        {"batch_key": batch_key},
+                    )
+                    accepted, duplicates = cursor.fetchall()[0]
+                    return {
+                        "accepted": accepted,
+                        "duplicates": duplicates,
+                        "replayed": True,
+                    }
+
+            self.codec.refresh(cursor)
+            jobs = {}
+            for (job_id, _), crash in unique.items():
+                jobs.setdefault(job_id, []).append(crash)
+
+            for job_id, job_crashes in jobs.items():
+                jobtime = lagopus_crashes.job_time(cursor, job_id, create_time)
+                analyses = [
+                    (
+                        c["sample"],
+                        c["type"],
+                        c["is_crash"],
+                        c["is_security_issue"],
+                        c["backtrace"],
+                        c.get("output"),
+                        c.get("return_code"),
+                    )
+                    for c in job_crashes
+                ]
+                sample_frames = {
+                    c["sample"]: [
+                        (
+                            f["thread"],
+                            f["frame"],
+                            f["depth"],
+                            f.get("function"),
+                            f.get("file"),
+                            f.get("line"),
+                            f.get("module"),
+                        )
+                        for f in c.get("frames") or []
+                    ]
+                    for c in job_crashes
+                }
+                lagopus_crashes.export(
+                    cursor,
+                    self.codec,
+                    *lagopus_crashes.crash_rows(
+                        job_id, jobtime, create_time, analyses, sample_frames
+                    ),
+                )
+
+            batchcnx.commit()
+        except Exception:
+            batchcnx.rollback()
+            raise
+        finally:
+            batchcnx.close()
+
         return result
 
+    def expire_batches(self, cursor):
+        """
+        Forget the keys of batches applied longer ago than anyone would retry
+        them.
+
+        :param cursor: database cursor
+        """
+        cursor.execute(
+            "DELETE FROM crash_batches WHERE create_time < %(before)s",
+            {
+                "before": datetime.datetime.utcnow()
+                - datetime.timedelta(seconds=CONFIG["crashes"]["batch_key_ttl"])
+            },
+        )
+
     def get_sample(self, job_id, sample_name):
         jobdir = CONFIG["dirs"]["jobs"] + "/" + job_id
         jobresult_file = jobdir + "/jobresults.zip"
         if not os.path.exists(jobresult_file):
-            app.logger.warning(
-                "Job '{}': No job results file '{}'".format(job_id, jobresult_file)
-            )
-            return None
+            # the job may still be running, and have streamed it
+            return self.get_streamed_sample(job_id, sample_name)
 
         zf = ZipFile(jobresult_file)
-        samples = list(filter(lambda x: sample_name in x, zf.namelist()))
+        samples = [n for n in zf.namelist() if os.path.basename(n) == sample_name]
         if not samples:
             app.logger.warning(
                 "Job '{}': Sample '{}' not found".format(job_id, sample_name)
@@ -332,6 +973,252 @@ class LagopusCrash(object):
 
         return extractpath
 
+    def get_streamed_sample(self, job_id, sample_name):
+        """
+        Find a crash sample among the files a job has streamed.
+
+        AFL samples are named "<instance>:<file>", like afl-collect names
+        them, and were streamed from the instance's crashes or hangs
+        directory; libFuzzer samples are streamed under their own name.
+
+        :return: path to a copy of the sample, or None if it hasn't been
+                 streamed
+        """
+        instance, sep, name = sample_name.partition(":")
+        if sep and not sample_name.startswith("id:"):
+            wanted = [
+                "results/{}/{}/{}".format(instance, subdir, name)
+                for subdir in ("crashes", "hangs")
+            ]
+        else:
+            wanted = [sample_name]
+
+        crashes = LagopusJob.get_artifacts(job_id, "crash")
+        crashes += LagopusJob.get_artifacts(job_id, "hang")
+        streamed = {a["path"] for a in crashes}
+        paths = [p for p in wanted if p in streamed]
+        data = LagopusJob.get_artifact(job_id, paths[0]) if paths else None
+        if data is None:
+            app.logger.warning(
+                "Job '{}': Sample '{}' not found".format(job_id, sample_name)
+            )
+            return None
+
+        extractpath = os.path.join("/tmp", job_id, os.path.basename(paths[0]))
+        os.makedirs(os.path.dirname(extractpath), exist_ok=True)
+        with open(extractpath, "wb") as f:
+            f.write(data)
+        return extractpath
+
+
+class LagopusScan(object):
+    """
+    Read-only access to the scanner's ledger of imported job results.
+    """
+
+    # seconds between a results file landing and its import finishing
+    LAG = "TIMESTAMPDIFF(MICROSECOND, results_mtime, scan_finish) / 1000000"
+
+    def get(self, job_id=None):
+        cursor = lagopus_db_cursor(dictionary=True)
+        query = "SELECT *, {} AS lag FROM scans WHERE job_id LIKE %(job_id)s".format(
+            self.LAG
+        )
+        job_id = job_id if job_id else "%"
+        cursor.execute(query, {"job_id": job_id})
+        result = cursor.fetchall()
+        return result
+
+    def summary(self, since=None):
+        """
+        Aggregate ingestion metrics per scan status.
+
+        :param since: only consider scans started after this time
+        """
+        since = lagopus_db_time(since)
+        cursor = lagopus_db_cursor(dictionary=True)
+        query = "SELECT status, COUNT(*) AS scans, SUM(rows_imported) AS rows_imported"
+        query += ", AVG({0}) AS mean_lag, MAX({0}) AS max_lag".format(self.LAG)
+        query += " FROM scans"
+        query += " WHERE scan_start > %(since)s" if since else ""
+        query += " GROUP BY status"
+        cursor.execute(query, {"since": since})
+        result = cursor.fetchall()
+        return result
+
+    def throughput(self):
+        """
+        Fetch the scanner's current backlog and throughput.
+
+        :return: scanner statistics, or None if the scanner isn't reachable
+        """
+        url = "{}/stats".format(CONFIG["scanner"]["notify"])
+        try:
+            response = requests.get(url, timeout=5)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            app.logger.warning("Couldn't get scanner stats: {}".format(e))
+            return None
+
+        return response.json()
+
+
+class LagopusQueue(object):
+    """
+    Singleton class for the queue of jobs waiting for cluster resources.
+    """
+
+    def enqueue(self, job_id, user, priority, cpus, memory, pods=1):
+        cursor = lagopus_db_cursor()
+        cursor.execute(
+            "INSERT INTO job_queue (job_id, user, priority, cpus, pods, memory, state, enqueue_time) VALUES (%(job_id)s, %(user)s, %(priority)s, %(cpus)s, %(pods)s, %(memory)s, 'queued', %(now)s)",
+            {
+                "job_id": job_id,
+                "user": user,
+                "priority": priority,
+                "cpus": cpus,
+                "pods": pods,
+                "memory": memory,
+                "now": datetime.datetime.utcnow(),
+            },
+        )
+        cursor.close()
+        lagopus_scheduler_wake.set()
+
+    def cancel(self, job_id):
+        """
+        Remove a job from the queue, if it hasn't been released yet.
+
+        :return: whether the job was cancelled
+        """
+        cursor = lagopus_db_cursor()
+        cursor.execute(
+            "UPDATE job_queue SET state = 'cancelled' WHERE job_id = %(job_id)s AND state = 'queued'",
+            {"job_id": job_id},
+        )
+        cancelled = cursor.rowcount > 0
+        if cancelled:
+            cursor.execute(
+                "UPDATE jobs SET status = 'Cancelled' WHERE job_id = %(job_id)s",
+                {"job_id": job_id},
+            )
+        cursor.close()
+        return cancelled
+
+    def get(self, job_id=None):
+        """
+        Get queued jobs, highest priority and longest waiting first.
+
+        :param job_id: only this job, in any state
+        """
+        cursor = lagopus_db_cursor(dictionary=True)
+        query = "SELECT *, TIMESTAMPDIFF(MICROSECOND, enqueue_time, COALESCE(release_time, UTC_TIMESTAMP(6))) / 1e6 AS wait FROM job_queue"
+        if job_id:
+            query += " WHERE job_id = %(job_id)s"
+        else:
+            query += " WHERE state = 'queued' ORDER BY priority DESC, enqueue_time"
+        cursor.execute(query, {"job_id": job_id})
+        result = cursor.fetchall()
+        if job_id:
+            return result[0] if result else None
+        return result
+
+    def stats(self, cursor=None):
+        """
+        Summarize the queue: its depth, how long the jobs in it have been
+        waiting, and how long jobs released in the last hour waited.
+
+        :param cursor: dictionary cursor to use instead of the shared
+                       connection, for callers on other threads
+        """
+        cursor = cursor or lagopus_db_cursor(dictionary=True)
+        cursor.execute(
+            "SELECT COUNT(*) AS depth, COALESCE(SUM(cpus * pods), 0) AS cpus, COALESCE(SUM(memory * pods), 0) AS memory, MAX(TIMESTAMPDIFF(MICROSECOND, enqueue_time, UTC_TIMESTAMP(6))) / 1e6 AS max_wait FROM job_queue WHERE state = 'queued'"
+        )
+        stats = cursor.fetchall()[0]
+        cursor.execute(
+            "SELECT COUNT(*) AS released, AVG(TIMESTAMPDIFF(MICROSECOND, enqueue_time, release_time)) / 1e6 AS mean_wait FROM job_queue WHERE state = 'released' AND release_time > UTC_TIMESTAMP(6) - INTERVAL 1 HOUR"
+        )
+        stats.update(cursor.fetchall()[0])
+        cursor.execute(
+            "SELECT user, COUNT(*) AS depth, SUM(cpus * pods) AS cpus FROM job_queue WHERE state = 'queued' GROUP BY user"
+        )
+        stats["users"] = cursor.fetchall()
+        return stats
+
+
+class LagopusPlacement(object):
+    """
+    Singleton class for where the scheduler placed jobs.
+    """
+
+    def get(self, job_id):
+        """
+        :return: placement of each of the job's pods, for each phase
+        """
+        cursor = lagopus_db_cursor(dictionary=True)
+        cursor.execute(
+            "SELECT * FROM job_placements WHERE job_id = %(job_id)s ORDER BY phase, pod",
+            {"job_id": job_id},
+        )
+        return cursor.fetchall()
+
+    def stats(self, since=None):
+        """
+        Compare the fuzzing throughput of jobs kept within one NUMA node with
+        jobs whose cores span several.
+
+        Throughput is each job's mean execs/sec over its lifetime, from the
+        job metrics in InfluxDB, divided by its cores. Each pod of a
+        distributed job reports its own metrics, so for those this is per pod
+        too. Only where the fuzz phase was placed counts.
+
+        :param since: only jobs placed after this time
+        """
+        since = lagopus_db_time(since)
+        cursor = lagopus_db_cursor(dictionary=True)
+        query = "SELECT job_id, MAX(numa_node) AS numa_node, MAX(numa_nodes) AS numa_nodes, MAX(cpus) AS cpus, COUNT(*) AS pods FROM job_placements WHERE phase = 'fuzz'"
+        query += " AND place_time > %(since)s" if since else ""
+        query += " GROUP BY job_id"
+        cursor.execute(query, {"since": since})
+        placements = cursor.fetchall()
+
+        query = "SELECT MEAN(execs_per_sec) FROM jobs"
+        query += " WHERE time > '{}'".format(since.isoformat() + "Z") if since else ""
+        query += " GROUP BY job_id"
+        try:
+            data = InfluxDBClient(database="lagopus").query(query)
+        except InfluxDBClientError as e:
+            app.logger.error("InfluxDB error: {}".format(e))
+            return []
+        eps = {}
+        for (_, tags), points in data.items():
+            for point in points:
+                eps[tags["job_id"]] = point["mean"]
+
+        groups = {}
+        for p in placements:
+            if p["job_id"] not in eps or not p["cpus"]:
+                continue
+            if p["pods"] > 1:
+                placement = "distributed"
+            elif p["numa_nodes"] == 1:
+                placement = "single"
+            elif p["numa_node"] is None:
+                placement = "spanning"
+            else:
+                placement = "aligned"
+            groups.setdefault(placement, []).append(eps[p["job_id"]] / p["cpus"])
+
+        return [
+            {
+                "placement": placement,
+                "jobs": len(values),
+                "execs_per_sec_per_core": sum(values) / len(values),
+            }
+            for placement, values in sorted(groups.items())
+        ]
+
 
 class LagopusJob(object):
     """
@@ -350,15 +1237,17 @@ class LagopusJob(object):
         # ...job status, etc
         k8s_jobs = lagopus_k8s_get_jobs(job_id)
 
-        # Set all incomplete job statuses to "Unknown"
+        # Set all incomplete job statuses to "Unknown"; jobs that never made it
+        # into k8s keep theirs
         cursor.execute(
-            "UPDATE jobs SET status = %(status)s WHERE status <> 'Complete'",
+            "UPDATE jobs SET status = %(status)s WHERE status NOT IN ('Complete', 'Queued', 'Cancelled', 'Failed')",
             {"status": "Unknown"},
         )
-        # Update with statuses from k8s
+        # Update with statuses from k8s; a finished fuzz phase isn't the end of
+        # the job, which is about to be queued for its minimize phase
         for job in k8s_jobs:
             cursor.execute(
-                "UPDATE jobs SET status = %(status)s WHERE job_id = %(job_id)s",
+                "UPDATE jobs SET status = %(status)s WHERE job_id = %(job_id)s AND NOT (phase = 'fuzz' AND %(status)s = 'Complete')",
                 {"status": job["status"], "job_id": job["name"]},
             )
 
@@ -377,12 +1266,39 @@ class LagopusJob(object):
         else:
             return result
 
-    def create(self, job_name, driver, target, deadline, cpus, memory):
+    def create(
+        self,
+        job_name,
+        driver,
+        target,
+        deadline,
+        cpus,
+        memory,
+        pods=1,
+        minimize_cpus=None,
+        minimize_memory=None,
+        corpus=None,
+        user="default",
+        priority=0,
+        plateau=None,
+    ):
         # generate unique job id
         now = datetime.datetime.now()
         job_id = lagopus_job_id(job_name, driver, now)
 
-        status = "Created"
+        # jobs build up the corpus named after them unless told otherwise
+        corpus = secure_filename(corpus or job_name)
+        if not corpus:
+            raise JobCreateError("Invalid corpus name")
+        seed = LagopusCorpus.get(corpus)
+
+        if plateau is not None and plateau not in CONFIG["plateau"]["policies"]:
+            raise JobCreateError("No plateau policy '{}'".format(plateau))
+
+        minimize_cpus = minimize_cpus or CONFIG["jobs"]["minimize_cpus"]
+        minimize_memory = minimize_memory or CONFIG["jobs"]["minimize_memory"]
+
+        status = "Queued"
         create_timestamp = now.strftime("%Y-%m-%d %H-%M-%S")
 
         filename = secure_filename(job_id + ".zip")
@@ -390,10 +1306,19 @@ class LagopusJob(object):
         with open(savepath, "wb") as tgt:
             tgt.write(base64.b64decode(target))
 
-        # create in k8s
+        # set up the job; the scheduler creates it in k8s once it fits
         try:
-            response = lagopus_k8s_create_job(
-                job_id, driver, savepath, cpus, memory, deadline
+            lagopus_job_prepare(
+                job_id,
+                driver,
+                savepath,
+                cpus,
+                memory,
+                deadline,
+                pods,
+                minimize_cpus,
+                minimize_memory,
+                seed,
             )
         except JobCreateError as e:
             app.logger.warning("Failed to create job: {}".format(str(e)))
@@ -402,22 +1327,94 @@ class LagopusJob(object):
         # insert new job into db
         cursor = lagopus_db_cursor()
         cursor.execute(
-            "INSERT INTO jobs (job_id, status, driver, target, cpus, memory, deadline, create_time) VALUES ('{}', '{}', '{}', '{}', {}, {}, {}, '{}')".format(
-                job_id,
-                status,
-                driver,
-                savepath,
-                cpus,
-                memory,
-                deadline,
-                create_timestamp,
-            )
+            "INSERT INTO jobs (job_id, status, driver, target, cpus, pods, memory, deadline, create_time, phase, phase_time, minimize_cpus, minimize_memory, corpus, corpus_seed, plateau_policy) VALUES (%(job_id)s, %(status)s, %(driver)s, %(target)s, %(cpus)s, %(pods)s, %(memory)s, %(deadline)s, %(create_time)s, 'fuzz', %(phase_time)s, %(minimize_cpus)s, %(minimize_memory)s, %(corpus)s, %(corpus_seed)s, %(plateau_policy)s)",
+            {
+                "job_id": job_id,
+                "status": status,
+                "driver": driver,
+                "target": savepath,
+                "cpus": cpus,
+                "pods": pods,
+                "memory": memory,
+                "deadline": deadline,
+                "create_time": create_timestamp,
+                "phase_time": datetime.datetime.utcnow(),
+                "minimize_cpus": minimize_cpus,
+                "minimize_memory": minimize_memory,
+                "corpus": corpus,
+                "corpus_seed": seed["version"] if seed else None,
+                "plateau_policy": plateau,
+            },
         )
         cursor.close()
 
+        LagopusQueue.enqueue(job_id, user, priority, cpus, memory, pods)
+
         return self.get(job_id)
 
+    def finish_phase(self, job_id, phase):
+        """
+        Record that a pod of a job has finished a phase.
+
+        :param phase: phase the pod finished
+        :return: the job's phase afterwards, or None if there's no such job
+        """
+        cursor = lagopus_db_cursor(dictionary=True)
+        if phase == "fuzz":
+            lagopus_job_advance(cursor, job_id)
+        elif phase == "minimize":
+            cursor.execute(
+                "UPDATE jobs SET phase = 'done', phase_time = %(now)s WHERE job_id = %(job_id)s AND phase = 'minimize'",
+                {"job_id": job_id, "now": datetime.datetime.utcnow()},
+            )
+            # the scheduler puts the job's corpus into the store
+            lagopus_scheduler_wake.set()
+
+        cursor.execute(
+            "SELECT job_id, phase, phase_time FROM jobs WHERE job_id = %(job_id)s",
+            {"job_id": job_id},
+        )
+        result = cursor.fetchall()
+        return result[0] if result else None
+
+    def stop(self, job_id, reason, cursor=None):
+        """
+        Stop a job's fuzz phase early, as if its deadline had passed. Its pods
+        see the stop file in the job directory, stream what they have and
+        finish, and the job moves on to its minimize phase.
+
+        Raises OSError if the stop file can't be written, in which case the
+        job isn't recorded as stopped.
+
+        :param reason: why the job was stopped, recorded on the job
+        :param cursor: database cursor
+        :return: whether the job was fuzzing and hadn't been stopped already
+        """
+        cursor = cursor or lagopus_db_cursor()
+        cursor.execute(
+            "UPDATE jobs SET stop_time = %(now)s, stop_reason = %(reason)s WHERE job_id = %(job_id)s AND phase = 'fuzz' AND status NOT IN ('Queued', 'Cancelled', 'Failed') AND stop_time IS NULL",
+            {"job_id": job_id, "reason": reason, "now": datetime.datetime.utcnow()},
+        )
+        if cursor.rowcount == 0:
+            return False
+
+        app.logger.info("Stopping job {}: {}".format(job_id, reason))
+        try:
+            with open(os.path.join(CONFIG["dirs"]["jobs"], job_id, "stop"), "w") as f:
+                f.write(reason + "\n")
+        except OSError:
+            # the pods never see the stop, so the job mustn't look stopped
+            cursor.execute(
+                "UPDATE jobs SET stop_time = NULL, stop_reason = NULL WHERE job_id = %(job_id)s",
+                {"job_id": job_id},
+            )
+            raise
+        return True
+
     def kill(self, job_id):
+        if LagopusQueue.cancel(job_id):
+            return True
+
         job = lagopus_k8s_get_jobs(job_id)
         if not job:
             app.logger.warning("Job not found ({})".format(job_id))
@@ -437,6 +1434,11 @@ class LagopusJob(object):
         query = "select MEAN(*) from jobs"
         query += " where job_id = '{}'".format(job_id) if job_id else ""
         query += " AND time > '{}'".format(since) if since else ""
+        if job_id:
+            # each pod of a distributed job reports its own stats, tagged with
+            # its hostname; add them up so the job reads as one
+            query += " GROUP BY time(1m), host fill(none)"
+            query = "select SUM(*) from ({})".format(query)
         # TODO: revisit this; this is a bit of a hack. Without downsampling
         # like this, 10 hours or so the amount of metrics data will be in the
         # mb range.  The web UI especially doesn't like this, and it gets
@@ -460,8 +1462,72 @@ class LagopusJob(object):
             app.logger.error("InfluxDB error: {}".format(e))
             return []
 
+        # SUM() prefixes the field names again; keep the names MEAN() gives
+        for point in results:
+            for key in [k for k in point if k.startswith("sum_")]:
+                point[key[len("sum_") :]] = point.pop(key)
+
         return results
 
+    def get_instance_stats(self, job_id):
+        """
+        Latest stats of each of a job's fuzzer instances, with how they
+        compare to each other. Instances that are dead, stuck, or much slower
+        than the rest are flagged.
+
+        :return: dict of the instances, and of the total, min, max, median and
+                 skew of their execs/sec; skew is (max - min) / mean, over the
+                 instances that are alive
+        """
+        query = "SELECT LAST(*) FROM jobs_instances WHERE job_id = '{}' AND time > now() - {}s GROUP BY pod, instance".format(
+            job_id, CONFIG["instances"]["window"]
+        )
+        try:
+            data = InfluxDBClient(database="lagopus").query(query)
+        except InfluxDBClientError as e:
+            app.logger.error("InfluxDB error: {}".format(e))
+            data = {}
+
+        instances = []
+        for (_, tags), points in data.items():
+            for point in points:
+                # LAST() prefixes the field names
+                instance = {
+                    k[len("last_") :]: v
+                    for k, v in point.items()
+                    if k.startswith("last_")
+                }
+                instance.update(pod=int(tags["pod"]), instance=tags["instance"])
+                instances.append(instance)
+        instances.sort(key=lambda i: (i["pod"], i["instance"]))
+
+        alive = [i for i in instances if i.get("alive")]
+        eps = [i.get("execs_per_sec") or 0 for i in alive]
+        median = statistics.median(eps) if eps else 0
+        mean = statistics.mean(eps) if eps else 0
+        slow = CONFIG["instances"]["slow"] * median
+        for instance in instances:
+            flags = []
+            if not instance.get("alive"):
+                flags.append("dead")
+            elif (instance.get("execs_per_sec") or 0) < slow:
+                flags.append("slow")
+            if (instance.get("since_update") or 0) > CONFIG["instances"]["stale"]:
+                flags.append("stuck")
+            instance["flags"] = flags
+
+        return {
+            "instances": instances,
+            "alive": len(alive),
+            "flagged": len([i for i in instances if i["flags"]]),
+            "execs": sum(i.get("execs") or 0 for i in instances),
+            "execs_per_sec": sum(eps),
+            "execs_per_sec_min": min(eps) if eps else 0,
+            "execs_per_sec_max": max(eps) if eps else 0,
+            "execs_per_sec_median": median,
+            "skew": (max(eps) - min(eps)) / mean if mean else 0,
+        }
+
     def get_result(self, job_id):
         jobdir = CONFIG["dirs"]["jobs"] + "/" + job_id
         jobresult_file = jobdir + "/jobresults.zip"
@@ -473,26 +1539,955 @@ class LagopusJob(object):
 
         return jobresult_file
 
+    def get_artifacts(self, job_id, kind=None):
+        """
+        Files a job's pods have streamed to its job directory so far, as
+        ingested by the scanner.
 
-LagopusJob = LagopusJob()
-LagopusCrash = LagopusCrash()
-LagopusNode = LagopusNode()
-
-# Web
-
-
-@app.after_request
-def apply_caching(response):
-    """
-    Sometimes firefox doesn't allow inline scripts? What's up with that?
-    """
-    response.headers["Content-Security-Policy"] = "script-src 'unsafe-inline' 'self'"
-    return response
+        :param kind: only return artifacts of this kind
+        :return: list of artifacts
+        """
+        cursor = lagopus_db_cursor(dictionary=True)
+        query = "SELECT * FROM job_artifacts WHERE job_id = %(job_id)s"
+        query += " AND kind = %(kind)s" if kind else ""
+        query += " ORDER BY stream_time, path"
+        cursor.execute(query, {"job_id": job_id, "kind": kind})
+        return cursor.fetchall()
+
+    def get_artifact(self, job_id, path):
+        """
+        Read the latest streamed copy of a file from a job's stream.
+
+        :param path: path of the artifact
+        :return: contents of the artifact, or None if there's no such artifact
+        """
+        cursor = lagopus_db_cursor(dictionary=True)
+        cursor.execute(
+            "SELECT sha1, segment FROM job_artifacts WHERE job_id = %(job_id)s AND path = %(path)s",
+            {"job_id": job_id, "path": path},
+        )
+        result = cursor.fetchall()
+        if not result:
+            return None
 
+        segment = os.path.join(CONFIG["dirs"]["jobs"], job_id, result[0]["segment"])
+        try:
+            with lagopus_segment.Segment(segment) as seg:
+                data = seg.get(result[0]["sha1"])
+                return bytes(data) if data is not None else None
+        except (FileNotFoundError, ValueError) as e:
+            app.logger.warning(
+                "Job '{}': Can't read artifact '{}': {}".format(job_id, path, e)
+            )
+            return None
 
-## API
+    def add_span(self, job_id, span):
+        """
+        Record a step of one of a job's pods on the job's timeline. Recording
+        the same span again replaces it.
 
-app.config["UPLOAD_FOLDER"] = tempfile.mkdtemp()
+        :param span: dict of the span's phase, pod, name, start_time and
+                     end_time as UNIX times, and optionally cpu_seconds,
+                     memory_peak and detail
+        :return: whether there's such a job
+        """
+        cursor = lagopus_db_cursor()
+        cursor.execute(
+            "SELECT job_id FROM jobs WHERE job_id = %(job_id)s", {"job_id": job_id}
+        )
+        if not cursor.fetchall():
+            return False
+
+        row = dict(
+            span,
+            job_id=job_id,
+            start_time=datetime.datetime.utcfromtimestamp(span["start_time"]),
+            end_time=datetime.datetime.utcfromtimestamp(span["end_time"]),
+            cpu_seconds=span.get("cpu_seconds"),
+            memory_peak=span.get("memory_peak"),
+            detail=(span.get("detail") or "")[:255] or None,
+        )
+        cursor.execute(
+            "INSERT INTO job_spans (job_id, phase, pod, name, start_time, end_time, cpu_seconds, memory_peak, detail) VALUES (%(job_id)s, %(phase)s, %(pod)s, %(name)s, %(start_time)s, %(end_time)s, %(cpu_seconds)s, %(memory_peak)s, %(detail)s) AS new ON DUPLICATE KEY UPDATE end_time = new.end_time, cpu_seconds = new.cpu_seconds, memory_peak = new.memory_peak, detail = new.detail",
+            row,
+        )
+        return True
+
+    def get_timeline(self, job_id):
+        """
+        :return: the steps of a job's pods recorded so far, oldest first
+        """
+        cursor = lagopus_db_cursor(dictionary=True)
+        cursor.execute(
+            "SELECT * FROM job_spans WHERE job_id = %(job_id)s ORDER BY start_time, pod",
+            {"job_id": job_id},
+        )
+        return cursor.fetchall()
+
+    def notify_result(self, job_id):
+        """
+        Tell the scanner that a job has finished uploading its results, so it
+        can import them without waiting for its next sweep.
+
+        :return: whether the scanner accepted the notification
+        """
+        url = "{}/jobs/{}".format(CONFIG["scanner"]["notify"], job_id)
+        try:
+            response = requests.post(url, timeout=5)
+        except ConnectionError as e:
+            app.logger.warning("Couldn't notify scanner: {}".format(e))
+            return False
+
+        if response.status_code != 202:
+            app.logger.warning(
+                "Scanner rejected notification for job {}: {}".format(
+                    job_id, response.status_code
+                )
+            )
+            return False
+
+        return True
+
+
+def lagopus_job_advance(cursor, job_id, finished=False):
+    """
+    Move a job from its fuzz phase to its minimize phase once every one of
+    its pods has finished streaming its output, or once its k8s job has
+    finished without them, e.g. because pods were killed; whatever they
+    streamed before then is minimized.
+
+    The fuzz phase's k8s job is deleted, since the minimize phase's takes its
+    name, and the job goes back into the queue with the minimize phase's
+    resources.
+
+    :param cursor: dictionary cursor
+    :param job_id: job to advance
+    :param finished: whether the fuzz phase's k8s job has finished
+    :return: whether the job is past its fuzz phase
+    """
+    cursor.execute(
+        "SELECT phase, pods, minimize_cpus, minimize_memory FROM jobs WHERE job_id = %(job_id)s",
+        {"job_id": job_id},
+    )
+    result = cursor.fetchall()
+    if not result:
+        return False
+    job = result[0]
+    if job["phase"] != "fuzz":
+        return True
+
+    jobdir = os.path.join(CONFIG["dirs"]["jobs"], job_id)
+    done = len(glob.glob(os.path.join(jobdir, "stream", "pod-*", "done")))
+    if done < job["pods"] and not finished:
+        return False
+
+    now = datetime.datetime.utcnow()
+    cursor.execute(
+        "UPDATE jobs SET phase = 'minimize', phase_time = %(now)s, status = 'Queued' WHERE job_id = %(job_id)s AND phase = 'fuzz'",
+        {"job_id": job_id, "now": now},
+    )
+    if cursor.rowcount == 0:
+        return True
+
+    app.logger.info("Job {} finished fuzzing, queueing minimize phase".format(job_id))
+    lagopus_k8s_kill_job(job_id)
+    cursor.execute(
+        "UPDATE job_queue SET phase = 'minimize', cpus = %(cpus)s, pods = 1, memory = %(memory)s, state = 'queued', enqueue_time = %(now)s, release_time = NULL, error = NULL WHERE job_id = %(job_id)s",
+        {
+            "job_id": job_id,
+            "cpus": job["minimize_cpus"] or CONFIG["jobs"]["minimize_cpus"],
+            "memory": job["minimize_memory"] or CONFIG["jobs"]["minimize_memory"],
+            "now": now,
+        },
+    )
+    lagopus_scheduler_wake.set()
+    return True
+
+
+def lagopus_job_plateau(job_id, policy):
+    """
+    Check whether a fuzzing job's coverage has stopped growing.
+
+    Stats of all of the job's pods are added together. For libFuzzer jobs,
+    total_paths is the coverage libFuzzer reports, and nothing is pending.
+
+    :param policy: plateau policy, from CONFIG["plateau"]["policies"]
+    :return: why the job has plateaued, or None if it hasn't, or it hasn't
+             reported stats for a whole window yet
+    """
+    now = datetime.datetime.utcnow()
+    start = now - datetime.timedelta(seconds=policy["window"])
+    # and a few minutes before the window, for the paths it started with
+    since = start - datetime.timedelta(minutes=5)
+    points = LagopusJob.get_stats(job_id, since.strftime("%Y-%m-%dT%H:%M:%SZ"))
+
+    start = start.strftime("%Y-%m-%dT%H:%M:%SZ")
+    before = [p.get("mean_total_paths") or 0 for p in points if p["time"] < start]
+    during = [p for p in points if p["time"] >= start]
+    if not before or not during:
+        return None
+
+    paths = max(p.get("mean_total_paths") or 0 for p in during)
+    new_paths = max(0, paths - max(before))
+    pending_fav = during[-1].get("mean_pending_fav") or 0
+    if new_paths > policy["max_new_paths"]:
+        return None
+    max_pending_fav = policy["max_pending_fav"]
+    if max_pending_fav is not None and pending_fav > max_pending_fav:
+        return None
+
+    return "{} new paths in the last {} minutes, {} in total, {} favored paths pending".format(
+        int(new_paths), policy["window"] // 60, int(paths), int(pending_fav)
+    )
+
+
+def lagopus_plateau_sweep(cursor):
+    """
+    Stop fuzzing jobs whose coverage has plateaued under their plateau
+    policy, so their cores go to queued jobs.
+
+    :param cursor: dictionary cursor
+    """
+    cursor.execute(
+        "SELECT job_id, plateau_policy FROM jobs WHERE phase = 'fuzz' AND status NOT IN ('Queued', 'Cancelled', 'Failed') AND stop_time IS NULL"
+    )
+    for job in cursor.fetchall():
+        name = job["plateau_policy"] or CONFIG["plateau"]["default"]
+        policy = CONFIG["plateau"]["policies"].get(name)
+        if not policy:
+            continue
+        try:
+            reason = lagopus_job_plateau(job["job_id"], policy)
+        except ConnectionError as e:
+            app.logger.warning("Could not connect to InfluxDB: {}".format(e))
+            return
+        if reason:
+            reason = "Coverage plateaued under the {} policy: {}".format(name, reason)
+            try:
+                LagopusJob.stop(job["job_id"], reason, cursor)
+            except OSError as e:
+                app.logger.warning("Could not stop job {}: {}".format(job["job_id"], e))
+
+
+class LagopusCorpus(object):
+    """
+    Singleton class for the corpus store.
+
+    Corpora are stored on the shared volume in packed segments, content
+    addressed, so an input is stored once however many versions of a corpus
+    have it:
+
+      corpora/segments/<job ID>.{seg,idx}  inputs first stored from that job
+      corpora/<name>/<version>.json        manifest listing the inputs and the
+                                           segments they're in
+      corpora/<name>/<version>.cov.gz      coverage of each input, as cmin.py
+                                           records it
+      corpora/<name>/latest                latest version
+
+    Corpora are named after the jobs that build them up. When a job finishes,
+    its minimized corpus is merged with the latest version of its corpus into
+    a new version, named after the job. New jobs are seeded with the latest
+    version.
+    """
+
+    def path(self, *parts):
+        return os.path.join(CONFIG["dirs"]["corpora"], *parts)
+
+    def segment(self, name):
+        """
+        Open a segment of the store. Segments are opened as needed and closed
+        once used, so a long running server doesn't pile up open files and
+        mappings as the store grows.
+        """
+        return lagopus_segment.Segment(self.path("segments", name))
+
+    def locate(self, manifest):
+        """
+        Find the inputs of a version in its segments, reading the index of each
+        segment once.
+
+        :return: dict mapping SHA-1 to tuple of (segment, size) of every input
+                 that could be found
+        """
+        wanted = set(manifest["inputs"])
+        located = {}
+        for name in manifest["segments"]:
+            try:
+                with self.segment(name) as segment:
+                    for digest, size in segment.sizes().items():
+                        if digest in wanted:
+                            located.setdefault(digest, (name, size))
+            except (OSError, ValueError) as e:
+                app.logger.warning(
+                    "Corpus {} version {}: can't read segment {}: {}".format(
+                        manifest["name"], manifest["version"], name, e
+                    )
+                )
+        return located
+
+    def names(self):
+        """
+        :return: names of the corpora in the store
+        """
+        try:
+            with os.scandir(self.path()) as entries:
+                return sorted(
+                    e.name for e in entries if e.is_dir() and e.name != "segments"
+                )
+        except FileNotFoundError:
+            return []
+
+    def get(self, name, version=None):
+        """
+        :param version: version to get, or None for the latest
+        :return: manifest of the corpus, or None if there's no such version
+        """
+        try:
+            if not version:
+                with open(self.path(name, "latest")) as latest:
+                    version = latest.read().strip()
+            with open(self.path(name, version + ".json")) as manifest:
+                return json.load(manifest)
+        except FileNotFoundError:
+            return None
+
+    def versions(self, name):
+        """
+        :return: manifests of every version of a corpus, oldest first
+        """
+        try:
+            with os.scandir(self.path(name)) as entries:
+                versions = [
+                    e.name[: -len(".json")]
+                    for e in entries
+                    if e.name.endswith(".json")
+                ]
+        except FileNotFoundError:
+            return []
+        manifests = [self.get(name, version) for version in versions]
+        return sorted(manifests, key=lambda m: m["create_time"])
+
+    def signatures(self, name, version):
+        """
+        :return: tuple of (target SHA-1, dict of input SHA-1 to features)
+        """
+        return lagopus_corpus_signatures_load(self.path(name, version + ".cov.gz"))
+
+    def inputs(self, manifest):
+        """
+        Contents of a version's inputs, read a segment at a time so that each
+        segment is read sequentially.
+
+        :return: generator of (SHA-1, contents)
+        """
+        remaining = set(manifest["inputs"])
+        for name in manifest["segments"]:
+            with self.segment(name) as segment:
+                for digest, data in segment.items():
+                    if digest in remaining:
+                        remaining.discard(digest)
+                        yield digest, data
+
+    def seed(self, manifest, jobdir):
+        """
+        Put a version of a corpus into a job directory for its pods to start
+        from, as the seed segment and seed-coverage.jsonl.gz.
+        """
+        lagopus_segment.pack(self.inputs(manifest), os.path.join(jobdir, "seed"))
+
+        cov = self.path(manifest["name"], manifest["version"] + ".cov.gz")
+        if os.path.exists(cov):
+            shutil.copyfile(cov, os.path.join(jobdir, "seed-coverage.jsonl.gz"))
+
+    def put(self, name, version, jobdir, job_id=None):
+        """
+        Merge the corpus a job left in its job directory, as the corpus segment
+        and corpus-coverage.jsonl.gz, with the latest version of a corpus, as a
+        new version.
+
+        :return: new manifest, or None if the job has no corpus
+        """
+        previous = self.get(name)
+        located = self.locate(previous) if previous else {}
+
+        with lagopus_segment.Segment(os.path.join(jobdir, "corpus")) as results:
+            if not len(results):
+                return None
+            sizes = results.sizes()
+            segments = set(located[d][0] for d in sizes if d in located)
+
+            # inputs the latest version doesn't have go into a segment of their
+            # own
+            new = set(sizes) - set(located)
+            if new:
+                os.makedirs(self.path("segments"), exist_ok=True)
+                lagopus_segment.pack(
+                    ((d, data) for d, data in results.items() if d in new),
+                    self.path("segments", version),
+                )
+                segments.add(version)
+
+        target, features = lagopus_corpus_signatures_load(
+            os.path.join(jobdir, "corpus-coverage.jsonl.gz")
+        )
+        if previous:
+            for digest in previous["inputs"]:
+                if digest in sizes:
+                    continue
+                if digest not in located:
+                    # its segment is gone or damaged; the new version can only
+                    # go without it
+                    app.logger.warning(
+                        "Corpus {} version {} lost input {}".format(
+                            name, previous["version"], digest
+                        )
+                    )
+                    continue
+                segment, sizes[digest] = located[digest]
+                segments.add(segment)
+            prev_target, prev_features = self.signatures(name, previous["version"])
+            if target and prev_target == target:
+                for digest, f in prev_features.items():
+                    features.setdefault(digest, f)
+
+        manifest = {
+            "name": name,
+            "version": version,
+            "job_id": job_id,
+            "previous": previous["version"] if previous else None,
+            "create_time": datetime.datetime.utcnow().isoformat(),
+            "inputs": sorted(sizes),
+            "segments": sorted(segments),
+            "size": sum(sizes.values()),
+        }
+        os.makedirs(self.path(name), exist_ok=True)
+        if target:
+            lagopus_corpus_signatures_save(
+                self.path(name, version + ".cov.gz"),
+                target,
+                {d: f for d, f in features.items() if d in sizes},
+            )
+        lagopus_write_atomic(
+            self.path(name, version + ".json"), json.dumps(manifest).encode()
+        )
+        lagopus_write_atomic(self.path(name, "latest"), version.encode())
+        return manifest
+
+    def store_finished(self, cursor):
+        """
+        Put the corpora of finished jobs into the store.
+
+        :param cursor: dictionary cursor
+        """
+        cursor.execute(
+            "SELECT job_id, corpus FROM jobs WHERE phase = 'done' AND corpus IS NOT NULL AND corpus_version IS NULL"
+        )
+        for job in cursor.fetchall():
+            jobdir = os.path.join(CONFIG["dirs"]["jobs"], job["job_id"])
+            try:
+                manifest = self.put(
+                    job["corpus"], job["job_id"], jobdir, job["job_id"]
+                )
+            except (FileNotFoundError, ValueError) as e:
+                app.logger.warning(
+                    "Job {} has no usable corpus for corpus {}: {}".format(
+                        job["job_id"], job["corpus"], e
+                    )
+                )
+                manifest = None
+            except OSError as e:
+                # try again next pass
+                app.logger.error(
+                    "Couldn't store corpus of job {}: {}".format(job["job_id"], e)
+                )
+                continue
+            except Exception as e:
+                # e.g. a damaged segment; trying again won't help, and mustn't
+                # hold up the other jobs
+                app.logger.error(
+                    "Couldn't store corpus of job {}, giving up".format(job["job_id"])
+                )
+                app.logger.exception(e)
+                manifest = None
+
+            if manifest:
+                app.logger.info(
+                    "Stored corpus {} version {}, {} inputs".format(
+                        job["corpus"], manifest["version"], len(manifest["inputs"])
+                    )
+                )
+            # versions are named after the job, so this is its version, or
+            # empty if it didn't produce one
+            cursor.execute(
+                "UPDATE jobs SET corpus_version = %(version)s WHERE job_id = %(job_id)s",
+                {
+                    "job_id": job["job_id"],
+                    "version": manifest["version"] if manifest else "",
+                },
+            )
+
+
+def lagopus_write_atomic(path, data):
+    """
+    Write a file so that nobody reading it sees it half written.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+
+def lagopus_corpus_signatures_load(source):
+    """
+    Read a coverage signature file written by cmin.py.
+
+    :param source: path or binary file object
+    :return: tuple of (target SHA-1, dict of input SHA-1 to features); the
+             target is None if the file is missing or unreadable
+    """
+    signatures = {}
+    try:
+        with gzip.open(source, "rt") as f:
+            target = json.loads(f.readline() or "{}").get("target")
+            for line in f:
+                entry = json.loads(line)
+                signatures[entry["input"]] = entry["features"]
+    except FileNotFoundError:
+        return None, {}
+    except (OSError, ValueError, KeyError) as e:
+        app.logger.warning("Unreadable coverage signatures: {}".format(e))
+        return None, {}
+    return target, signatures
+
+
+def lagopus_corpus_signatures_save(path, target, signatures):
+    with gzip.open(path, "wt") as f:
+        f.write(json.dumps({"target": target}) + "\n")
+        for digest in sorted(signatures):
+            f.write(
+                json.dumps({"input": digest, "features": signatures[digest]}) + "\n"
+            )
+
+
+LagopusJob = LagopusJob()
+LagopusCrash = LagopusCrash()
+LagopusNode = LagopusNode()
+LagopusScan = LagopusScan()
+LagopusQueue = LagopusQueue()
+LagopusPlacement = LagopusPlacement()
+LagopusCorpus = LagopusCorpus()
+
+
+# ---
+# Scheduler
+# ---
+
+lagopus_scheduler_wake = threading.Event()
+
+
+def lagopus_schedule_cells(free, placements):
+    """
+    Estimate the whole cores free in each NUMA node of a node.
+
+    Lagopus jobs take cores from the NUMA node they were placed on. The
+    kubelet's reserved cores and every other pod are assumed to take cores
+    from the lowest numbered NUMA nodes first, which is how the static CPU
+    manager hands them out.
+
+    :param free: the node's entry from lagopus_k8s_get_capacity
+    :param placements: dict of (numa_node, cpus) keyed by job ID, for active
+                       jobs placed on this node
+    :return: list of free cores, indexed by NUMA node
+    """
+    cells = [free["cores"] // free["numa_nodes"]] * free["numa_nodes"]
+    others = free["reserved"]
+    for job_name, cpu in free["pods"]:
+        placed = placements.get(job_name)
+        if placed and placed[0] is not None and placed[0] < len(cells):
+            cells[placed[0]] -= math.ceil(cpu)
+        else:
+            others += cpu
+
+    others = math.ceil(others)
+    for i in range(len(cells)):
+        taken = min(max(cells[i], 0), others)
+        cells[i] -= taken
+        others -= taken
+
+    return cells
+
+
+def lagopus_schedule_fit(capacity, cpus, memory):
+    """
+    Find where a job fits, packing jobs onto as few nodes as possible and
+    keeping each within one NUMA node where possible.
+
+    :param capacity: free resources of each node, as from
+                     lagopus_k8s_get_capacity, each with "cells" from
+                     lagopus_schedule_cells
+    :param cpus: cores the job requests
+    :param memory: memory the job requests, in Mi
+    :return: tuple of (node name, NUMA node or None), or (None, None) if the
+             job doesn't fit anywhere
+    """
+    fits = []
+    for name, free in capacity.items():
+        # whole cores only; a fraction of a core can't be handed out exclusively
+        if math.floor(free["cpu"]) < cpus or free["memory"] < memory * 2 ** 20:
+            continue
+
+        # the fullest NUMA node that still has room
+        cells = [(c, i) for i, c in enumerate(free["cells"]) if c >= cpus]
+        numa_node = min(cells)[1] if cells else None
+        if (
+            numa_node is None
+            and CONFIG["scheduler"]["numa"] == "require"
+            and cpus <= free["cores"] // free["numa_nodes"]
+        ):
+            continue
+
+        fits.append((numa_node is None, math.floor(free["cpu"]) - cpus, name, numa_node))
+
+    if not fits:
+        return None, None
+    _, _, name, numa_node = min(fits)
+    return name, numa_node
+
+
+def lagopus_schedule_fit_pods(capacity, cpus, memory, pods):
+    """
+    Find where every pod of a job fits, placing them one at a time as
+    lagopus_schedule_fit would.
+
+    Pods of a distributed job can't be given a NUMA node each, since they
+    share one pod template, so they're placed without one.
+
+    :param capacity: as for lagopus_schedule_fit; not modified
+    :param cpus: cores each pod requests
+    :param memory: memory each pod requests, in Mi
+    :param pods: number of pods
+    :return: list of (node name, NUMA node or None) for each pod, or None if
+             they don't all fit
+    """
+    if pods == 1:
+        node, numa_node = lagopus_schedule_fit(capacity, cpus, memory)
+        return [(node, numa_node)] if node else None
+
+    capacity = copy.deepcopy(capacity)
+    placements = []
+    for _ in range(pods):
+        node, _ = lagopus_schedule_fit(capacity, cpus, memory)
+        if not node:
+            return None
+        lagopus_schedule_take(capacity[node], cpus, None)
+        capacity[node]["memory"] -= memory * 2 ** 20
+        placements.append((node, None))
+    return placements
+
+
+def lagopus_schedule_take(free, cpus, numa_node):
+    """
+    Account for a job's cores on the node it was placed on.
+    """
+    free["cpu"] -= cpus
+    if numa_node is not None:
+        free["cells"][numa_node] -= cpus
+        return
+    for i in sorted(range(len(free["cells"])), key=lambda i: -free["cells"][i]):
+        taken = min(max(free["cells"][i], 0), cpus)
+        free["cells"][i] -= taken
+        cpus -= taken
+
+
+def lagopus_schedule(cursor):
+    """
+    Release as many queued jobs into k8s as currently fit.
+
+    Jobs are considered highest priority first. Within a priority, jobs of
+    the user using the least of their share of the cluster go first, then
+    the longest waiting. Jobs that don't fit anywhere are skipped, letting
+    smaller jobs behind them through, until the first of them has waited
+    CONFIG["scheduler"]["backfill_wait"] seconds.
+
+    Nothing is released while k8s still has pods of released jobs it hasn't
+    found a node for, since the free resources it reports don't account for
+    those yet. A pod that has waited longer than
+    CONFIG["scheduler"]["pending_timeout"] seconds, which may never fit, stops
+    holding back the queue.
+
+    A distributed job is only released once all of its pods fit, and counts
+    against its user's share for all of them.
+
+    :param cursor: dictionary cursor on the scheduler's own connection
+    :return: number of jobs released
+    """
+    cursor.execute(
+        "SELECT job_id, phase, user, priority, cpus, pods, memory, enqueue_time FROM job_queue WHERE state = 'queued'"
+    )
+    queued = cursor.fetchall()
+    if not queued:
+        return 0
+
+    capacity, unbound = lagopus_k8s_get_capacity()
+    if unbound:
+        names = sorted({name for name, created in unbound})
+        cursor.execute(
+            "SELECT DISTINCT job_id FROM job_queue WHERE state = 'released' AND job_id IN ({})".format(
+                ", ".join(["%s"] * len(names))
+            ),
+            names,
+        )
+        released = {row["job_id"] for row in cursor.fetchall()}
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+            seconds=CONFIG["scheduler"]["pending_timeout"]
+        )
+        pending = [n for n, created in unbound if n in released and created > cutoff]
+        stuck = sorted(
+            {n for n, created in unbound if n in released and created <= cutoff}
+        )
+        if stuck:
+            app.logger.warning(
+                "Scheduler: pods of {} have been pending for over {}s, ignoring them".format(
+                    ", ".join(stuck), CONFIG["scheduler"]["pending_timeout"]
+                )
+            )
+        if pending:
+            app.logger.info("Scheduler: {} job pods still pending".format(len(pending)))
+            return 0
+
+    # cores currently used by each user's running jobs, and where they are
+    usage = {}
+    placements = {}
+    active = lagopus_k8s_get_active_jobs()
+    if active:
+        inlist = ", ".join(["%s"] * len(active))
+        cursor.execute(
+            "SELECT user, SUM(cpus * pods) AS cpus FROM job_queue WHERE state = 'released' AND job_id IN ({}) GROUP BY user".format(
+                inlist
+            ),
+            active,
+        )
+        usage = {row["user"]: float(row["cpus"]) for row in cursor.fetchall()}
+        cursor.execute(
+            "SELECT p.job_id, p.node, p.numa_node, p.cpus FROM job_placements p JOIN job_queue q ON q.job_id = p.job_id AND q.phase = p.phase WHERE p.job_id IN ({})".format(
+                inlist
+            ),
+            active,
+        )
+        for row in cursor.fetchall():
+            placements.setdefault(row["node"], {})[row["job_id"]] = (
+                row["numa_node"],
+                row["cpus"],
+            )
+
+    for name, free in capacity.items():
+        free["cells"] = lagopus_schedule_cells(free, placements.get(name, {}))
+
+    shares = CONFIG["scheduler"]["shares"]
+    now = datetime.datetime.utcnow()
+    released = 0
+
+    while queued:
+        queued.sort(
+            key=lambda j: (
+                -j["priority"],
+                usage.get(j["user"], 0) / shares.get(j["user"], 1),
+                j["enqueue_time"],
+            )
+        )
+
+        job = pods = None
+        for candidate in queued:
+            pods = lagopus_schedule_fit_pods(
+                capacity, candidate["cpus"], candidate["memory"], candidate["pods"]
+            )
+            if pods:
+                job = candidate
+                break
+            waited = (now - candidate["enqueue_time"]).total_seconds()
+            if waited > CONFIG["scheduler"]["backfill_wait"]:
+                break
+        if not job:
+            break
+
+        queued.remove(job)
+
+        # claim the job first so that a concurrent cancel can't be lost
+        cursor.execute(
+            "UPDATE job_queue SET state = 'released', release_time = %(now)s WHERE job_id = %(job_id)s AND state = 'queued'",
+            {"job_id": job["job_id"], "now": datetime.datetime.utcnow()},
+        )
+        if cursor.rowcount == 0:
+            continue
+
+        try:
+            lagopus_k8s_create_job(job["job_id"], pods, job["phase"])
+        except JobExistsError as e:
+            # the previous phase's k8s job is still being deleted; try again
+            # on the next pass
+            app.logger.info("Scheduler: {}, retrying".format(e))
+            cursor.execute(
+                "UPDATE job_queue SET state = 'queued', release_time = NULL WHERE job_id = %(job_id)s",
+                {"job_id": job["job_id"]},
+            )
+            continue
+        except (JobCreateError, OSError) as e:
+            app.logger.warning(
+                "Scheduler: failed to create job {}: {}".format(job["job_id"], e)
+            )
+            cursor.execute(
+                "UPDATE job_queue SET state = 'failed', error = %(error)s WHERE job_id = %(job_id)s",
+                {"job_id": job["job_id"], "error": str(e)},
+            )
+            cursor.execute(
+                "UPDATE jobs SET status = 'Failed' WHERE job_id = %(job_id)s",
+                {"job_id": job["job_id"]},
+            )
+            continue
+
+        cursor.execute(
+            "UPDATE jobs SET status = 'Created' WHERE job_id = %(job_id)s",
+            {"job_id": job["job_id"]},
+        )
+        place_time = datetime.datetime.utcnow()
+        for pod, (node, numa_node) in enumerate(pods):
+            # k8s decides which pod lands on which of the chosen nodes, so for
+            # distributed jobs this is only where some pod went
+            cursor.execute(
+                "INSERT INTO job_placements (job_id, phase, pod, node, numa_node, numa_nodes, cpus, place_time) VALUES (%(job_id)s, %(phase)s, %(pod)s, %(node)s, %(numa_node)s, %(numa_nodes)s, %(cpus)s, %(now)s)",
+                {
+                    "job_id": job["job_id"],
+                    "phase": job["phase"],
+                    "pod": pod,
+                    "node": node,
+                    "numa_node": numa_node,
+                    "numa_nodes": capacity[node]["numa_nodes"],
+                    "cpus": job["cpus"],
+                    "now": place_time,
+                },
+            )
+            app.logger.info(
+                "Scheduler: released job {} {} pod {} ({} cpus, {}Mi) for user {} onto {}, NUMA node {}".format(
+                    job["job_id"],
+                    job["phase"],
+                    pod,
+                    job["cpus"],
+                    job["memory"],
+                    job["user"],
+                    node,
+                    numa_node,
+                )
+            )
+            lagopus_schedule_take(capacity[node], job["cpus"], numa_node)
+            capacity[node]["memory"] -= job["memory"] * 2 ** 20
+        usage[job["user"]] = usage.get(job["user"], 0) + job["cpus"] * job["pods"]
+        released += 1
+
+    return released
+
+
+def lagopus_scheduler_metrics(stats):
+    """
+    Record queue statistics in InfluxDB alongside the job metrics.
+
+    :param stats: as from LagopusQueue.stats
+    """
+    point = {
+        "measurement": "queue",
+        "fields": {
+            "depth": stats["depth"],
+            "cpus": int(stats["cpus"]),
+            "memory": int(stats["memory"]),
+            "max_wait": float(stats["max_wait"] or 0),
+            "released": stats["released"],
+            "mean_wait": float(stats["mean_wait"] or 0),
+        },
+    }
+    try:
+        InfluxDBClient(database="lagopus").write_points([point])
+    except (InfluxDBClientError, requests.exceptions.RequestException) as e:
+        app.logger.warning("Couldn't record queue metrics: {}".format(e))
+
+
+def lagopus_scheduler():
+    """
+    Scheduler loop.
+
+    Every gunicorn worker runs one, but only the one whose connection holds
+    the scheduler lock in MySQL schedules anything. If that worker dies, its
+    connection goes with it and another worker takes over.
+    """
+    schedcnx = None
+    plateau_time = 0
+    while True:
+        lagopus_scheduler_wake.wait(CONFIG["scheduler"]["interval"])
+        lagopus_scheduler_wake.clear()
+
+        try:
+            if not schedcnx or not schedcnx.is_connected():
+                schedcnx = lagopus_db_connect()
+                if not schedcnx:
+                    continue
+
+            cursor = schedcnx.cursor(dictionary=True)
+            cursor.execute(
+                "SELECT IS_USED_LOCK('lagopus_scheduler') = CONNECTION_ID() OR GET_LOCK('lagopus_scheduler', 0) AS leader"
+            )
+            if not cursor.fetchall()[0]["leader"]:
+                cursor.close()
+                continue
+
+            # catch fuzz phases whose pods couldn't notify us, or didn't get
+            # the chance to
+            cursor.execute(
+                "SELECT job_id FROM jobs WHERE phase = 'fuzz' AND status NOT IN ('Queued', 'Cancelled', 'Failed')"
+            )
+            fuzzing = cursor.fetchall()
+            finished = lagopus_k8s_get_finished_jobs() if fuzzing else []
+            for row in fuzzing:
+                lagopus_job_advance(cursor, row["job_id"], row["job_id"] in finished)
+
+            LagopusCrash.expire_batches(cursor)
+
+            if time.monotonic() - plateau_time > CONFIG["plateau"]["interval"]:
+                plateau_time = time.monotonic()
+                lagopus_plateau_sweep(cursor)
+
+            lagopus_schedule(cursor)
+            lagopus_scheduler_metrics(LagopusQueue.stats(cursor))
+        except Exception as e:
+            app.logger.error("Scheduler pass failed")
+            app.logger.exception(e)
+            continue
+
+        # after scheduling, so that storing a corpus, which can take a while
+        # or fail, never holds up releasing jobs
+        try:
+            LagopusCorpus.store_finished(cursor)
+        except Exception as e:
+            app.logger.error("Storing finished corpora failed")
+            app.logger.exception(e)
+        cursor.close()
+
+
+threading.Thread(target=lagopus_scheduler, daemon=True).start()
+
+# Web
+
+
+@app.after_request
+def apply_caching(response):
+    """
+    Sometimes firefox doesn't allow inline scripts? What's up with that?
+    """
+    response.headers["Content-Security-Policy"] = "script-src 'unsafe-inline' 'self'"
+    return response
+
+
+## API
+
+app.config["UPLOAD_FOLDER"] = tempfile.mkdtemp()
 # XXX: Fixme!
 app.config["SECRET_KEY"] = "389afsd89j34fasd"
 
@@ -512,12 +2507,23 @@ job_base_model = Model(
         "cpus": fields.Integer(
             description="Number of CPUs the job should use", required=True
         ),
+        "pods": fields.Integer(
+            description="Number of pods to fuzz with, each with the job's CPUs and memory, sharing their corpus",
+            default=1,
+            min=1,
+        ),
         "memory": fields.Integer(
             description="Memory limit for the job, in Mi", required=True
         ),
         "deadline": fields.Integer(
             description="Maximum runtime of fuzzing step", required=True
         ),
+        "minimize_cpus": fields.Integer(
+            description="Number of CPUs the minimize phase should use", min=1
+        ),
+        "minimize_memory": fields.Integer(
+            description="Memory limit for the minimize phase, in Mi", min=1
+        ),
     },
 )
 
@@ -530,6 +2536,21 @@ job_request_model = api.clone(
             description="Base64 encoded zip archive containing target binary and corpus",
             required=True,
         ),
+        "user": fields.String(
+            description="User the job belongs to, for fair sharing of the cluster",
+            default="default",
+        ),
+        "priority": fields.Integer(
+            description="Scheduling priority; higher priority jobs are started first",
+            default=0,
+        ),
+        "corpus": fields.String(
+            description="Corpus in the corpus store to seed the job from and add its corpus to; defaults to the job name",
+        ),
+        "plateau": fields.String(
+            description="Policy deciding when the job's coverage has plateaued and it's stopped early; defaults to the server's default policy",
+            enum=list(CONFIG["plateau"]["policies"]),
+        ),
     },
 )
 
@@ -543,9 +2564,37 @@ job_response_model = api.clone(
         ),
         "status": fields.String(
             description="Current status of job",
-            enum=["Complete", "Incomplete", "Unknown"],
+            enum=[
+                "Queued",
+                "Created",
+                "Complete",
+                "Incomplete",
+                "Cancelled",
+                "Failed",
+                "Unknown",
+            ],
             required=True,
         ),
+        "phase": fields.String(
+            description="Phase the job is in", enum=["fuzz", "minimize", "done"]
+        ),
+        "phase_time": fields.DateTime(description="When the phase began (UTC)"),
+        "corpus": fields.String(description="Corpus in the corpus store"),
+        "corpus_seed": fields.String(
+            description="Version of the corpus the job was seeded from"
+        ),
+        "corpus_version": fields.String(
+            description="Version of the corpus the job's results were stored as"
+        ),
+        "plateau_policy": fields.String(
+            description="Plateau policy of the job, if not the server's default"
+        ),
+        "stop_time": fields.DateTime(
+            description="When the job was stopped before its deadline (UTC)"
+        ),
+        "stop_reason": fields.String(
+            description="Why the job was stopped before its deadline"
+        ),
     },
 )
 
@@ -566,23 +2615,166 @@ class JobList(Resource):
         except JobCreateError as e:
             errors.abort(code=400, message="Job creation failed: {}".format(str(e)))
 
-        app.logger.info("Created job {}".format(job))
-        return job
+        app.logger.info("Created job {}".format(job))
+        return job
+
+
+@api.route("/jobs/<string:job_id>")
+@api.doc(params={"job_id": "Job to retrieve"})
+class Job(Resource):
+    @api.marshal_with(job_response_model)
+    def get(self, job_id):
+        return LagopusJob.get(job_id)
+
+
+queue_model = api.model(
+    "QueuedJob",
+    {
+        "job_id": fields.String(description="Unique ID for job", required=True),
+        "user": fields.String(description="User the job belongs to", required=True),
+        "priority": fields.Integer(description="Scheduling priority", required=True),
+        "cpus": fields.Integer(description="Cores requested per pod", required=True),
+        "pods": fields.Integer(description="Pods requested", required=True),
+        "memory": fields.Integer(
+            description="Memory requested per pod, in Mi", required=True
+        ),
+        "state": fields.String(
+            description="Queue state",
+            enum=["queued", "released", "failed", "cancelled"],
+            required=True,
+        ),
+        "enqueue_time": fields.DateTime(description="When the job was queued (UTC)"),
+        "release_time": fields.DateTime(
+            description="When the job was released into k8s (UTC)"
+        ),
+        "wait": fields.Float(description="Seconds spent waiting in the queue"),
+        "error": fields.String(description="Why the job couldn't be created"),
+    },
+)
+
+queue_user_model = api.model(
+    "QueueUser",
+    {
+        "user": fields.String(description="User", required=True),
+        "depth": fields.Integer(description="Jobs queued", required=True),
+        "cpus": fields.Integer(description="Cores requested by queued jobs"),
+    },
+)
+
+queue_stats_model = api.model(
+    "QueueStats",
+    {
+        "depth": fields.Integer(description="Jobs queued", required=True),
+        "cpus": fields.Integer(description="Cores requested by queued jobs"),
+        "memory": fields.Integer(description="Memory requested by queued jobs, in Mi"),
+        "max_wait": fields.Float(
+            description="Seconds the longest waiting queued job has waited"
+        ),
+        "released": fields.Integer(description="Jobs released in the last hour"),
+        "mean_wait": fields.Float(
+            description="Mean seconds jobs released in the last hour waited"
+        ),
+        "users": fields.List(fields.Nested(queue_user_model)),
+    },
+)
+
+
+@api.route("/queue")
+class Queue(Resource):
+    @api.marshal_list_with(queue_model)
+    def get(self):
+        return LagopusQueue.get()
+
+
+@api.route("/queue/stats")
+class QueueStats(Resource):
+    @api.marshal_with(queue_stats_model)
+    def get(self):
+        return LagopusQueue.stats()
+
+
+@api.route("/queue/<string:job_id>")
+@api.doc(params={"job_id": "Job to retrieve queue entry for"})
+class QueueEntry(Resource):
+    @api.doc(responses={404: "Job was never queued"})
+    @api.marshal_with(queue_model)
+    def get(self, job_id):
+        entry = LagopusQueue.get(job_id)
+        if not entry:
+            errors.abort(code=404, message="Job {} was never queued".format(job_id))
+        return entry
+
+
+placement_model = api.model(
+    "Placement",
+    {
+        "job_id": fields.String(description="Unique ID for job", required=True),
+        "phase": fields.String(
+            description="Phase of the job", enum=["fuzz", "minimize"], required=True
+        ),
+        "pod": fields.Integer(description="Pod of the job", required=True),
+        "node": fields.String(description="Node the pod was placed on", required=True),
+        "numa_node": fields.Integer(
+            description="NUMA node the job's cores come from; null if they span NUMA nodes"
+        ),
+        "numa_nodes": fields.Integer(description="NUMA nodes on the node"),
+        "cpus": fields.Integer(description="Cores the job has to itself"),
+        "place_time": fields.DateTime(description="When the job was placed (UTC)"),
+    },
+)
+
+placement_stats_model = api.model(
+    "PlacementStats",
+    {
+        "placement": fields.String(
+            description="single: node has one NUMA node; aligned: job within one of several NUMA nodes; spanning: job across NUMA nodes; distributed: job with several pods",
+            enum=["single", "aligned", "spanning", "distributed"],
+            required=True,
+        ),
+        "jobs": fields.Integer(description="Number of jobs", required=True),
+        "execs_per_sec_per_core": fields.Float(
+            description="Mean executions per second per core", required=True
+        ),
+    },
+)
+
+parser_placement_stats = reqparse.RequestParser()
+parser_placement_stats.add_argument(
+    "since",
+    type=inputs.datetime_from_iso8601,
+    help="Only jobs placed since this time, as ISO 8601 timestamp",
+    default=None,
+)
 
 
-@api.route("/jobs/<string:job_id>")
-@api.doc(params={"job_id": "Job to retrieve"})
-class Job(Resource):
-    @api.marshal_with(job_response_model)
+@api.route("/jobs/<string:job_id>/placement")
+@api.doc(params={"job_id": "Job to retrieve placement for"})
+class JobPlacement(Resource):
+    @api.doc(responses={404: "Job hasn't been placed"})
+    @api.marshal_list_with(placement_model)
     def get(self, job_id):
-        return LagopusJob.get(job_id)
+        placement = LagopusPlacement.get(job_id)
+        if not placement:
+            errors.abort(code=404, message="Job {} hasn't been placed".format(job_id))
+        return placement
+
+
+@api.route("/placements/stats")
+class PlacementStats(Resource):
+    @api.expect(parser_placement_stats, validate=True)
+    @api.marshal_list_with(placement_stats_model)
+    def get(self):
+        args = parser_placement_stats.parse_args()
+        return LagopusPlacement.stats(**args)
 
 
 job_control_request_model = api.model(
     "JobControlRequest",
     {
         "action": fields.String(
-            description="Action to perform", enum=["kill"], required=True
+            description="Action to perform; stop ends fuzzing early but still minimizes the job's results",
+            enum=["kill", "stop"],
+            required=True,
         ),
     },
 )
@@ -636,6 +2828,18 @@ class JobControl(Resource):
                 app.logger.warning("k8s kill failed for job {}".format(job_id))
                 errors.abort(code=500, message="Failed to kill job {}".format(job_id))
 
+        if api.payload["action"] == "stop":
+            try:
+                stopped = LagopusJob.stop(job_id, "Stopped on request")
+            except OSError as e:
+                app.logger.warning("Could not stop job {}: {}".format(job_id, e))
+                errors.abort(code=500, message="Failed to stop job {}".format(job_id))
+            if not stopped:
+                errors.abort(code=400, message="Job {} isn't fuzzing".format(job_id))
+            response["status"] = "success"
+            response["info"] = "stopped job"
+            return response, 200
+
         errors.abort(code=400, message="Unknown action")
 
 
@@ -648,10 +2852,23 @@ stats_response_model = api.model(
             attribute="mean_alive",
         ),
         "cpu_hours": fields.Float(
-            description="Number of CPU hours consumed",
+            description="CPU hours consumed by the job's containers",
             required=True,
             attribute="mean_cpu_hours",
         ),
+        "cpu_periods": fields.Integer(
+            description="CFS scheduling periods the job's containers have run for",
+            attribute="mean_cpu_periods",
+        ),
+        "cpu_throttled": fields.Integer(
+            description="Scheduling periods in which the job's containers were "
+            "throttled for reaching their CPU limit",
+            attribute="mean_cpu_throttled",
+        ),
+        "cpu_throttled_seconds": fields.Float(
+            description="Seconds the job's containers spent throttled",
+            attribute="mean_cpu_throttled_seconds",
+        ),
         "crashes": fields.Integer(
             description="Number of crashes triggered",
             required=True,
@@ -678,7 +2895,21 @@ stats_response_model = api.model(
             attribute="mean_hangs",
         ),
         "memory": fields.Float(
-            description="Memory usage, in Mi", required=True, attribute="mean_memory"
+            description="Memory used by the job's containers, in Mi",
+            required=True,
+            attribute="mean_memory",
+        ),
+        "memory_peak": fields.Float(
+            description="Most memory the job's containers have used, in Mi",
+            attribute="mean_memory_peak",
+        ),
+        "memory_limit": fields.Float(
+            description="Memory the job's containers may use, in Mi",
+            attribute="mean_memory_limit",
+        ),
+        "oom_kills": fields.Integer(
+            description="Processes killed for running out of memory",
+            attribute="mean_oom_kills",
         ),
         "pending": fields.Integer(
             description="For AFL, number of unexplored paths",
@@ -727,6 +2958,85 @@ class JobStats(Resource):
         return results
 
 
+instance_model = api.model(
+    "JobInstance",
+    {
+        "pod": fields.Integer(description="Pod the instance runs in", required=True),
+        "instance": fields.String(
+            description="Instance ID; AFL instance name, or libFuzzer worker index",
+            required=True,
+        ),
+        "alive": fields.Boolean(description="Whether it's running", required=True),
+        "execs_per_sec": fields.Float(description="Target executions per second"),
+        "execs": fields.Integer(description="Total execution count of target"),
+        "total_paths": fields.Integer(
+            description="Execution paths discovered; for libFuzzer, its coverage"
+        ),
+        "pending_fav": fields.Integer(
+            description="For AFL, number of favored unexplored paths"
+        ),
+        "crashes": fields.Integer(description="For AFL, number of crashes"),
+        "hangs": fields.Integer(description="For AFL, number of hangs"),
+        "since_last_path": fields.Integer(
+            description="For AFL, seconds since it last found a path"
+        ),
+        "since_update": fields.Integer(
+            description="For AFL, seconds since it last updated its stats"
+        ),
+        "flags": fields.List(
+            fields.String(enum=["dead", "slow", "stuck"]),
+            description="What's wrong with it, if anything",
+        ),
+    },
+)
+
+instances_response_model = api.model(
+    "JobInstancesResponse",
+    {
+        "instances": fields.List(fields.Nested(instance_model)),
+        "alive": fields.Integer(description="Instances running", required=True),
+        "flagged": fields.Integer(
+            description="Instances that are dead, stuck or slow", required=True
+        ),
+        "execs": fields.Integer(description="Total execution count of target"),
+        "execs_per_sec": fields.Float(
+            description="Target executions per second, of all instances"
+        ),
+        "execs_per_sec_min": fields.Float(
+            description="Execs/sec of the slowest running instance"
+        ),
+        "execs_per_sec_max": fields.Float(
+            description="Execs/sec of the fastest running instance"
+        ),
+        "execs_per_sec_median": fields.Float(
+            description="Median execs/sec of the running instances"
+        ),
+        "skew": fields.Float(
+            description="Spread of execs/sec of the running instances, as "
+            "(max - min) / mean; 0 when they're all the same"
+        ),
+    },
+)
+
+
+@api.route("/jobs/<string:job_id>/instances")
+@api.doc(params={"job_id": "Job to retrieve instance stats for"})
+class JobInstances(Resource):
+    @api.marshal_with(instances_response_model)
+    @api.doc(responses={503: "Could not connect to stats database"})
+    def get(self, job_id):
+        """
+        Latest stats of each of the job's fuzzer instances, with how they
+        compare. Instances that are dead, stuck, or much slower than the
+        job's median instance are flagged.
+        """
+        try:
+            return LagopusJob.get_instance_stats(job_id)
+        except ConnectionError as e:
+            app.logger.warning("Could not connect to InfluxDB: {}".format(e))
+            errors.abort(code=503, message="Could not connect to InfluxDB")
+
+
 @api.route("/jobs/<string:job_id>/result")
 @api.doc(params={"job_id": "Job to retrieve result for"})
 class JobResults(Resource):
@@ -738,6 +3048,289 @@ class JobResults(Resource):
         else:
             errors.abort(code=404, message="Result not found")
 
+    @api.doc(
+        responses={
+            202: "Scanner notified",
+            404: "Result not found",
+            503: "Could not notify scanner",
+        }
+    )
+    def post(self, job_id):
+        """
+        Notify Lagopus that a job has uploaded its results.
+
+        Called by fuzzer pods once their results are in the job directory so
+        that crashes are imported immediately.
+        """
+        if not LagopusJob.get_result(job_id):
+            errors.abort(code=404, message="Result not found")
+
+        if not LagopusJob.notify_result(job_id):
+            errors.abort(code=503, message="Could not notify scanner")
+
+        return {}, 202
+
+
+artifact_model = api.model(
+    "JobArtifact",
+    {
+        "job_id": fields.String(description="Job that streamed it", required=True),
+        "path": fields.String(
+            description="Path in the job's assembled output", required=True
+        ),
+        "pod": fields.Integer(description="Pod that streamed it"),
+        "kind": fields.String(
+            description="What it is",
+            enum=["corpus", "crash", "hang", "stats", "log"],
+        ),
+        "sha1": fields.String(description="SHA-1 of its contents"),
+        "size": fields.Integer(description="Size, in bytes"),
+        "segment": fields.String(
+            description="Segment its latest copy is in, within the job directory"
+        ),
+        "stream_time": fields.DateTime(description="When it was streamed (UTC)"),
+    },
+)
+
+parser_artifacts = reqparse.RequestParser()
+parser_artifacts.add_argument(
+    "kind",
+    type=str,
+    choices=["corpus", "crash", "hang", "stats", "log"],
+    help="Only return artifacts of this kind",
+    default=None,
+)
+
+
+@api.route("/jobs/<string:job_id>/artifacts")
+@api.doc(params={"job_id": "Job to list streamed results of"})
+class JobArtifactList(Resource):
+    @api.expect(parser_artifacts, validate=True)
+    @api.marshal_list_with(artifact_model)
+    def get(self, job_id):
+        """
+        Results the job's pods have streamed so far.
+
+        Pods stream crashes, corpus inputs, stats and logs to the job directory
+        as they go, so these are available while the job is still running.
+        """
+        args = parser_artifacts.parse_args()
+        return LagopusJob.get_artifacts(job_id, args["kind"])
+
+
+@api.route("/jobs/<string:job_id>/artifacts/<path:path>")
+@api.doc(params={"job_id": "Job that streamed it", "path": "Path of the artifact"})
+class JobArtifact(Resource):
+    @api.doc(responses={404: "Artifact not found"})
+    def get(self, job_id, path):
+        """
+        Download the latest streamed copy of an artifact.
+        """
+        data = LagopusJob.get_artifact(job_id, path)
+        if data is None:
+            errors.abort(code=404, message="Artifact not found")
+        return send_file(
+            io.BytesIO(data),
+            as_attachment=True,
+            attachment_filename=os.path.basename(path),
+        )
+
+
+job_phase_request_model = api.model(
+    "JobPhaseRequest",
+    {
+        "phase": fields.String(
+            description="Phase the pod finished", enum=["fuzz", "minimize"], required=True
+        ),
+    },
+)
+
+job_phase_response_model = api.model(
+    "JobPhaseResponse",
+    {
+        "job_id": fields.String(description="Unique ID for job", required=True),
+        "phase": fields.String(
+            description="Phase the job is in", enum=["fuzz", "minimize", "done"]
+        ),
+        "phase_time": fields.DateTime(description="When the phase began (UTC)"),
+    },
+)
+
+
+@api.route("/jobs/<string:job_id>/phase")
+@api.doc(params={"job_id": "Job whose pod finished a phase"})
+class JobPhase(Resource):
+    @api.expect(job_phase_request_model, validate=True)
+    @api.marshal_with(job_phase_response_model)
+    @api.doc(responses={404: "No such job"})
+    def post(self, job_id):
+        """
+        Notify Lagopus that a pod of a job has finished a phase.
+
+        Called by fuzzer pods once their output is in the job directory. When
+        every pod of the fuzz phase has, the job is queued for its minimize
+        phase.
+        """
+        result = LagopusJob.finish_phase(job_id, api.payload["phase"])
+        if not result:
+            errors.abort(code=404, message="No such job")
+        return result
+
+
+span_request_model = api.model(
+    "JobSpanRequest",
+    {
+        "phase": fields.String(
+            description="Phase of the job", enum=["fuzz", "minimize"], required=True
+        ),
+        "pod": fields.Integer(description="Index of the pod", required=True, min=0),
+        "name": fields.String(
+            description="Step of the phase, e.g. provision, fuzz, triage",
+            required=True,
+            max_length=64,
+        ),
+        "start_time": fields.Float(
+            description="When the step began, as a UNIX time", required=True
+        ),
+        "end_time": fields.Float(
+            description="When the step ended, as a UNIX time", required=True
+        ),
+        "cpu_seconds": fields.Float(
+            description="CPU seconds the pod used during the step"
+        ),
+        "memory_peak": fields.Integer(
+            description="Peak memory of the pod by the end of the step, in bytes"
+        ),
+        "detail": fields.String(description="Anything else worth knowing"),
+    },
+)
+
+span_model = api.model(
+    "JobSpan",
+    {
+        "phase": fields.String(description="Phase of the job", required=True),
+        "pod": fields.Integer(description="Index of the pod", required=True),
+        "name": fields.String(description="Step of the phase", required=True),
+        "start_time": fields.DateTime(description="When it began (UTC)"),
+        "end_time": fields.DateTime(description="When it ended (UTC)"),
+        "duration": fields.Float(
+            description="Seconds it took",
+            attribute=lambda s: (s["end_time"] - s["start_time"]).total_seconds(),
+        ),
+        "cpu_seconds": fields.Float(
+            description="CPU seconds the pod used during the step"
+        ),
+        "memory_peak": fields.Integer(
+            description="Peak memory of the pod by the end of the step, in bytes"
+        ),
+        "detail": fields.String(description="Anything else worth knowing"),
+    },
+)
+
+
+@api.route("/jobs/<string:job_id>/timeline")
+@api.doc(params={"job_id": "Job the timeline is of"})
+class JobTimeline(Resource):
+    @api.marshal_list_with(span_model)
+    def get(self, job_id):
+        """
+        Steps of the job's pods, e.g. setting up the target, fuzzing, triaging
+        crashes and minimizing the corpus, with how long each took and the
+        resources it used.
+        """
+        return LagopusJob.get_timeline(job_id)
+
+    @api.expect(span_request_model, validate=True)
+    @api.doc(responses={201: "Span recorded", 400: "Bad span", 404: "No such job"})
+    def post(self, job_id):
+        """
+        Record a step of one of the job's pods. Called by fuzzer pods as they
+        go.
+        """
+        if api.payload["end_time"] < api.payload["start_time"]:
+            errors.abort(code=400, message="Span ends before it starts")
+        if not LagopusJob.add_span(job_id, api.payload):
+            errors.abort(code=404, message="No such job")
+        return {}, 201
+
+
+corpus_model = api.model(
+    "Corpus",
+    {
+        "name": fields.String(description="Name of the corpus", required=True),
+        "version": fields.String(description="Version of the corpus", required=True),
+        "job_id": fields.String(description="Job whose results made this version"),
+        "previous": fields.String(description="Version this one was merged with"),
+        "create_time": fields.DateTime(description="When it was stored (UTC)"),
+        "inputs": fields.Integer(
+            description="Number of inputs",
+            attribute=lambda m: len(m["inputs"]),
+        ),
+        "size": fields.Integer(description="Total size of the inputs, in bytes"),
+    },
+)
+
+
+@api.route("/corpora")
+class CorpusList(Resource):
+    @api.marshal_list_with(corpus_model)
+    def get(self):
+        """
+        Latest version of each corpus in the corpus store.
+        """
+        corpora = [LagopusCorpus.get(name) for name in LagopusCorpus.names()]
+        return [c for c in corpora if c]
+
+
+@api.route("/corpora/<string:name>")
+@api.doc(params={"name": "Corpus to retrieve versions of"})
+class Corpus(Resource):
+    @api.doc(responses={404: "No such corpus"})
+    @api.marshal_list_with(corpus_model)
+    def get(self, name):
+        versions = LagopusCorpus.versions(secure_filename(name))
+        if not versions:
+            errors.abort(code=404, message="No such corpus")
+        return versions
+
+
+parser_corpus_download = reqparse.RequestParser()
+parser_corpus_download.add_argument(
+    "version", type=str, help="Version to download; defaults to the latest"
+)
+
+
+@api.route("/corpora/<string:name>/download")
+@api.doc(params={"name": "Corpus to download"})
+class CorpusDownload(Resource):
+    @api.expect(parser_corpus_download, validate=True)
+    @api.doc(responses={404: "No such corpus"})
+    def get(self, name):
+        """
+        Download a corpus as a zip, laid out as a job zip's corpus directory,
+        with the coverage recorded for it.
+        """
+        args = parser_corpus_download.parse_args()
+        name = secure_filename(name)
+        version = secure_filename(args["version"]) if args["version"] else None
+        manifest = LagopusCorpus.get(name, version)
+        if not manifest:
+            errors.abort(code=404, message="No such corpus")
+
+        out = tempfile.TemporaryFile()
+        with ZipFile(out, "w") as zf:
+            for digest, data in LagopusCorpus.inputs(manifest):
+                zf.writestr("corpus/" + digest, data)
+            cov = LagopusCorpus.path(name, manifest["version"] + ".cov.gz")
+            if os.path.exists(cov):
+                zf.write(cov, "corpus-coverage.jsonl.gz")
+        out.seek(0)
+        return send_file(
+            out,
+            as_attachment=True,
+            attachment_filename="{}-{}.zip".format(name, manifest["version"]),
+        )
+
 
 crash_model = api.model(
     "Crash",
@@ -759,7 +3352,7 @@ crash_model = api.model(
             description="Name of sample that triggers the crash", required=True
         ),
         "backtrace": fields.String(
-            description="Program output upon crash", required=True
+            description="Program output upon crash; only included when requested"
         ),
         "backtrace_hash": fields.String(
             description="Backtrace hash; used for deduplicating crashes"
@@ -777,6 +3370,76 @@ parser_crashes.add_argument(
     default=None,
     required=False,
 )
+parser_crashes.add_argument(
+    "type", type=str, help="Return crashes of a specific type", default=None,
+)
+parser_crashes.add_argument(
+    "is_security_issue",
+    type=inputs.boolean,
+    help="Return only crashes that are (or are not) likely security issues",
+    default=None,
+)
+parser_crashes.add_argument(
+    "since",
+    type=inputs.datetime_from_iso8601,
+    help="Return crashes imported since this time, as ISO 8601 timestamp",
+    default=None,
+)
+parser_crashes.add_argument(
+    "limit",
+    type=inputs.positive,
+    help="Return at most this many crashes",
+    default=None,
+)
+parser_crashes.add_argument(
+    "backtraces",
+    type=inputs.boolean,
+    help="Include backtraces; fetch them individually when possible",
+    default=False,
+)
+
+parser_crash_search = reqparse.RequestParser()
+parser_crash_search.add_argument(
+    "function", type=str, help="Return crashes with a frame in this function",
+)
+parser_crash_search.add_argument(
+    "file",
+    type=str,
+    help="Return crashes with a frame in this file; full path or file name",
+)
+parser_crash_search.add_argument(
+    "q",
+    type=str,
+    help="Return crashes with a frame whose function or file matches this full text query",
+)
+parser_crash_search.add_argument(
+    "depth",
+    type=inputs.positive,
+    help="Only match the top N interesting frames of each stack",
+    default=None,
+)
+parser_crash_search.add_argument(
+    "type", type=str, help="Return crashes of a specific type", default=None,
+)
+parser_crash_search.add_argument(
+    "job_id", type=str, help="Return crashes found by a specific job", default=None,
+)
+parser_crash_search.add_argument(
+    "limit",
+    type=inputs.positive,
+    help="Return at most this many crashes",
+    default=100,
+)
+
+crash_backtrace_model = api.model(
+    "CrashBacktrace",
+    {
+        "backtrace": fields.String(
+            description="Program output upon crash", required=True
+        ),
+        "output": fields.String(description="Full program output"),
+    },
+)
 
 
 @api.route("/crashes")
@@ -790,6 +3453,175 @@ class CrashList(Resource):
         return crashes
 
 
+@api.route("/crashes/search")
+class CrashSearch(Resource):
+    @api.expect(parser_crash_search, validate=True)
+    @api.doc(responses={400: "No frame criteria given"})
+    @api.marshal_list_with(crash_model)
+    def get(self):
+        args = parser_crash_search.parse_args()
+        if not (args["function"] or args["file"] or args["q"]):
+            errors.abort(code=400, message="One of function, file or q is required")
+        return LagopusCrash.search(**args)
+
+
+crash_batch_response_model = api.model(
+    "CrashBatchResponse",
+    {
+        "accepted": fields.Integer(description="Number of crashes stored"),
+        "duplicates": fields.Integer(
+            description="Number of crashes dropped as duplicates within the batch"
+        ),
+        "replayed": fields.Boolean(
+            description="Whether the batch had already been applied; if so, the "
+            "counts are those of the first attempt"
+        ),
+    },
+)
+
+# fields every analysis in a batch must have
+CRASH_BATCH_FIELDS = [
+    "job_id",
+    "sample",
+    "type",
+    "is_crash",
+    "is_security_issue",
+    "backtrace",
+]
+
+
+class BodyTooLargeError(ValueError):
+    pass
+
+
+def lagopus_decode_body(data, encoding, limit):
+    """
+    Decompress a request body.
+
+    :param data: request body
+    :param encoding: its Content-Encoding; gzip, zstd or identity
+    :param limit: most bytes to decompress it to
+    :return: decompressed body
+    :raises BodyTooLargeError: if it decompresses to more than limit bytes
+    :raises ValueError: if the encoding isn't supported or the body is corrupt
+    """
+    encoding = (encoding or "identity").lower()
+    if encoding == "identity":
+        out = data
+    elif encoding == "gzip":
+        try:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            out = decompressor.decompress(data, limit + 1)
+        except zlib.error as e:
+            raise ValueError("Corrupt gzip body: {}".format(e))
+    elif encoding == "zstd":
+        try:
+            reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data))
+            out = reader.read(limit + 1)
+        except zstandard.ZstdError as e:
+            raise ValueError("Corrupt zstd body: {}".format(e))
+    else:
+        raise ValueError("Unsupported Content-Encoding '{}'".format(encoding))
+
+    if len(out) > limit:
+        raise BodyTooLargeError(
+            "Body decompresses to more than {} bytes".format(limit)
+        )
+    return out
+
+
+@api.route("/crashes/batch")
+class CrashBatch(Resource):
+    @api.marshal_with(crash_batch_response_model)
+    @api.doc(
+        params={
+            "Idempotency-Key": {
+                "in": "header",
+                "description": "Key identifying the batch; a batch sent again "
+                "with the same key is only applied once",
+            }
+        },
+        responses={
+            400: "Malformed batch",
+            413: "Batch too large",
+            503: "Could not connect to database",
+        },
+    )
+    def post(self):
+        """
+        Ingest a batch of crash analyses.
+
+        The body is newline delimited JSON, one analysis per line, optionally
+        compressed with gzip or zstd as given by Content-Encoding. Each
+        analysis has job_id, sample, type, is_crash, is_security_issue,
+        backtrace, output, return_code, and the parsed stack frames in frames,
+        as written by triage.py in the fuzzer.
+
+        Crashes with the same backtrace in the same job are stored once, and
+        the batch is applied in a single transaction. Give each batch a unique
+        Idempotency-Key to make retrying it safe.
+        """
+        limit = CONFIG["crashes"]["batch_max_bytes"]
+        try:
+            body = lagopus_decode_body(
+                request.get_data(), request.headers.get("Content-Encoding"), limit
+            )
+        except BodyTooLargeError as e:
+            errors.abort(code=413, message=str(e))
+        except ValueError as e:
+            errors.abort(code=400, message=str(e))
+
+        crashes = []
+        for i, line in enumerate(body.splitlines()):
+            if not line.strip():
+                continue
+            try:
+                crash = json.loads(line)
+            except ValueError as e:
+                errors.abort(code=400, message="Line {}: {}".format(i + 1, e))
+            if not isinstance(crash, dict):
+                errors.abort(code=400, message="Line {}: not an object".format(i + 1))
+            missing = [f for f in CRASH_BATCH_FIELDS if f not in crash]
+            if missing:
+                errors.abort(
+                    code=400,
+                    message="Line {}: missing {}".format(i + 1, ", ".join(missing)),
+                )
+            if not isinstance(crash["backtrace"], str):
+                errors.abort(
+                    code=400, message="Line {}: backtrace isn't text".format(i + 1)
+                )
+            crashes.append(crash)
+
+        batch_key = request.headers.get("Idempotency-Key")
+        if batch_key is not None and not 0 < len(batch_key) <= 128:
+            errors.abort(
+                code=400, message="Idempotency-Key must be 1 to 128 characters"
+            )
+
+        try:
+            return LagopusCrash.ingest(crashes, batch_key)
+        except ConnectionError as e:
+            errors.abort(code=503, message=str(e))
+
+
+@api.route("/crashes/<string:job_id>/backtraces/<string:backtrace_hash>")
+@api.doc(
+    params={
+        "job_id": "Job the crash was found by",
+        "backtrace_hash": "Backtrace hash of the crash",
+    }
+)
+class CrashBacktrace(Resource):
+    @api.doc(responses={404: "Crash not found"})
+    @api.marshal_with(crash_backtrace_model)
+    def get(self, job_id, backtrace_hash):
+        backtrace = LagopusCrash.get_backtrace(job_id, backtrace_hash)
+        if not backtrace:
+            errors.abort(code=404, message="Crash not found")
+        return backtrace
+
+
 @api.route("/crashes/<string:job_id>/samples/<string:sample_name>")
 @api.doc(
     params={"job_id": "Job to select sample from", "sample_name": "Name of sample"}
@@ -804,6 +3636,120 @@ class CrashSample(Resource):
             errors.abort(code=404, message="Sample not found")
 
 
+scan_model = api.model(
+    "Scan",
+    {
+        "job_id": fields.String(description="Job the results belong to", required=True),
+        "results_file": fields.String(
+            description="Results file within the job directory", required=True
+        ),
+        "results_size": fields.Integer(description="Size of results file, in bytes"),
+        "results_mtime": fields.DateTime(
+            description="Modification time of results file (UTC)"
+        ),
+        "results_hash": fields.String(description="SHA-1 of results file"),
+        "status": fields.String(
+            description="Scan status",
+            enum=["running", "complete", "failed"],
+            required=True,
+        ),
+        "rows_imported": fields.Integer(description="Number of crashes imported"),
+        "scan_start": fields.DateTime(description="When the scan started (UTC)"),
+        "scan_finish": fields.DateTime(description="When the scan finished (UTC)"),
+        "error": fields.String(description="Why the scan failed"),
+        "lag": fields.Float(
+            description="Seconds between results landing and their import finishing"
+        ),
+    },
+)
+
+scan_summary_model = api.model(
+    "ScanSummary",
+    {
+        "status": fields.String(description="Scan status", required=True),
+        "scans": fields.Integer(description="Number of scans", required=True),
+        "rows_imported": fields.Integer(description="Total crashes imported"),
+        "mean_lag": fields.Float(description="Mean ingestion lag, in seconds"),
+        "max_lag": fields.Float(description="Maximum ingestion lag, in seconds"),
+    },
+)
+
+parser_scans = reqparse.RequestParser()
+parser_scans.add_argument(
+    "job_id",
+    type=str,
+    help="Return scans of a specific job",
+    default=None,
+    required=False,
+)
+
+parser_scan_summary = reqparse.RequestParser()
+parser_scan_summary.add_argument(
+    "since",
+    type=inputs.datetime_from_iso8601,
+    help="Only summarize scans started since this time, as ISO 8601 timestamp",
+    default=None,
+)
+
+
+@api.route("/scans")
+class ScanList(Resource):
+    @api.expect(parser_scans, validate=True)
+    @api.marshal_list_with(scan_model)
+    def get(self):
+        args = parser_scans.parse_args()
+        scans = LagopusScan.get(**args)
+        return scans if scans else []
+
+
+scan_throughput_model = api.model(
+    "ScanThroughput",
+    {
+        "backlog": fields.Integer(
+            description="Number of jobs waiting to be scanned", required=True
+        ),
+        "workers": fields.Integer(description="Number of scan workers", required=True),
+        "jobs": fields.Integer(
+            description="Jobs scanned since scanner startup", required=True
+        ),
+        "rows": fields.Integer(
+            description="Crashes imported since scanner startup", required=True
+        ),
+        "errors": fields.Integer(
+            description="Failed scans since scanner startup", required=True
+        ),
+        "jobs_per_sec": fields.Float(
+            description="Jobs scanned per second over the last minute", required=True
+        ),
+        "rows_per_sec": fields.Float(
+            description="Crashes imported per second over the last minute",
+            required=True,
+        ),
+    },
+)
+
+
+@api.route("/scans/throughput")
+class ScanThroughput(Resource):
+    @api.marshal_with(scan_throughput_model)
+    @api.doc(responses={503: "Could not reach scanner"})
+    def get(self):
+        stats = LagopusScan.throughput()
+        if stats is None:
+            errors.abort(code=503, message="Could not reach scanner")
+        return stats
+
+
+@api.route("/scans/summary")
+class ScanSummary(Resource):
+    @api.expect(parser_scan_summary, validate=True)
+    @api.marshal_list_with(scan_summary_model)
+    def get(self):
+        args = parser_scan_summary.parse_args()
+        summary = LagopusScan.summary(**args)
+        return summary if summary else []
+
+
 # -------------
 # Web interface
 # -------------
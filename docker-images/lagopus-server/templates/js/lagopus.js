@@ -139,6 +139,15 @@ function lagopus_job_aflperf(ctx, jobid) {
                 fill: false,
                 data: [],
                 yAxisID: "y-axis-memory"
+            }, {
+                label: 'Memory limit',
+                influx_column: 'memory_limit',
+                pointRadius: 0,
+                borderColor: color(lagopusChartColors.red).alpha(0.6).rgbString(),
+                borderDash: [5, 5],
+                fill: false,
+                data: [],
+                yAxisID: "y-axis-memory"
             }]
         },
         options: {